@@ -1,6 +1,28 @@
+import os
 import json
 import logging
-import ollama
+
+import metrics
+import llm_client
+
+# "two_pass": enhance_text_with_ai then generate_report_with_ai
+# "single_pass": generate_structured_report, one streamed generation for both
+AI_PIPELINE_MODE = os.getenv('AI_PIPELINE_MODE', 'two_pass')
+# Ollama model used for all generations
+AI_MODEL = os.getenv('AI_MODEL', 'gemma3')
+# Part of the cache key of model outputs. The source of the AI functions is hashed as well,
+# bump this when output changes through anything else, e.g. the parsing helpers.
+PROMPT_VERSION = '1'
+
+# Keys of the structured report, in template order
+REPORT_KEYS = [
+    'patient_name', 'examination_date', 'sex', 'age', 'refby', 'uhidno',
+    'examination_type', 'examined_area', 'device_model', 'imaging_findings',
+    'diagnosis_summary', 'comment'
+]
+# Fields that may legitimately hold nested structures (formatted by report_generation)
+FREE_TEXT_KEYS = {'imaging_findings', 'diagnosis_summary', 'comment'}
+
 def enhance_text_with_ai(text):
     """
     Use AI to enhance and refine the input text
@@ -21,10 +43,11 @@ Original text:
 Please return only the enhanced text without any explanations or additional content.
 """
         # Call AI model for text enhancement
-        response = ollama.generate(model='gemma3', prompt=prompt)
+        response = llm_client.generate(AI_MODEL, prompt)
+        metrics.record_llm_usage('enhance_text_with_ai', response, AI_MODEL)
         enhanced_text = response['response']
         
-        print("Enhanced text:", enhanced_text)  # Debug log
+        metrics.log_payload("Enhanced text", enhanced_text)
         return enhanced_text.strip()
         
     except Exception as e:
@@ -32,29 +55,21 @@ Please return only the enhanced text without any explanations or additional cont
         return text  # Return original text if enhancement fails
 
 
-def generate_report_with_ai(text):
+def generate_report_with_ai(text, keys=None):
     """
     Generate structured report using Llama2 via Ollama
     text: Text obtained from OCR or speech recognition
+    keys: report keys to ask for, default all of REPORT_KEYS (fields already read from the text are left out)
     """
+    keys = keys or REPORT_KEYS
     try:
-        print("Text passed to AI model:", text)  # 打印传递给模型的文本
+        metrics.log_payload("Text passed to AI model", text)
         # Construct prompt, specifying required fields
+        key_list = '\n'.join(f'- {key}' for key in keys)
         prompt = f"""Below is some content. Generate a structured report strictly in JSON format with exactly the following keys. If a field is not mentioned in the content, set its value to "UNKNOWN". Do not include any text or commentary outside of the JSON object.
 
 Keys:
-- patient_name
-- examination_date
-- sex
-- age
-- refby
-- uhidno
-- examination_type
-- examined_area
-- device_model
-- imaging_findings
-- diagnosis_summary
-- comment
+{key_list}
 
 Content:
 {text}
@@ -63,17 +78,17 @@ Output only a valid JSON object.
 """
         
         # Call Llama2 via Ollama
-        response = ollama.generate(model='gemma3', prompt=prompt)
+        response = llm_client.generate(AI_MODEL, prompt)
+        metrics.record_llm_usage('generate_report_with_ai', response, AI_MODEL)
         generated_text = response['response']
         
-        # Debug: Print the generated text
-        print("Generated text from AI1234:", generated_text)
+        metrics.log_payload("Generated text from AI", generated_text)
          # 使用正则表达式提取 JSON 部分
         import re
         match = re.search(r'(\{.*\})', generated_text, re.DOTALL)
         if match:
             json_str = match.group(1)
-            print("Extracted JSON string:", json_str)
+            metrics.log_payload("Extracted JSON string", json_str)
         else:
             # 如果未找到花括号，则直接使用原文本（可能会失败）
             json_str = generated_text
@@ -81,46 +96,157 @@ Output only a valid JSON object.
         try:
             data = json.loads(json_str)
             # Ensure all keys are present and have non-empty values
-            required_keys = [
-                'patient_name', 'examination_date', 'sex', 'age', 'refby', 'uhidno',
-                'examination_type', 'examined_area', 'device_model', 'imaging_findings',
-                'diagnosis_summary', 'comment'
-            ]
-            for key in required_keys:
+            for key in keys:
                 if key not in data or not data[key]:
                     data[key] = '456'
             return data
         except json.JSONDecodeError:
             # If cannot parse as JSON, return default structure
-            return {
-                'patient_name': 'unknown',
-                'examination_date': 'unknown',
-                'sex': 'unknown',
-                'age': 'unknown',
-                'refby': 'unknown',
-                'uhidno': 'unknown',
-                'examination_type': 'unknown',
-                'examined_area': 'unknown',
-                'device_model': 'unknown',
-                'imaging_findings': 'unknown',
-                'diagnosis_summary': 'unknown',
-                'comment': 'unknown'
-            }
+            return {key: 'unknown' for key in keys}
         
     except Exception as e:
         logging.error(f"gemma3 report generation failed: {str(e)}")
         # If AI generation fails, return default structure
-        return {
-            'patient_name': 'unknown',
-            'examination_date': 'unknown',
-            'sex': 'unknown',
-            'age': 'unknown',
-            'refby': 'unknown',
-            'uhidno': 'unknown',
-            'examination_type': 'unknown',
-            'examined_area': 'unknown',
-            'device_model': 'unknown',
-            'imaging_findings': 'unknown',
-            'diagnosis_summary': 'unknown',
-            'comment': 'unknown'
-        } 
\ No newline at end of file
+        return {key: 'unknown' for key in keys} 
+
+
+class StreamingJSONExtractor:
+    """
+    Incrementally parse a JSON object arriving in chunks. Every top-level member is
+    decoded as soon as it is complete, so fields can be validated while the model
+    is still generating. Text before the opening brace is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = None
+        self.done = False
+
+    def feed(self, chunk):
+        """Consume a chunk of text and return the list of (key, value) members completed by it"""
+        members = []
+        self.buffer += chunk
+        while self.position < len(self.buffer) and not self.done:
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif self.depth == 0:
+                # Only an opening brace starts the object, brackets in the preamble are prose
+                if char == '{':
+                    self.depth = 1
+                    self.member_start = self.position + 1
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 1:
+                    members.extend(self._close_member())
+                    self.done = True
+                self.depth -= 1
+            elif char == ',' and self.depth == 1:
+                members.extend(self._close_member())
+                self.member_start = self.position + 1
+            self.position += 1
+        return members
+
+    def _close_member(self):
+        member = self.buffer[self.member_start:self.position].strip()
+        if not member:
+            return []
+        try:
+            return list(json.loads('{' + member + '}').items())
+        except json.JSONDecodeError as e:
+            logging.warning(f"Skipping malformed JSON member: {e}")
+            return []
+
+
+def validate_report_field(key, value):
+    """
+    Return the cleaned value for a structured report field, or None if it should be
+    treated as missing. Nested values are only accepted for free-text fields.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        return value if value and value.upper() != 'UNKNOWN' else None
+    if isinstance(value, (list, dict)):
+        if not value:
+            return None
+        return value if key in FREE_TEXT_KEYS else json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def generate_structured_report(text, on_field=None, keys=None):
+    """
+    Refine the text and extract the structured report in a single streamed generation.
+    text: Text obtained from OCR or speech recognition
+    on_field: optional callback(key, value) invoked as each validated field arrives
+    keys: report keys to ask for, default all of REPORT_KEYS
+    return: (enhanced_text, structured report dict)
+    """
+    keys = keys or REPORT_KEYS
+    data = {key: 'unknown' for key in keys}
+    enhanced_text = text
+    try:
+        key_list = '\n'.join(f'- {key}' for key in ['enhanced_text'] + keys)
+        prompt = f"""Below is the content of a medical report. Produce a single JSON object with exactly the following keys.
+
+"enhanced_text" must hold the refined report text: correct obvious grammar and spelling errors, use professional medical terminology, stay objective and preserve the original information without over-interpretation.
+The other keys form the structured report. If a field is not mentioned in the content, set its value to "UNKNOWN".
+
+Keys:
+{key_list}
+
+Content:
+{text}
+
+Output only a valid JSON object.
+"""
+        extractor = StreamingJSONExtractor()
+        stream = llm_client.generate(AI_MODEL, prompt, format='json', stream=True)
+        # Each streamed part is one token; the final part with Ollama's counts is
+        # usually not read because the loop stops when the object is closed
+        usage = {'eval_count': 0}
+        try:
+            for part in stream:
+                usage = part if part.get('done') else {'eval_count': usage.get('eval_count', 0) + 1}
+                for key, value in extractor.feed(part.get('response', '')):
+                    if key == 'enhanced_text':
+                        if isinstance(value, str) and value.strip():
+                            enhanced_text = value.strip()
+                        continue
+                    if key not in data:
+                        logging.warning(f"Ignoring unexpected report field: {key}")
+                        continue
+                    value = validate_report_field(key, value)
+                    if value is not None:
+                        data[key] = value
+                        if on_field:
+                            on_field(key, value)
+                # Stop reading as soon as the object is closed
+                if extractor.done:
+                    break
+        finally:
+            metrics.record_llm_usage('generate_structured_report', usage, AI_MODEL)
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+
+        if not extractor.done:
+            logging.error("Single-pass generation ended before the JSON object was complete")
+        return enhanced_text, data
+
+    except Exception as e:
+        logging.error(f"gemma3 single-pass report generation failed: {str(e)}")
+        return enhanced_text, data
@@ -1,25 +1,39 @@
-from flask import Flask, request, send_file, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, render_template, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
 import uuid
+import shutil
+import tempfile
+import multiprocessing
 from pathlib import Path
 import logging
+from logging.handlers import WatchedFileHandler
 from flask_cors import CORS
 from dotenv import load_dotenv
-from vosk import Model, KaldiRecognizer
-import wave
-
-# Import the three modules
-from text_processing import process_image, process_audio, process_text, process_pdf, process_docx
-from ai_processing import generate_report_with_ai, enhance_text_with_ai
-from report_generation import generate_report, download_report
 
 # -------------- 1. Get absolute path of project root directory --------------
 BASE_DIR = Path(__file__).parent.parent.absolute()
 
 # -------------- 2. Load environment variables (.env) --------------
+# Loaded before the local modules so their module-level settings see .env values
 load_dotenv(BASE_DIR / ".env")
 
+# Import the processing modules
+from pipeline import processors, get_extension, run_pipeline, update_report
+from upload_spool import SpoolingRequest, SpooledUpload, SPOOL_DIR
+from report_generation import download_report
+from pdf_conversion import check_converter
+from model_registry import warm_up, loaded_models
+from job_queue import submit_job, get_job, public_job, recover_jobs, queue_depth, QueueFullError, JOB_QUEUE_SIZE
+from dictation import sock
+from bulk_ingest import iter_bulk_results, iter_ndjson, unpack_archive, BULK_MAX_FILES
+from template_engine import get_template, available_templates, load_templates, TemplateNotFoundError, DEFAULT_TEMPLATE
+from result_cache import cache_stats
+from llm_client import endpoint_status
+from report_store import query_reports, stored_bytes, get_version, list_versions, ReportNotFoundError, VersionConflictError
+from static_assets import asset_url, send_asset, ASSETS_URL
+import metrics
+
 # -------------- 3. Configure Flask's static and template directories --------------
 app = Flask(
     __name__,
@@ -27,37 +41,86 @@ app = Flask(
     template_folder=str(BASE_DIR / 'template')
 )
 CORS(app)
+# Spool uploads in memory up to SPOOL_MAX_MEMORY_MB, larger ones to unique per-request temp files
+app.request_class = SpoolingRequest
+# WebSocket routes (real-time dictation)
+sock.init_app(app)
+# Pages link static files with {{ asset_url('css/styles.css') }}, fingerprinted once static_assets.py has built them
+app.jinja_env.globals['asset_url'] = asset_url
 
 # -------------- 4. Configuration parameters: upload directory etc. --------------
 UPLOAD_FOLDER = 'uploads'  # Note this is a relative path, will create/use uploads/ under TESTGEN/
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # -------------- 5. Configure logging --------------
+# LOG_LEVEL=DEBUG also logs sampled payloads (see PAYLOAD_LOG_SAMPLE_RATE)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=LOG_LEVEL,
     format='%(asctime)s %(levelname)s %(message)s',
     handlers=[
-        logging.FileHandler('app.log'),   # Log to file
+        # Log to file; every gunicorn worker appends to it, so rotation is left to logrotate
+        # and the file is reopened once it has been moved away
+        WatchedFileHandler('app.log'),
         logging.StreamHandler()           # Log to console
     ]
 )
 
+# -------------- 6. Load speech models and report templates once per worker process --------------
+# With preload_app (gunicorn.conf.py) this runs once in the gunicorn master and the workers share the result.
+# Spawned pool workers re-import this module as __mp_main__ (python app2.py) and must not load anything
+if multiprocessing.parent_process() is None:
+    warm_up()
+    load_templates()
+    check_converter()
+
+# -------------- 7. Values owned by other modules, read on every /metrics scrape --------------
+metrics.register_collector('job_queue_depth', 'Jobs waiting for a worker', queue_depth, summed=True)
+metrics.register_collector('job_queue_capacity', 'Jobs allowed to wait for a worker', lambda: JOB_QUEUE_SIZE, summed=True)
+metrics.register_collector(
+    'cache_requests_total', 'Result cache lookups per tier and outcome',
+    lambda: {
+        (('tier', tier), ('result', outcome)): count
+        for tier, counts in cache_stats().items() for outcome, count in counts.items()
+    },
+    kind='counter', summed=True
+)
+metrics.register_collector(
+    'llm_endpoint_healthy', 'Whether an Ollama endpoint answered its last request or health check',
+    lambda: {(('endpoint', e['url']),): int(e['healthy']) for e in endpoint_status()}
+)
+metrics.register_collector(
+    'llm_in_flight', 'Generations in flight or waiting per Ollama endpoint',
+    lambda: {(('endpoint', e['url']),): e['in_flight'] for e in endpoint_status()},
+    summed=True
+)
+metrics.register_collector('report_store_bytes', 'Disk usage of the distinct stored report artifacts', stored_bytes)
+metrics.register_collector(
+    'speech_model_bytes', 'Resident speech models',
+    lambda: {(('model', ':'.join(key)),): size for key, size in loaded_models()}
+)
+
 # -------------------- Route definitions --------------------
 
 # -------------- Homepage: Return template/index.html --------------
 @app.route('/')
 def index():
-    return send_from_directory(app.template_folder, 'index.html')
+    return render_template('index.html')
 
 # -------------- Text upload page: Return text-upload.html --------------
 @app.route('/text-upload')
 def text_upload():
-    return send_from_directory(app.template_folder, 'text-upload.html')
+    return render_template('text-upload.html')
 
 # -------------- Audio upload page: Return audio-upload.html --------------
 @app.route('/audio-upload')
 def audio_upload():
-    return send_from_directory(app.template_folder, 'audio-upload.html')
+    return render_template('audio-upload.html')
+
+# -------------- Fingerprinted static files, see static_assets.py --------------
+@app.route(f'{ASSETS_URL}/<path:filename>')
+def assets(filename):
+    return send_asset(filename)
 
 # -------------------- File upload processing and report generation --------------------
 
@@ -67,6 +130,8 @@ def process_file():
     Process uploaded file, perform OCR / speech recognition / text reading / PDF extraction based on file type,
     then call AI to generate structured report, finally generate report files (both DOCX and PDF formats),
     and return JSON response containing download links.
+    With mode=async (form field or query string) the file is queued instead and a job ID is returned
+    immediately; progress and result are available from /jobs/<job_id>.
     """
     try:
         # 1. Check if file is uploaded
@@ -77,55 +142,218 @@ def process_file():
         if file.filename == '':
             return jsonify({'error': 'Invalid file'}), 400
 
-        # 2. Save uploaded file to TESTGEN/uploads/
+        # 2. Check that a processor exists for the file extension
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # 3. Select processor based on file extension
-        ext = filename.split('.')[-1].lower()
-        processors = {
-            'jpg': process_image,
-            'jpeg': process_image,
-            'png': process_image,
-            'wav': process_audio,
-            'mp3': process_audio,
-            'pdf': process_pdf,
-            'docx': process_docx,
-            'txt': process_text
-        }
-        
-        if ext not in processors:
+        if get_extension(filename) not in processors:
             return jsonify({'error': 'Unsupported file type'}), 400
-        
-        text = processors[ext](filepath)
-        
-        # 4. Call Llama2 AI to generate structured report data
-        structured_data = generate_report_with_ai(enhance_text_with_ai(text))
-        print("Structured data from AI:", structured_data)
-        if not structured_data:
-            return jsonify({'error': 'AI report generation failed'}), 500
-        
-        # 5. Generate report files and store in TESTGEN/reports/
-        report_id = str(uuid.uuid4())
-        os.makedirs('reports', exist_ok=True)
-        # Generate both DOCX and PDF versions
-        original_filename = secure_filename(file.filename)
-        docx_path = generate_report(structured_data, 'docx', report_id, original_filename)
-        pdf_path = generate_report(structured_data, 'pdf', report_id, original_filename)
-        
-        # 6. Return report ID, download links for both formats and generated structured data
-        return jsonify({
-            'reportId': report_id,
-            'downloadUrl_docx': f'/download/{report_id}?format=docx',
-            'downloadUrl_pdf': f'/download/{report_id}?format=pdf',
-            'data': structured_data
-        }), 200
+
+        # Whisper detects the language of recordings sent without one
+        language = request.form.get('language') or None
+        mode = request.form.get('mode') or request.args.get('mode', 'sync')
+        # "two_pass" or "single_pass" LLM structuring, server default when omitted
+        ai_mode = request.form.get('ai_mode')
+        # Report template (e.g. per exam type), see /templates
+        template_name = request.form.get('template') or None
+        try:
+            get_template(template_name)
+        except TemplateNotFoundError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # 3. Async mode: save under a unique name and hand over to the job queue
+        if mode == 'async':
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'{uuid.uuid4().hex}_{filename}')
+            with metrics.timed('upload_save', get_extension(filename)):
+                file.save(filepath)
+            try:
+                job = submit_job(filepath, filename, language, ai_mode, template_name)
+            except QueueFullError as e:
+                os.remove(filepath)
+                return jsonify({'error': str(e)}), 429, {'Retry-After': '5'}
+            return jsonify(public_job(job)), 202
+
+        # 4. Hand the spooled upload (memory, or a per-request temp file) straight to the processors
+        # 5. Extract text, call AI and generate both DOCX and PDF reports, then return
+        #    report ID, download links for both formats and generated structured data
+        with metrics.timed('upload_save', get_extension(filename)):
+            upload = SpooledUpload.from_file_storage(file, filename)
+        with upload:
+            result = run_pipeline(upload, filename, language, ai_mode=ai_mode, template_name=template_name)
+        return jsonify(result), 200
         
     except Exception as e:
         logging.error(f"Processing failed: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/bulk', methods=['POST'])
+def bulk_process():
+    """
+    Process many files in one request: a zip archive in 'archive' and/or several files in 'files'.
+    Extraction runs in parallel and one JSON object per file is streamed back as NDJSON
+    as soon as its report is ready.
+    """
+    work_dir = tempfile.mkdtemp(prefix='bulk-', dir=SPOOL_DIR)
+    try:
+        template_name = request.form.get('template') or None
+        try:
+            get_template(template_name)
+        except TemplateNotFoundError as e:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 400
+
+        items = []
+        for index, file in enumerate(request.files.getlist('files')):
+            filename = secure_filename(file.filename or '')
+            if not filename:
+                continue
+            filepath = os.path.join(work_dir, f'{index:05d}_{filename}')
+            file.save(filepath)
+            items.append((filename, filepath))
+        archive = request.files.get('archive')
+        if archive and archive.filename:
+            archive_path = os.path.join(work_dir, 'archive.zip')
+            archive.save(archive_path)
+            items.extend(unpack_archive(archive_path, work_dir))
+
+        if not items:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': 'No file uploaded'}), 400
+        if len(items) > BULK_MAX_FILES:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return jsonify({'error': f'At most {BULK_MAX_FILES} files per request'}), 400
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        logging.error(f"Bulk upload failed: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+    language = request.form.get('language') or None
+    ai_mode = request.form.get('ai_mode')
+
+    def generate():
+        try:
+            yield from iter_ndjson(iter_bulk_results(items, language, ai_mode, template_name))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Return status and current pipeline stage of a job submitted with mode=async
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job does not exist'}), 404
+    return jsonify(public_job(job)), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    Return the same payload as synchronous /process once the job has finished
+    """
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job does not exist'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error']}), 500
+    if job['status'] != 'finished':
+        return jsonify(public_job(job)), 202
+    return jsonify(job['result']), 200
+
+@app.route('/templates', methods=['GET'])
+def list_templates():
+    """
+    List the report templates that can be selected with the 'template' field of /process
+    """
+    templates = []
+    for name in available_templates():
+        try:
+            placeholders = sorted(get_template(name).placeholders)
+        except Exception as e:
+            logging.error(f"Failed to load template {name}: {str(e)}")
+            continue
+        templates.append({'name': name, 'default': name == DEFAULT_TEMPLATE, 'placeholders': placeholders})
+    return jsonify({'templates': templates}), 200
+
+@app.route('/reports', methods=['GET'])
+def list_reports():
+    """
+    Find stored reports by patient (uhidno), examination date range (from / to, YYYY-MM-DD)
+    or upload content hash (source); paged with limit / offset
+    """
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    reports = query_reports(
+        uhidno=request.args.get('uhidno'),
+        date_from=request.args.get('from'),
+        date_to=request.args.get('to'),
+        source_hash=request.args.get('source'),
+        limit=limit,
+        offset=offset
+    )
+    return jsonify({'reports': reports}), 200
+
+@app.route('/reports/<report_id>', methods=['PATCH'])
+def patch_report(report_id):
+    """
+    Correct fields of a generated report without processing the upload again, e.g.
+    {"fields": {"patient_name": "Jane Doe"}, "version": 1}. The data is merged into the
+    stored report, the DOCX / PDF are rendered again and a new version is recorded.
+    version (optional): the version the correction was made on, 409 if the report changed since
+    template (optional): render with another template
+    """
+    body = request.get_json(silent=True) or {}
+    fields = body.get('fields')
+    if not isinstance(fields, dict) or not fields:
+        return jsonify({'error': 'Expected a JSON object with the changed fields in "fields"'}), 400
+    version = body.get('version')
+    if version is not None and not isinstance(version, int):
+        return jsonify({'error': 'version must be an integer'}), 400
+    try:
+        result = update_report(report_id, fields, version, body.get('template') or None)
+    except ReportNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except VersionConflictError as e:
+        return jsonify({'error': str(e)}), 409
+    except (ValueError, TemplateNotFoundError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Report update failed: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify(result), 200
+
+@app.route('/reports/<report_id>/versions', methods=['GET'])
+def report_versions(report_id):
+    """
+    History of a report: version number, changed fields (null for generated data) and time of every version
+    """
+    versions = list_versions(report_id)
+    if not versions:
+        return jsonify({'error': 'Report does not exist'}), 404
+    return jsonify({'reportId': report_id, 'versions': versions}), 200
+
+@app.route('/reports/<report_id>/versions/<int:version>', methods=['GET'])
+def report_version(report_id, version):
+    """
+    Structured data of one version of a report
+    """
+    stored = get_version(report_id, version)
+    if stored is None:
+        return jsonify({'error': 'Report version does not exist'}), 404
+    return jsonify({'reportId': report_id, **stored}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    Stage latencies, queue depth, cache hit rates and LLM token counts of this worker process
+    in the Prometheus text format
+    """
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/download/<report_id>', methods=['GET'])
 def download_report_route(report_id):
     """
@@ -157,9 +385,14 @@ if __name__ == '__main__':
             logging.critical(f"Critical file missing: {file_path}")
             exit(1)
     
-    # 2. Create necessary directories: uploads/ and reports/
+    # 2. Create necessary directories: uploads/, reports/ and jobs/
     Path('uploads').mkdir(exist_ok=True)
     Path('reports').mkdir(exist_ok=True)
+    (BASE_DIR / 'jobs').mkdir(exist_ok=True)
     
-    # 3. Start Flask server, listen on 0.0.0.0:5000
+    # 3. Take over the jobs a previous run left unfinished, in the serving (reloader child) process
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        recover_jobs()
+
+    # 4. Start Flask server, listen on 0.0.0.0:5000
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
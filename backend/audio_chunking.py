@@ -0,0 +1,173 @@
+import os
+import json
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from model_registry import get_whisper_model, get_vosk_model, normalize_language, VOSK_MODELS
+
+# Recordings longer than this are split at silences and transcribed in parallel
+LONG_AUDIO_SECONDS = float(os.getenv('LONG_AUDIO_SECONDS', '120'))
+# "whisper", or "vosk" for the cheap bundled models (languages without one use Whisper)
+LONG_AUDIO_ENGINE = os.getenv('LONG_AUDIO_ENGINE', 'whisper')
+# Worker processes for chunk transcription; each one holds its own model
+AUDIO_CHUNK_PROCESSES = int(os.getenv('AUDIO_CHUNK_PROCESSES', '2'))
+# Chunks are cut at the silence closest to this length and never exceed the maximum
+CHUNK_TARGET_SECONDS = float(os.getenv('CHUNK_TARGET_SECONDS', '30'))
+CHUNK_MAX_SECONDS = float(os.getenv('CHUNK_MAX_SECONDS', '45'))
+# A pause at least this long is a candidate cut point
+MIN_SILENCE_MS = int(os.getenv('MIN_SILENCE_MS', '400'))
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+FRAME_BYTES = SAMPLE_RATE * 2 * FRAME_MS // 1000
+
+
+def _speech_flags(pcm):
+    """Speech / non-speech decision for every 30 ms frame of 16 kHz 16-bit mono PCM"""
+    frame_count = len(pcm) // FRAME_BYTES
+    try:
+        import webrtcvad
+        vad = webrtcvad.Vad(2)
+        return [vad.is_speech(pcm[i * FRAME_BYTES:(i + 1) * FRAME_BYTES], SAMPLE_RATE) for i in range(frame_count)]
+    except ImportError:
+        # Energy based fallback: frames well below the recording's typical loudness are silence
+        import numpy as np
+        samples = np.frombuffer(pcm[:frame_count * FRAME_BYTES], dtype=np.int16).astype(np.float32)
+        if not frame_count:
+            return []
+        rms = np.sqrt(np.mean(samples.reshape(frame_count, -1) ** 2, axis=1)) + 1e-6
+        threshold = np.percentile(rms, 90) * 0.1
+        return list(rms > threshold)
+
+
+def split_at_silences(pcm):
+    """
+    Return (start, end) byte offsets of chunks of PCM, cut in the middle of pauses so no
+    word is split, close to CHUNK_TARGET_SECONDS and never longer than CHUNK_MAX_SECONDS
+    """
+    flags = _speech_flags(pcm)
+    min_silence_frames = max(1, MIN_SILENCE_MS // FRAME_MS)
+
+    # Middle frame of every pause that is long enough
+    cut_frames = []
+    run_start = None
+    for index, speech in enumerate(flags + [True]):
+        if not speech and run_start is None:
+            run_start = index
+        elif speech and run_start is not None:
+            if index - run_start >= min_silence_frames:
+                cut_frames.append((run_start + index) // 2)
+            run_start = None
+
+    target = int(CHUNK_TARGET_SECONDS * 1000 / FRAME_MS)
+    maximum = int(CHUNK_MAX_SECONDS * 1000 / FRAME_MS)
+    total = len(flags)
+    chunks = []
+    start = 0
+    while total - start > maximum:
+        candidates = [f for f in cut_frames if start < f <= start + maximum]
+        # Closest pause to the target length, or a hard cut when nobody pauses
+        end = min(candidates, key=lambda f: abs(f - start - target)) if candidates else start + maximum
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, total))
+    return [(s * FRAME_BYTES, len(pcm) if e == total else e * FRAME_BYTES) for s, e in chunks]
+
+
+def _init_worker():
+    # Share the CPU between worker processes instead of every one using all cores
+    try:
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // AUDIO_CHUNK_PROCESSES))
+    except ImportError:
+        pass
+
+
+def transcribe_chunk(engine, language, pcm, offset_seconds):
+    """
+    Transcribe one chunk
+    return: (segments with timestamps relative to the whole recording, language of the chunk)
+    """
+    duration = len(pcm) / (SAMPLE_RATE * 2)
+    if engine == 'vosk':
+        from vosk import KaldiRecognizer
+        recognizer = KaldiRecognizer(get_vosk_model(language), SAMPLE_RATE)
+        for i in range(0, len(pcm), 8000):
+            recognizer.AcceptWaveform(pcm[i:i + 8000])
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        return [{'start': offset_seconds, 'end': offset_seconds + duration, 'text': text.strip()}], language
+
+    import numpy as np
+    model = get_whisper_model(language=language)
+    waveform = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    result = model.transcribe(waveform, language=language, condition_on_previous_text=False)
+    segments = [
+        {
+            'start': offset_seconds + segment['start'],
+            'end': offset_seconds + min(segment['end'], duration),
+            'text': segment['text'].strip()
+        }
+        for segment in result['segments'] if segment['text'].strip()
+    ]
+    return segments, result.get('language', language)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: torch and model state must not be forked from a threaded server process
+            _pool = ProcessPoolExecutor(
+                max_workers=AUDIO_CHUNK_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return _pool
+
+
+def transcribe_long_audio(audio, language=None, engine=None, on_partial=None):
+    """
+    Split a 16 kHz mono 16-bit AudioSegment at silences, transcribe the chunks in parallel
+    worker processes and stitch the segments back in order.
+    on_partial: optional callback receiving the transcript of all leading chunks finished so far,
+                e.g. to show progress in the job status
+    language: None to let Whisper detect it on the first chunk and use it for all others
+    return: {'text': full transcript, 'segments': [{'start', 'end', 'text'}, ...]}
+    """
+    engine = engine or LONG_AUDIO_ENGINE
+    language = normalize_language(language) if language else None
+    if engine == 'vosk' and language not in VOSK_MODELS:
+        # Vosk cannot detect the language, and only the bundled languages have a model
+        logging.info(f"No Vosk model for language {language or 'auto'}, transcribing with Whisper")
+        engine = 'whisper'
+    pcm = audio.raw_data
+    chunks = split_at_silences(pcm)
+    logging.info(f"Transcribing {audio.duration_seconds:.0f}s of audio in {len(chunks)} chunks with {engine}")
+
+    pool = _get_pool()
+    futures = []
+    if language is None and chunks:
+        start, end = chunks[0]
+        first = pool.submit(transcribe_chunk, engine, None, pcm[start:end], 0.0)
+        # Chunks detected one by one could disagree, the first one decides for the recording
+        language = first.result()[1]
+        futures.append(first)
+        chunks = chunks[1:]
+    futures.extend(
+        pool.submit(transcribe_chunk, engine, language, pcm[start:end], start / (SAMPLE_RATE * 2))
+        for start, end in chunks
+    )
+
+    # Collect in order, so every partial transcript is a coherent prefix of the recording
+    segments = []
+    for future in futures:
+        segments.extend(future.result()[0])
+        if on_partial:
+            on_partial(' '.join(segment['text'] for segment in segments))
+    return {'text': ' '.join(segment['text'] for segment in segments), 'segments': segments}
@@ -0,0 +1,395 @@
+"""
+Benchmark of the report pipeline, offline and repeatable.
+
+A synthetic corpus (txt, docx, pdf, png, wav) or a folder of real samples is replayed
+through every processor, every AI function and the full run_pipeline, against the
+fake Ollama server in fake_ollama.py (or a real one with --ollama-host). Per-stage
+p50/p95/p99 latency, requests/sec at each client count and peak RSS are printed and
+stored under TESTGEN/benchmarks/, named after the time and git commit, so runs can be
+compared across commits.
+
+Command line usage (from the backend/ directory):
+    python benchmark.py --clients 1,4,8 --requests 40 --latency-ms 300 --token-ms 5
+    python benchmark.py --corpus samples/ --compare latest
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+RESULTS_DIR = BASE_DIR / 'benchmarks'
+
+# Load .env first, the pipeline modules are imported later once the Ollama host is known
+load_dotenv(BASE_DIR / ".env")
+
+SAMPLE_REPORT = """Patient Name: Jane Doe    Age: 45    Sex: F
+UHID No: UH123456    Ref By: Dr. Smith    Date: 15/01/2024
+Examination: Ultrasound Abdomen    Device: Voluson E8
+Liver is normal in size and echotexture, no focal lesion seen. Gall bladder is well distended,
+no calculi. Common bile duct is not dilated. Pancreas and spleen appear normal.
+Both kidneys are normal in size with maintained corticomedullary differentiation.
+Impression: Normal study."""
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 2) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 2) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 2) if samples else None,
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 2) if samples else None
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its finished / pooled child processes"""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor
+    return round(own, 1), round(children, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# -------------- Corpus
+
+def _write_wav(path, seconds=8):
+    """16 kHz mono speech-like bursts separated by pauses"""
+    import math
+    import wave
+    import struct
+    frames = bytearray()
+    for i in range(16000 * seconds):
+        t = i / 16000
+        voiced = int(t * 2) % 3 != 2
+        sample = 0.3 * math.sin(2 * math.pi * 180 * t) * math.sin(2 * math.pi * 3 * t) if voiced else 0.0
+        frames += struct.pack('<h', int(sample * 32767))
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(bytes(frames))
+
+
+def _write_png(path):
+    from PIL import Image, ImageDraw
+    image = Image.new('RGB', (1024, 768), 'black')
+    draw = ImageDraw.Draw(image)
+    for index, line in enumerate(SAMPLE_REPORT.splitlines()[:3]):
+        draw.text((20, 20 + index * 24), line, fill='white')
+    # Stand-in for the ultrasound sector
+    draw.pieslice((212, 120, 812, 720), 240, 300, fill=(90, 90, 90))
+    image.save(path, dpi=(96, 96))
+
+
+def _write_docx(path):
+    from docx import Document
+    document = Document()
+    for line in SAMPLE_REPORT.splitlines():
+        document.add_paragraph(line)
+    document.save(path)
+
+
+def _write_pdf(path, pages=5):
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_font('helvetica', size=11)
+    for _ in range(pages):
+        pdf.add_page()
+        for line in SAMPLE_REPORT.splitlines():
+            pdf.multi_cell(0, 6, line, new_x='LMARGIN', new_y='NEXT')
+    pdf.output(str(path))
+
+
+def generate_corpus(directory):
+    """Write one sample of every supported input type and return their paths"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / 'report.txt').write_text(SAMPLE_REPORT, encoding='utf-8')
+    writers = {'report.docx': _write_docx, 'report.pdf': _write_pdf, 'scan.png': _write_png, 'dictation.wav': _write_wav}
+    for name, writer in writers.items():
+        try:
+            writer(directory / name)
+        except ImportError as e:
+            logging.warning(f"Skipping {name} in the benchmark corpus: {str(e)}")
+    return sorted(p for p in directory.iterdir() if p.is_file())
+
+
+# -------------- Measurements
+
+class StageTimer:
+    """Collect durations per stage name, thread-safe"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def error(self, stage):
+        with self._lock:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def measure(self, stage, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Benchmark stage {stage} failed: {str(e)}")
+            self.error(stage)
+            return None
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def summary(self):
+        stages = sorted(set(self.samples) | set(self.errors))
+        return {stage: {**summarize(self.samples.get(stage, [])), 'errors': self.errors.get(stage, 0)} for stage in stages}
+
+
+def bench_components(paths, iterations, timer):
+    """Time every processor, AI function and the DOCX rendering on their own"""
+    from pipeline import processors, get_extension, _extract_text
+    from ai_processing import enhance_text_with_ai, generate_report_with_ai, generate_structured_report
+    from report_generation import render_docx, report_paths
+
+    texts = []
+    for path in paths:
+        ext = get_extension(path.name)
+        if ext not in processors:
+            continue
+        for _ in range(iterations):
+            # Uncached, straight through the processor
+            text = timer.measure(f'processor.{ext}', _extract_text, str(path), ext, 'en')
+        if text:
+            texts.append(text)
+    texts = texts or [SAMPLE_REPORT]
+
+    data = None
+    for _ in range(iterations):
+        for text in texts:
+            timer.measure('ai.enhance_text_with_ai', enhance_text_with_ai, text)
+            data = timer.measure('ai.generate_report_with_ai', generate_report_with_ai, text) or data
+            timer.measure('ai.generate_structured_report', generate_structured_report, text)
+
+    for _ in range(iterations):
+        report_id = f'bench-{uuid.uuid4()}'
+        timer.measure('render.render_docx', render_docx, dict(data or {}), report_id)
+        for path in report_paths(report_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def bench_pipeline(paths, clients, requests, ai_mode=None):
+    """
+    Replay the corpus through run_pipeline from `clients` concurrent threads.
+    return: (stage timer, requests per second)
+    """
+    import report_store
+    from pipeline import run_pipeline
+    from report_generation import report_paths
+
+    timer = StageTimer()
+
+    def one_request(index):
+        path = paths[index % len(paths)]
+        report_id = f'bench-{uuid.uuid4()}'
+        current = {'stage': None, 'started': time.perf_counter()}
+
+        def on_stage(stage):
+            now = time.perf_counter()
+            if current['stage']:
+                timer.add(f"pipeline.{current['stage']}", now - current['started'])
+            current.update(stage=stage, started=now)
+
+        started = time.perf_counter()
+        try:
+            run_pipeline(str(path), path.name, report_id=report_id, on_stage=on_stage, ai_mode=ai_mode)
+            now = time.perf_counter()
+            timer.add(f"pipeline.{current['stage']}", now - current['started'])
+            timer.add('pipeline.total', now - started)
+        except Exception as e:
+            logging.error(f"Benchmark request for {path.name} failed: {str(e)}")
+            timer.error('pipeline.total')
+        finally:
+            # Stored rows and blobs too, not only the report files
+            report_store.delete_report(report_id)
+            for report_path in report_paths(report_id):
+                if os.path.exists(report_path):
+                    os.remove(report_path)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - started
+    return timer, round(requests / elapsed, 3)
+
+
+# -------------- Results
+
+def save_results(results, directory=RESULTS_DIR):
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json"
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def load_previous(spec, exclude=None, directory=RESULTS_DIR):
+    """Load a stored run: a file path, or "latest" for the most recent one"""
+    if spec != 'latest':
+        with open(spec, encoding='utf-8') as f:
+            return json.load(f)
+    runs = sorted(p for p in directory.glob('*.json') if p != exclude)
+    if not runs:
+        return None
+    with open(runs[-1], encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _change(new, old):
+    if new is None or not old:
+        return ''
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def print_report(results, previous=None, out=sys.stdout):
+    out.write(f"Benchmark {results['commit']} ({results['timestamp']})\n\n")
+    out.write(f"{'stage':<36}{'n':>6}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'err':>5}{'p50 vs prev':>13}\n")
+    previous_stages = (previous or {}).get('stages', {})
+    for stage, stats in results['stages'].items():
+        old = previous_stages.get(stage, {})
+        out.write(
+            f"{stage:<36}{stats['count']:>6}{stats['p50_ms'] or 0:>11.1f}{stats['p95_ms'] or 0:>11.1f}"
+            f"{stats['p99_ms'] or 0:>11.1f}{stats['errors']:>5}{_change(stats['p50_ms'], old.get('p50_ms')):>13}\n"
+        )
+    out.write('\n')
+    previous_throughput = (previous or {}).get('throughput', {})
+    for clients, stats in results['throughput'].items():
+        old = previous_throughput.get(clients, {})
+        out.write(
+            f"{clients:>3} clients: {stats['requests_per_second']:>8.2f} req/s, "
+            f"p95 {stats['p95_ms'] or 0:.1f} ms {_change(stats['requests_per_second'], old.get('requests_per_second'))}\n"
+        )
+    out.write(f"\nPeak RSS: {results['peak_rss_mb']['self']} MB (children {results['peak_rss_mb']['children']} MB)\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline offline')
+    parser.add_argument('--corpus', help='folder of sample inputs (default: generate a synthetic corpus)')
+    parser.add_argument('--clients', default='1,4', help='comma separated concurrent client counts')
+    parser.add_argument('--requests', type=int, default=20, help='pipeline requests per client count')
+    parser.add_argument('--iterations', type=int, default=3, help='repetitions of the component benchmarks')
+    parser.add_argument('--ai-mode', choices=['two_pass', 'single_pass'], default=None)
+    parser.add_argument('--ollama-host', help='benchmark against this Ollama instead of the fake server')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='fake Ollama delay before the first token')
+    parser.add_argument('--token-ms', type=float, default=0.0, help='fake Ollama delay per token')
+    parser.add_argument('--cache', action='store_true', help='keep the result cache enabled (warm runs)')
+    parser.add_argument('--skip-components', action='store_true')
+    parser.add_argument('--compare', help='stored run to compare with: a result file or "latest"')
+    parser.add_argument('--no-save', action='store_true', help='do not store the results')
+    args = parser.parse_args(argv)
+
+    # Must be set before the pipeline modules (and the ollama client) are imported. llm_client reads
+    # OLLAMA_HOSTS first, so a value from .env would otherwise send the run to the real servers
+    if args.ollama_host:
+        url = args.ollama_host
+    else:
+        from fake_ollama import start_in_background
+        _, url = start_in_background(args.latency_ms, args.token_ms)
+    os.environ['OLLAMA_HOSTS'] = url
+    os.environ['OLLAMA_HOST'] = url
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    if args.cache:
+        os.environ['CACHE_DIR'] = os.path.join(work_dir, 'cache')
+    else:
+        os.environ['CACHE_ENABLED'] = '0'
+
+    previous = load_previous(args.compare) if args.compare else None
+    try:
+        if args.corpus:
+            paths = sorted(p for p in Path(args.corpus).iterdir() if p.is_file())
+        else:
+            paths = generate_corpus(os.path.join(work_dir, 'corpus'))
+        (BASE_DIR / 'reports').mkdir(exist_ok=True)
+
+        timer = StageTimer()
+        if not args.skip_components:
+            bench_components(paths, args.iterations, timer)
+
+        throughput = {}
+        for clients in (int(c) for c in args.clients.split(',') if c.strip()):
+            level_timer, requests_per_second = bench_pipeline(paths, clients, args.requests, args.ai_mode)
+            for stage, samples in level_timer.samples.items():
+                for sample in samples:
+                    timer.add(stage, sample)
+            for stage, count in level_timer.errors.items():
+                timer.errors[stage] = timer.errors.get(stage, 0) + count
+            throughput[str(clients)] = {
+                'requests_per_second': requests_per_second,
+                **summarize(level_timer.samples.get('pipeline.total', []))
+            }
+
+        own, children = peak_rss_mb()
+        results = {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'settings': {
+                'corpus': [p.name for p in paths],
+                'requests': args.requests,
+                'iterations': args.iterations,
+                'ai_mode': args.ai_mode,
+                'ollama': args.ollama_host or f'fake ({args.latency_ms} ms + {args.token_ms} ms/token)',
+                'cache': args.cache
+            },
+            'stages': timer.summary(),
+            'throughput': throughput,
+            'peak_rss_mb': {'self': own, 'children': children}
+        }
+        if not args.no_save:
+            path = save_results(results)
+        print_report(results, previous)
+        if not args.no_save:
+            print(f"Results stored in {path}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    main()
@@ -0,0 +1,212 @@
+"""
+Bulk ingestion of many studies at once, e.g. to backfill old reports.
+
+Text extraction runs in parallel (OCR and PDF parsing in a process pool across CPU
+cores), LLM structuring runs in concurrent batches against Ollama, and one NDJSON
+record is produced per file as soon as it is finished.
+
+Command line usage (from the backend/ directory):
+    python bulk_ingest.py scans/ archive.zip notes.txt --output results.jsonl
+"""
+import os
+import sys
+import json
+import uuid
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from werkzeug.utils import secure_filename
+from dotenv import load_dotenv
+
+# Load .env before the local modules so their settings see it when run from the command line
+load_dotenv(Path(__file__).parent.parent.absolute() / ".env")
+
+from pipeline import processors, get_extension, extract_text, build_report, source_digest
+from text_processing import process_image, process_pdf
+
+# Worker processes for OCR / PDF extraction and concurrent LLM requests per batch
+BULK_EXTRACT_PROCESSES = int(os.getenv('BULK_EXTRACT_PROCESSES', str(os.cpu_count() or 2)))
+BULK_LLM_CONCURRENCY = int(os.getenv('BULK_LLM_CONCURRENCY', '4'))
+# Largest number of files accepted from one archive
+BULK_MAX_FILES = int(os.getenv('BULK_MAX_FILES', '1000'))
+# Largest uncompressed size of one archive entry and of all entries together, against zip bombs
+BULK_MAX_ENTRY_MB = int(os.getenv('BULK_MAX_ENTRY_MB', '200'))
+BULK_MAX_UNPACKED_MB = int(os.getenv('BULK_MAX_UNPACKED_MB', '2048'))
+
+# CPU bound extractors that benefit from separate processes
+CPU_BOUND_PROCESSORS = (process_image, process_pdf)
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+
+def _get_cpu_pool():
+    """Process pool shared by all bulk requests, started on first use"""
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            # spawn: worker processes must not be forked from a threaded server process
+            _cpu_pool = ProcessPoolExecutor(
+                max_workers=BULK_EXTRACT_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _cpu_pool
+
+
+def _copy_limited(src, dst, limit, error):
+    """Copy at most limit bytes, raise ValueError(error) beyond; the sizes in the zip directory are not trusted"""
+    written = 0
+    while True:
+        block = src.read(1024 * 1024)
+        if not block:
+            return written
+        written += len(block)
+        if written > limit:
+            raise ValueError(error)
+        dst.write(block)
+
+
+def unpack_archive(archive_path, target_dir):
+    """
+    Extract the supported files of a zip archive into target_dir and return
+    (original filename, path) pairs. Folder structure inside the archive is flattened.
+    Raises ValueError when the archive has too many files or unpacks to more than
+    BULK_MAX_ENTRY_MB per file or BULK_MAX_UNPACKED_MB in total.
+    """
+    items = []
+    entry_limit = BULK_MAX_ENTRY_MB * 1024 * 1024
+    remaining = BULK_MAX_UNPACKED_MB * 1024 * 1024
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            filename = secure_filename(os.path.basename(info.filename))
+            if not filename or filename.startswith('.'):
+                continue
+            if len(items) >= BULK_MAX_FILES:
+                raise ValueError(f'Archive contains more than {BULK_MAX_FILES} files')
+            if info.file_size > entry_limit:
+                raise ValueError(f'Archive entry {filename} is larger than {BULK_MAX_ENTRY_MB} MB')
+            if info.file_size > remaining:
+                raise ValueError(f'Archive unpacks to more than {BULK_MAX_UNPACKED_MB} MB')
+            path = os.path.join(target_dir, f'{len(items):05d}_{filename}')
+            error = (f'Archive entry {filename} is larger than {BULK_MAX_ENTRY_MB} MB' if entry_limit <= remaining
+                     else f'Archive unpacks to more than {BULK_MAX_UNPACKED_MB} MB')
+            with archive.open(info) as src, open(path, 'wb') as dst:
+                remaining -= _copy_limited(src, dst, min(entry_limit, remaining), error)
+            items.append((filename, path))
+    return items
+
+
+def collect_paths(paths, target_dir):
+    """Expand files, folders (recursively) and zip archives into (filename, path) pairs"""
+    items = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            items.extend((p.name, str(p)) for p in sorted(path.rglob('*')) if p.is_file())
+        elif path.suffix.lower() == '.zip':
+            archive_dir = tempfile.mkdtemp(dir=target_dir)
+            items.extend(unpack_archive(path, archive_dir))
+        else:
+            items.append((path.name, str(path)))
+    return items
+
+
+def _record(batch_id, index, filename, result=None, error=None):
+    """One output line, in the request_id / title / body record format plus report ID and error"""
+    return {
+        'request_id': f'{batch_id}-{index + 1:04d}',
+        'title': filename,
+        'body': result['data'] if result else None,
+        'reportId': result['reportId'] if result else None,
+        'downloadUrl_docx': result['downloadUrl_docx'] if result else None,
+        'downloadUrl_pdf': result['downloadUrl_pdf'] if result else None,
+        'error': error
+    }
+
+
+def iter_bulk_results(items, language=None, ai_mode=None, template_name=None, batch_id=None):
+    """
+    Process (original filename, path) pairs and yield one record per file in completion order
+    """
+    batch_id = batch_id or uuid.uuid4().hex[:8]
+    cpu_pool = _get_cpu_pool()
+    # future -> (stage, index, filename)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=1) as io_pool, \
+            ThreadPoolExecutor(max_workers=BULK_LLM_CONCURRENCY) as llm_pool:
+        try:
+            for index, (filename, path) in enumerate(items):
+                ext = get_extension(filename)
+                if ext not in processors:
+                    yield _record(batch_id, index, filename, error='Unsupported file type')
+                    continue
+                # Text / docx reading is cheap and audio shares the in-process speech models
+                pool = cpu_pool if processors[ext] in CPU_BOUND_PROCESSORS else io_pool
+                pending[pool.submit(extract_text, path, ext, language)] = ('extract', index, filename)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, index, filename = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"Bulk {stage} failed for {filename}: {str(e)}")
+                        yield _record(batch_id, index, filename, error=str(e))
+                        continue
+                    if stage == 'report':
+                        yield _record(batch_id, index, filename, result=result)
+                    elif not result:
+                        yield _record(batch_id, index, filename, error='No text extracted')
+                    else:
+                        llm_future = llm_pool.submit(_build_report, result, filename, items[index][1], ai_mode, template_name)
+                        pending[llm_future] = ('report', index, filename)
+        finally:
+            # A client that went away leaves nothing queued in the shared process pool
+            for future in pending:
+                future.cancel()
+
+
+def _build_report(text, filename, path, ai_mode, template_name):
+    return build_report(text, filename, ai_mode=ai_mode, template_name=template_name, source_hash=source_digest(path))
+
+
+def iter_ndjson(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate reports for many files, folders or zip archives')
+    parser.add_argument('paths', nargs='+', help='files, folders or .zip archives')
+    parser.add_argument('--output', '-o', help='NDJSON output file (default: stdout)')
+    parser.add_argument('--language', help='language of audio dictations (default: detected by Whisper)')
+    parser.add_argument('--ai-mode', choices=['two_pass', 'single_pass'], default=None)
+    parser.add_argument('--template', default=None, help='report template name')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='bulk-')
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        items = collect_paths(args.paths, work_dir)
+        records = iter_bulk_results(items, args.language, args.ai_mode, args.template)
+        for line in iter_ndjson(records):
+            out.write(line)
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main()
@@ -0,0 +1,107 @@
+import json
+import logging
+
+from flask import request
+from flask_sock import Sock, ConnectionClosed
+
+from model_registry import get_vosk_model, normalize_language
+from pipeline import build_report
+from template_engine import get_template, TemplateNotFoundError
+
+sock = Sock()
+
+# Sample rates accepted for the PCM stream; Vosk resamples to the model's rate
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+
+
+def _send(ws, message_type, **payload):
+    ws.send(json.dumps({'type': message_type, **payload}, ensure_ascii=False))
+
+
+def _sample_rate(value):
+    """The rate query parameter as an int, ValueError when it is not a supported sample rate"""
+    try:
+        rate = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid sample rate: {value}')
+    if not MIN_SAMPLE_RATE <= rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f'Sample rate must be between {MIN_SAMPLE_RATE} and {MAX_SAMPLE_RATE}')
+    return rate
+
+
+def _control_type(message):
+    """Type of a text control message, ValueError when it is not a JSON object"""
+    control = json.loads(message)
+    if not isinstance(control, dict):
+        raise ValueError('Control messages must be JSON objects')
+    return control.get('type')
+
+
+@sock.route('/ws/dictation')
+def dictation(ws):
+    """
+    Real-time dictation. The browser sends 16-bit mono PCM frames (binary messages) while
+    the sonographer speaks; recognized text is pushed back as it is decoded:
+        {"type": "partial", "text": ...}   current, still changing utterance
+        {"type": "final", "text": ...}     finished utterance
+    A text message {"type": "end"} finishes the dictation. The full transcript is sent
+    ({"type": "transcript"}), the report is generated right away and returned as
+    {"type": "report", ...same payload as /process...} or {"type": "error", "error": ...}.
+    Invalid parameters or control messages are answered with an error and the connection is closed.
+    Query parameters: language (en / zh), rate (sample rate, default 16000), template, ai_mode
+    """
+    language = normalize_language(request.args.get('language', 'en'))
+    template_name = request.args.get('template') or None
+    ai_mode = request.args.get('ai_mode') or None
+
+    # Imported on the first dictation, workers that never serve one do not load Vosk
+    from vosk import KaldiRecognizer
+    try:
+        sample_rate = _sample_rate(request.args.get('rate', 16000))
+        get_template(template_name)
+        # The Vosk model is loaded once per process and shared; a recognizer keeps the
+        # decoding state of one audio stream, so every connection gets its own
+        recognizer = KaldiRecognizer(get_vosk_model(language), sample_rate)
+    except (TemplateNotFoundError, ValueError) as e:
+        _send(ws, 'error', error=str(e))
+        return
+
+    utterances = []
+    try:
+        while True:
+            message = ws.receive()
+            if isinstance(message, (bytes, bytearray)):
+                if recognizer.AcceptWaveform(bytes(message)):
+                    text = json.loads(recognizer.Result()).get('text', '').strip()
+                    if text:
+                        utterances.append(text)
+                        _send(ws, 'final', text=text)
+                else:
+                    _send(ws, 'partial', text=json.loads(recognizer.PartialResult()).get('partial', ''))
+            elif message and _control_type(message) == 'end':
+                break
+    except ConnectionClosed:
+        logging.info("Dictation connection closed before the end of dictation")
+        return
+    except ValueError as e:
+        logging.info(f"Invalid dictation control message: {str(e)}")
+        _send(ws, 'error', error=f'Invalid control message: {str(e)}')
+        return
+
+    text = json.loads(recognizer.FinalResult()).get('text', '').strip()
+    if text:
+        utterances.append(text)
+        _send(ws, 'final', text=text)
+    transcript = '\n'.join(utterances)
+    _send(ws, 'transcript', text=transcript)
+
+    if not transcript:
+        _send(ws, 'error', error='No speech recognized')
+        return
+    try:
+        result = build_report(transcript, 'dictation.txt', ai_mode=ai_mode, template_name=template_name)
+        _send(ws, 'report', **result)
+    except Exception as e:
+        logging.error(f"Dictation report generation failed: {str(e)}")
+        _send(ws, 'error', error=str(e))
@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import math
+
+from ai_processing import REPORT_KEYS, FREE_TEXT_KEYS, validate_report_field
+from llm_client import LLM_MAX_CONCURRENCY
+
+# Texts longer than this many tokens are split and structured section by section
+LLM_CHUNK_TOKENS = int(os.getenv('LLM_CHUNK_TOKENS', '1500'))
+# Tokens repeated at the start of a section from the end of the previous one, so nothing is cut mid-context
+LLM_CHUNK_OVERLAP_TOKENS = int(os.getenv('LLM_CHUNK_OVERLAP_TOKENS', '150'))
+# Sections structured at the same time
+LLM_CHUNK_WORKERS = int(os.getenv('LLM_CHUNK_WORKERS', str(LLM_MAX_CONCURRENCY)))
+
+# Words, CJK characters (one token each) and single punctuation marks
+_TOKEN_PATTERN = re.compile(r'[぀-ヿ㐀-鿿]|\w+|[^\w\s]')
+_SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s+')
+
+
+def count_tokens(text):
+    """
+    Approximate number of model tokens: subword tokenizers use about one token per
+    four characters of a word, one per CJK character and punctuation mark
+    """
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in _TOKEN_PATTERN.findall(text or ''))
+
+
+def _units(text, max_tokens):
+    """Lines, and sentences / word runs of lines that alone exceed max_tokens, with their token counts"""
+    units = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        pieces = [line] if count_tokens(line) <= max_tokens else _SENTENCE_END.split(line)
+        for piece in pieces:
+            tokens = count_tokens(piece)
+            if tokens <= max_tokens:
+                units.append((piece, tokens))
+                continue
+            # A single sentence longer than the budget, cut between words
+            words, run = piece.split(' '), []
+            for word in words:
+                if run and count_tokens(' '.join(run + [word])) > max_tokens:
+                    units.append((' '.join(run), count_tokens(' '.join(run))))
+                    run = []
+                run.append(word)
+            if run:
+                units.append((' '.join(run), count_tokens(' '.join(run))))
+    return units
+
+
+def split_into_chunks(text, max_tokens=None, overlap_tokens=None):
+    """
+    Split text at line / sentence boundaries into sections of at most max_tokens
+    (default LLM_CHUNK_TOKENS), each starting with about overlap_tokens of the previous one
+    """
+    max_tokens = max_tokens or LLM_CHUNK_TOKENS
+    overlap_tokens = min(LLM_CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens, max_tokens // 2)
+    chunks = []
+    current, current_tokens = [], 0
+    for unit, tokens in _units(text, max_tokens):
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append('\n'.join(piece for piece, _ in current))
+            # Carry the tail of this section over
+            overlap, overlap_total = [], 0
+            for piece, piece_tokens in reversed(current):
+                if overlap_total + piece_tokens > overlap_tokens:
+                    break
+                overlap.insert(0, (piece, piece_tokens))
+                overlap_total += piece_tokens
+            current, current_tokens = overlap, overlap_total
+        current.append((unit, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append('\n'.join(piece for piece, _ in current))
+    return chunks
+
+
+def _normalize(value):
+    return re.sub(r'\s+', ' ', str(value)).strip().lower()
+
+
+def _known(key, value):
+    value = validate_report_field(key, value)
+    # generate_report_with_ai fills keys the model left out with '456'
+    if value is None or value == '456':
+        return None
+    return value
+
+
+def _merge_free_text(values):
+    """Sections in document order; repeats caused by the overlap are dropped"""
+    if all(isinstance(value, list) for value in values):
+        merged = []
+        for value in values:
+            merged.extend(item for item in value if item not in merged)
+        return merged
+    if all(isinstance(value, dict) for value in values):
+        merged = {}
+        for value in values:
+            for key, item in value.items():
+                merged.setdefault(key, item)
+        return merged
+
+    texts = []
+    for value in values:
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        normalized = _normalize(text)
+        if any(normalized in _normalize(existing) for existing in texts):
+            continue
+        # A later, longer section that repeats an earlier one replaces it
+        texts = [existing for existing in texts if _normalize(existing) not in normalized]
+        texts.append(text)
+    return '\n'.join(texts)
+
+
+def merge_partial_reports(partials, keys=None):
+    """
+    Merge the structured data of every section into one report.
+    Header fields take the value most sections agree on (the earliest on a tie, headers
+    usually lead the document); free-text fields are concatenated in document order.
+    """
+    keys = keys or REPORT_KEYS
+    merged = {}
+    for key in keys:
+        values = [value for value in (_known(key, partial.get(key)) for partial in partials) if value is not None]
+        if not values:
+            merged[key] = 'unknown'
+        elif key in FREE_TEXT_KEYS:
+            merged[key] = _merge_free_text(values)
+        else:
+            votes = {}
+            for index, value in enumerate(values):
+                count, first, original = votes.get(_normalize(value), (0, index, value))
+                votes[_normalize(value)] = (count + 1, first, original)
+            merged[key] = max(votes.values(), key=lambda vote: (vote[0], -vote[1]))[2]
+    return merged
@@ -0,0 +1,178 @@
+"""
+Local stand-in for the Ollama HTTP API, so the pipeline can be benchmarked offline
+and deterministically. /api/generate answers with canned output derived from the
+prompt: enhancement prompts get the original text back, report prompts a fixed
+structured report. Streaming and latency injection are supported.
+
+Command line usage (from the backend/ directory):
+    python fake_ollama.py --port 11435 --latency-ms 200 --token-ms 5
+    OLLAMA_HOST=http://127.0.0.1:11435 python app2.py
+"""
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_PORT = 11435
+
+CANNED_REPORT = {
+    'patient_name': 'Jane Doe',
+    'examination_date': '2024-01-15',
+    'sex': 'F',
+    'age': '45',
+    'refby': 'Dr. Smith',
+    'uhidno': 'UH123456',
+    'examination_type': 'Ultrasound',
+    'examined_area': 'Abdomen',
+    'device_model': 'Voluson E8',
+    'imaging_findings': 'Liver is normal in size and echotexture. No focal lesion is seen.',
+    'diagnosis_summary': 'Normal abdominal ultrasound.',
+    'comment': 'Clinical correlation is suggested.'
+}
+
+
+def canned_response(prompt):
+    """Deterministic model output for a pipeline prompt"""
+    match = re.search(r'(?:Original text|Content):\n(.*?)\n\n(?:Please return|Output only)', prompt, re.DOTALL)
+    content = match.group(1).strip() if match else prompt
+    if 'Output only a valid JSON object' not in prompt:
+        return content
+
+    report = dict(CANNED_REPORT)
+    # Vary one field with the content so different inputs give different reports
+    report['uhidno'] = 'UH' + hashlib.sha256(content.encode('utf-8')).hexdigest()[:6].upper()
+    # The prompts list the expected keys as "- key" lines
+    keys = re.findall(r'^- (\w+)$', prompt, re.MULTILINE) or list(report)
+    data = {key: (content if key == 'enhanced_text' else report.get(key, 'UNKNOWN')) for key in keys}
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+def _tokens(text):
+    # Roughly what a tokenizer produces: words with their trailing whitespace
+    return re.findall(r'\S+\s*|\s+', text)
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set by make_server
+    latency_ms = 0.0
+    token_ms = 0.0
+
+    def log_message(self, format, *args):
+        logging.debug("fake ollama: " + format % args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json(200, {'models': [{'name': 'gemma3:latest'}]})
+        elif self.path in ('/', '/api/version'):
+            self._send_json(200, {'version': 'fake'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path != '/api/generate':
+            self._send_json(404, {'error': 'not found'})
+            return
+
+        started = time.perf_counter()
+        prompt = request.get('prompt', '')
+        tokens = _tokens(canned_response(prompt))
+        summary = {
+            'model': request.get('model', ''),
+            'done': True,
+            'prompt_eval_count': len(_tokens(prompt)),
+            'eval_count': len(tokens)
+        }
+        # Time to first token
+        time.sleep(self.latency_ms / 1000)
+
+        if not request.get('stream', True):
+            time.sleep(self.token_ms * len(tokens) / 1000)
+            summary['total_duration'] = int((time.perf_counter() - started) * 1e9)
+            self._send_json(200, {'response': ''.join(tokens), **summary})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(self.token_ms / 1000)
+                self._write_chunk({'model': summary['model'], 'response': token, 'done': False})
+            summary['total_duration'] = int((time.perf_counter() - started) * 1e9)
+            self._write_chunk({'response': '', **summary})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stops reading once the JSON object is complete
+            pass
+
+    def _write_chunk(self, payload):
+        line = (json.dumps(payload) + '\n').encode('utf-8')
+        self.wfile.write(f'{len(line):X}\r\n'.encode('ascii') + line + b'\r\n')
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections after closing a stream early, nothing to report
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def make_server(host='127.0.0.1', port=DEFAULT_PORT, latency_ms=0.0, token_ms=0.0):
+    """Create the server; port 0 picks a free port (see server.server_address)"""
+    handler = type('Handler', (FakeOllamaHandler,), {'latency_ms': latency_ms, 'token_ms': token_ms})
+    server = FakeOllamaServer((host, port), handler)
+    return server
+
+
+def start_in_background(latency_ms=0.0, token_ms=0.0, port=0):
+    """Serve from a daemon thread and return (server, base url)"""
+    server = make_server(port=port, latency_ms=latency_ms, token_ms=token_ms)
+    threading.Thread(target=server.serve_forever, name='fake-ollama', daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f'http://{host}:{port}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve canned Ollama responses for offline benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='delay before the first token')
+    parser.add_argument('--token-ms', type=float, default=0.0, help='delay per generated token')
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.latency_ms, args.token_ms)
+    logging.info(f"Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main()
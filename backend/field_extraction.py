@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import logging
+import threading
+
+from ai_processing import FREE_TEXT_KEYS
+
+# Set to 0 to send the whole text to the model again
+FIELD_FAST_PATH = os.getenv('FIELD_FAST_PATH', '1') != '0'
+# JSON file with additional report layouts, tried before the built-in one (see DEFAULT_LAYOUT)
+FIELD_LAYOUTS_PATH = os.getenv('FIELD_LAYOUTS_PATH', '')
+
+# A layout maps report keys to the labels printed in front of their values. "detect" (optional) is a regex
+# that identifies documents of the layout; "value" (optional) a regex the whole value must match, ignoring
+# case. Labels only count at the start of a line or of a column (after a tab, "|" or two spaces), so words
+# like "name" or "area" in a sentence are never taken for one. Single-line fields run until the end of the
+# line or the next label. The labels of multiline fields (and of FREE_TEXT_KEYS) only end the field before
+# them; their value is left to the model.
+DEFAULT_LAYOUT = {
+    'name': 'generic',
+    'fields': {
+        'patient_name': {'labels': ['patient name', "patient's name", 'name of patient']},
+        'examination_date': {
+            'labels': ['examination date', 'exam date', 'date of examination', 'study date', 'date'],
+            'value': r'\d{1,4}[/\-.]\d{1,2}[/\-.]\d{1,4}|\d{1,2} [A-Za-z]+ \d{4}|[A-Za-z]+ \d{1,2}, \d{4}'
+        },
+        'sex': {'labels': ['sex', 'gender'], 'value': r'm|f|male|female|other'},
+        'age': {'labels': ['age'], 'value': r'\d{1,3}\s*(?:y|yr|yrs|years?|m|months?|d|days?)?(?:\s*/\s*[mf])?'},
+        'refby': {'labels': ['referred by', 'ref by', 'ref. by', 'refby', 'referring physician'], 'value': r'.{2,}'},
+        'uhidno': {'labels': ['uhid no', 'uhid no.', 'uhid', 'uhidno', 'mrn', 'patient id'], 'value': r'[\w\-/]+'},
+        'examination_type': {'labels': ['examination type', 'exam type', 'type of examination', 'study type']},
+        'examined_area': {'labels': ['examined area', 'area examined', 'examined region', 'body part']},
+        'device_model': {'labels': ['device model', 'machine model', 'ultrasound machine', 'equipment', 'scanner']},
+        'imaging_findings': {'labels': ['imaging findings', 'findings'], 'multiline': True},
+        'diagnosis_summary': {'labels': ['diagnosis summary', 'impression', 'diagnosis', 'conclusion'], 'multiline': True},
+        'comment': {'labels': ['comments', 'comment', 'remarks', 'advice', 'recommendation'], 'multiline': True}
+    }
+}
+
+
+class CompiledLayout:
+    """A layout with all its labels compiled into one regex"""
+
+    def __init__(self, layout):
+        self.name = layout.get('name', 'layout')
+        self.detect = re.compile(layout['detect'], re.IGNORECASE) if layout.get('detect') else None
+        self.fields = layout['fields']
+        self.values = {
+            key: re.compile(f"(?:{spec['value']})", re.IGNORECASE) for key, spec in self.fields.items() if spec.get('value')
+        }
+        self.free_text = {key for key, spec in self.fields.items() if spec.get('multiline') or key in FREE_TEXT_KEYS}
+        self.label_keys = {}
+        for key, spec in self.fields.items():
+            for label in spec['labels']:
+                self.label_keys[label.lower()] = key
+        # Longest labels first so "uhid no." wins over "uhid"
+        alternatives = '|'.join(re.escape(label) for label in sorted(self.label_keys, key=len, reverse=True))
+        self.pattern = re.compile(
+            rf'(?:^|(?<=\t)|(?<=\|)|(?<=  ))[ \t]*({alternatives})[ \t]*[:：][ \t]*', re.IGNORECASE | re.MULTILINE
+        )
+
+    def matches(self, text):
+        return self.detect is None or bool(self.detect.search(text))
+
+    def extract(self, text):
+        """
+        return: ({key: value} of the single-line fields found, text with those fields removed)
+        """
+        found = {}
+        spans = []
+        matches = list(self.pattern.finditer(text))
+        for index, match in enumerate(matches):
+            key = self.label_keys[match.group(1).lower()]
+            if key in found or key in self.free_text:
+                continue
+            end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+            line = text[match.end():end].split('\n', 1)[0]
+            value = re.sub(r'[ \t]+', ' ', line).strip().strip('|,;').strip()
+            if not value or value.upper() == 'UNKNOWN':
+                continue
+            if key in self.values and not self.values[key].fullmatch(value):
+                continue
+            found[key] = value
+            spans.append((match.start(), match.end() + len(line)))
+
+        # The model does not need to read what is already resolved
+        remaining = text
+        for start, stop in sorted(spans, reverse=True):
+            remaining = remaining[:start] + remaining[stop:]
+        remaining = '\n'.join(line.strip() for line in remaining.splitlines() if line.strip())
+        return found, remaining
+
+
+_layouts = None
+_layouts_mtime = None
+_lock = threading.Lock()
+
+
+def get_layouts():
+    """Compiled layouts, the configured ones first; reloaded when FIELD_LAYOUTS_PATH changes"""
+    global _layouts, _layouts_mtime
+    mtime = os.path.getmtime(FIELD_LAYOUTS_PATH) if FIELD_LAYOUTS_PATH and os.path.exists(FIELD_LAYOUTS_PATH) else None
+    with _lock:
+        if _layouts is None or mtime != _layouts_mtime:
+            layouts = []
+            if mtime is not None:
+                try:
+                    with open(FIELD_LAYOUTS_PATH, encoding='utf-8') as f:
+                        layouts = [CompiledLayout(layout) for layout in json.load(f)]
+                except Exception as e:
+                    logging.error(f"Failed to load field layouts from {FIELD_LAYOUTS_PATH}: {str(e)}")
+            _layouts = layouts + [CompiledLayout(DEFAULT_LAYOUT)]
+            _layouts_mtime = mtime
+        return _layouts
+
+
+def extract_fields(text):
+    """
+    Read the fields printed as "Label: value" with the first layout that matches the text.
+    return: (layout name, {key: value} of the fields found, remaining text for the model)
+    """
+    if not FIELD_FAST_PATH or not text:
+        return None, {}, text
+    for layout in get_layouts():
+        if layout.matches(text):
+            fields, remaining = layout.extract(text)
+            return layout.name, fields, remaining
+    return None, {}, text
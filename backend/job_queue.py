@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import uuid
+import queue
+import fcntl
+import logging
+import threading
+from pathlib import Path
+
+from pipeline import run_pipeline
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+JOBS_DIR = BASE_DIR / 'jobs'
+
+# Number of pipeline workers per process and how many jobs may wait for one
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '16'))
+# Hours the state of finished and failed jobs is kept for the status endpoint
+JOB_RETENTION_HOURS = float(os.getenv('JOB_RETENTION_HOURS', '24'))
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_workers = []
+_workers_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def _job_path(job_id):
+    return JOBS_DIR / f'{job_id}.json'
+
+
+def _save_job(job):
+    """Persist job state atomically so any worker process can answer status requests"""
+    JOBS_DIR.mkdir(exist_ok=True)
+    job['updated_at'] = time.time()
+    tmp_path = JOBS_DIR / f".{job['id']}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, _job_path(job['id']))
+
+
+def get_job(job_id):
+    """Return persisted job state, or None if the job is unknown"""
+    try:
+        uuid.UUID(job_id)
+        with open(_job_path(job_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def queue_depth():
+    return _queue.qsize()
+
+
+def _run_job(job):
+    def on_stage(name):
+        job['stage'] = name
+        _save_job(job)
+
+    def on_partial(text):
+        job['partial_text'] = text
+        _save_job(job)
+
+    job['status'] = 'running'
+    job['started_at'] = time.time()
+    try:
+        job['result'] = run_pipeline(
+            job['filepath'], job['filename'], job['language'],
+            report_id=job['report_id'], on_stage=on_stage, ai_mode=job.get('ai_mode'),
+            template_name=job.get('template'), on_partial=on_partial
+        )
+        job['status'] = 'finished'
+    except Exception as e:
+        logging.error(f"Job {job['id']} failed: {str(e)}")
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        job['stage'] = None
+        job['finished_at'] = time.time()
+        _save_job(job)
+        try:
+            os.remove(job['filepath'])
+        except OSError:
+            pass
+
+
+def _worker_loop():
+    while True:
+        job = _queue.get()
+        try:
+            _run_job(job)
+        finally:
+            _queue.task_done()
+
+
+def _ensure_workers():
+    with _workers_lock:
+        while len(_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=_worker_loop, name=f'job-worker-{len(_workers)}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+
+def _boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _process_identity(pid):
+    """
+    Boot id plus start time of a process, so a PID reused after a restart is not mistaken
+    for the process that owned a job. None where /proc is not available.
+    """
+    boot_id = _boot_id()
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    if boot_id is None:
+        return None
+    # Fields after the command name, which may itself contain spaces and parentheses
+    fields = stat[stat.rfind(')') + 2:].split()
+    return f'{boot_id}:{fields[19]}'
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_alive(job):
+    pid = job.get('owner_pid')
+    if not pid or not _process_alive(pid):
+        return False
+    owner_id = job.get('owner_id')
+    if owner_id is None:
+        return True
+    return _process_identity(pid) == owner_id
+
+
+def _set_owner(job):
+    """Make this process the owner of the job, recover_jobs() takes it over once it is gone"""
+    job['owner_pid'] = os.getpid()
+    job['owner_id'] = _process_identity(os.getpid())
+
+
+def prune_jobs():
+    """
+    Remove the state of jobs that finished or failed more than JOB_RETENTION_HOURS ago.
+    return: number of jobs removed
+    """
+    global _last_prune
+    _last_prune = time.time()
+    if not JOBS_DIR.exists():
+        return 0
+    cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+    removed = 0
+    for path in JOBS_DIR.glob('*.json'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if job.get('status') in ('finished', 'failed') and (job.get('finished_at') or 0) < cutoff:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        logging.info(f"Removed {removed} expired jobs")
+    return removed
+
+
+def recover_jobs():
+    """
+    Take over the unfinished jobs of server processes that are gone (restart, replaced worker):
+    queued jobs are queued again in this process, jobs that were running are marked failed
+    since their progress is lost. Expired jobs are removed as well.
+    Called once in every server process after it started.
+    return: number of jobs queued again
+    """
+    if not JOBS_DIR.exists():
+        return 0
+    recovered = 0
+    # Processes starting at the same time take turns, a job is only taken over once
+    with open(JOBS_DIR / '.recover.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for path in JOBS_DIR.glob('*.json'):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if job.get('status') not in ('queued', 'running') or _owner_alive(job):
+                continue
+
+            if job['status'] == 'queued' and os.path.exists(job['filepath']):
+                _set_owner(job)
+                try:
+                    _queue.put_nowait(job)
+                except queue.Full:
+                    # Left for the next process that starts
+                    break
+                _save_job(job)
+                recovered += 1
+                continue
+
+            job['error'] = ('The server restarted while the job was running, please submit the file again'
+                            if job['status'] == 'running' else 'The uploaded file is no longer available')
+            job['status'] = 'failed'
+            job['stage'] = None
+            job['finished_at'] = time.time()
+            _save_job(job)
+            logging.warning(f"Job {job['id']} failed: {job['error']}")
+            try:
+                os.remove(job['filepath'])
+            except OSError:
+                pass
+        prune_jobs()
+    if recovered:
+        _ensure_workers()
+        logging.info(f"Queued {recovered} jobs left by a previous server process")
+    return recovered
+
+
+def submit_job(filepath, filename, language=None, ai_mode=None, template_name=None):
+    """
+    Queue a saved upload for background processing and return the job state.
+    Raises QueueFullError when JOB_QUEUE_SIZE jobs are already waiting.
+    """
+    _ensure_workers()
+    if time.time() - _last_prune > 3600:
+        prune_jobs()
+    job_id = str(uuid.uuid4())
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'stage': None,
+        'filename': filename,
+        'filepath': filepath,
+        'language': language,
+        'ai_mode': ai_mode,
+        'template': template_name,
+        'report_id': job_id,
+        'created_at': time.time(),
+        'result': None,
+        'error': None
+    }
+    _set_owner(job)
+    _save_job(job)
+    try:
+        _queue.put_nowait(job)
+    except queue.Full:
+        os.remove(_job_path(job_id))
+        raise QueueFullError('Job queue is full, please retry later')
+    return job
+
+
+def public_job(job):
+    """Job state as returned by the status endpoint (without server-side paths)"""
+    return {
+        'jobId': job['id'],
+        'status': job['status'],
+        'stage': job.get('stage'),
+        # Transcript of long recordings finished so far, while the job is still extracting
+        'partialText': job.get('partial_text'),
+        'filename': job['filename'],
+        'error': job.get('error'),
+        'statusUrl': f"/jobs/{job['id']}",
+        'resultUrl': f"/jobs/{job['id']}/result"
+    }
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+
+import httpx
+import ollama
+
+# Ollama instances to spread generations over, e.g. "http://gpu1:11434,http://gpu2:11434"
+OLLAMA_HOSTS = [
+    host.strip() for host in
+    os.getenv('OLLAMA_HOSTS', os.getenv('OLLAMA_HOST', 'http://127.0.0.1:11434')).split(',') if host.strip()
+]
+# Generations in flight per server process, across all endpoints
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+# Seconds to connect, and to wait for the next bytes of a response
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '120'))
+# Retries of failed generations (connection errors, timeouts, 5xx / 429), with exponential backoff
+LLM_RETRIES = int(os.getenv('LLM_RETRIES', '2'))
+LLM_RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', '0.5'))
+# Seconds between health checks, and before a failed endpoint is tried again
+LLM_HEALTH_INTERVAL = float(os.getenv('LLM_HEALTH_INTERVAL', '10'))
+
+
+class LLMUnavailableError(Exception):
+    """No Ollama endpoint answered, even after retries"""
+
+
+class Endpoint:
+    """One Ollama instance with its own persistent connection pool"""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = ollama.Client(
+            url,
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY)
+        )
+        # Health checks use their own connection, so they never wait behind generations for a pooled one
+        self.health_client = httpx.Client(base_url=url, timeout=LLM_CONNECT_TIMEOUT)
+        self.in_flight = 0
+        self.healthy = True
+        self.failed_at = 0.0
+
+    def mark_failed(self):
+        if self.healthy:
+            logging.warning(f"Ollama endpoint {self.url} marked unhealthy")
+        self.healthy = False
+        self.failed_at = time.monotonic()
+
+    def mark_healthy(self):
+        if not self.healthy:
+            logging.info(f"Ollama endpoint {self.url} is healthy again")
+        self.healthy = True
+
+    def check(self):
+        """Ping the endpoint and update its health"""
+        try:
+            self.health_client.get('/api/tags').raise_for_status()
+            self.mark_healthy()
+        except httpx.HTTPError:
+            self.mark_failed()
+
+
+_endpoints = [Endpoint(url) for url in OLLAMA_HOSTS]
+_lock = threading.Lock()
+_semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+# Single-flight: request key -> Future of the generation currently running for it
+_pending = {}
+_health_thread = None
+# Rotates the starting point so equally loaded endpoints take turns
+_turn = 0
+
+
+def _health_loop():
+    while True:
+        time.sleep(LLM_HEALTH_INTERVAL)
+        for endpoint in _endpoints:
+            endpoint.check()
+
+
+def _start_health_checks():
+    # Health only matters for routing, so a single endpoint is never checked in the background
+    global _health_thread
+    with _lock:
+        if _health_thread is None and len(_endpoints) > 1:
+            _health_thread = threading.Thread(target=_health_loop, name='llm-health', daemon=True)
+            _health_thread.start()
+
+
+def _acquire_endpoint(exclude=()):
+    """
+    Least loaded healthy endpoint; unhealthy ones are tried again once LLM_HEALTH_INTERVAL
+    has passed, and when nothing else is left
+    """
+    global _turn
+    now = time.monotonic()
+    with _lock:
+        candidates = [e for e in _endpoints if e not in exclude] or list(_endpoints)
+        usable = [e for e in candidates if e.healthy or now - e.failed_at >= LLM_HEALTH_INTERVAL] or candidates
+        _turn += 1
+        endpoint = min(usable, key=lambda e: (
+            not e.healthy, e.in_flight, (_endpoints.index(e) - _turn) % len(_endpoints)
+        ))
+        endpoint.in_flight += 1
+        return endpoint
+
+
+def _release_endpoint(endpoint):
+    with _lock:
+        endpoint.in_flight -= 1
+
+
+def _retryable(error):
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code in (-1, 429) or error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _backoff(attempt):
+    time.sleep(LLM_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random()))
+
+
+def _call(model, prompt, **kwargs):
+    """One non-streamed generation with retries, failing over to other endpoints"""
+    tried = []
+    for attempt in range(LLM_RETRIES + 1):
+        endpoint = _acquire_endpoint(exclude=tried)
+        try:
+            with _semaphore:
+                response = endpoint.client.generate(model=model, prompt=prompt, **kwargs)
+            endpoint.mark_healthy()
+            return response
+        except Exception as e:
+            if not _retryable(e):
+                raise
+            endpoint.mark_failed()
+            tried.append(endpoint)
+            logging.warning(f"Generation on {endpoint.url} failed (attempt {attempt + 1}): {str(e)}")
+            if attempt < LLM_RETRIES:
+                _backoff(attempt)
+        finally:
+            _release_endpoint(endpoint)
+    raise LLMUnavailableError(f"No Ollama endpoint answered after {LLM_RETRIES + 1} attempts")
+
+
+def _stream(model, prompt, **kwargs):
+    """
+    Streamed generation. Retries only happen before the first part arrived, a stream
+    cut off halfway is reported to the caller. The concurrency slot is held until the
+    stream is exhausted or closed.
+    """
+    tried = []
+    for attempt in range(LLM_RETRIES + 1):
+        endpoint = _acquire_endpoint(exclude=tried)
+        received = False
+        try:
+            with _semaphore:
+                parts = endpoint.client.generate(model=model, prompt=prompt, stream=True, **kwargs)
+                try:
+                    for part in parts:
+                        received = True
+                        yield part
+                finally:
+                    # Closes the HTTP response when the caller stops reading early
+                    parts.close()
+            endpoint.mark_healthy()
+            return
+        except Exception as e:
+            if received or not _retryable(e):
+                raise
+            endpoint.mark_failed()
+            tried.append(endpoint)
+            logging.warning(f"Streamed generation on {endpoint.url} failed (attempt {attempt + 1}): {str(e)}")
+            if attempt < LLM_RETRIES:
+                _backoff(attempt)
+        finally:
+            _release_endpoint(endpoint)
+    raise LLMUnavailableError(f"No Ollama endpoint answered after {LLM_RETRIES + 1} attempts")
+
+
+def generate(model, prompt, stream=False, **kwargs):
+    """
+    Generate with the pooled clients, at most LLM_MAX_CONCURRENCY generations at a time.
+    Identical non-streamed requests running concurrently are sent once and share the response.
+    kwargs: the other arguments of ollama.generate (system, format, options, ...)
+    return: the response dict, or an iterator of parts with stream=True
+    """
+    _start_health_checks()
+    if stream:
+        return _stream(model, prompt, **kwargs)
+
+    key = hashlib.sha256(json.dumps([model, prompt, kwargs], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    with _lock:
+        future = _pending.get(key)
+        leader = future is None
+        if leader:
+            future = _pending[key] = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        future.set_result(_call(model, prompt, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _lock:
+            _pending.pop(key, None)
+    return future.result()
+
+
+async def agenerate(model, prompt, **kwargs):
+    """asyncio version of generate() sharing its connection pools, concurrency limit and single-flight"""
+    return await asyncio.to_thread(generate, model, prompt, **kwargs)
+
+
+async def astream(model, prompt, **kwargs):
+    """asyncio version of generate(stream=True), an async iterator of parts"""
+    parts = _stream(model, prompt, **kwargs)
+    done = object()
+    try:
+        while True:
+            part = await asyncio.to_thread(next, parts, done)
+            if part is done:
+                return
+            yield part
+    finally:
+        parts.close()
+
+
+def endpoint_status():
+    """Health and generations in flight per endpoint"""
+    with _lock:
+        return [{'url': e.url, 'healthy': e.healthy, 'in_flight': e.in_flight} for e in _endpoints]
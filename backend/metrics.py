@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+# Fraction of payloads (extracted text, model output, report data) logged at DEBUG level
+PAYLOAD_LOG_SAMPLE_RATE = float(os.getenv('PAYLOAD_LOG_SAMPLE_RATE', '0'))
+# Logged payloads are cut to this many characters
+PAYLOAD_LOG_MAX_CHARS = int(os.getenv('PAYLOAD_LOG_MAX_CHARS', '500'))
+
+# Every server process writes its values here; a scrape of any worker sums those of all of them
+METRICS_DIR = Path(os.getenv('METRICS_DIR', str(Path(__file__).parent.parent.absolute() / 'metrics')))
+# Seconds between two writes of the values of one process
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+
+METRIC_PREFIX = 'sonography'
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+# (stage, file type) -> [bucket counts..., count, sum]
+_stage_histograms = {}
+# (model, function) -> {'prompt': n, 'completion': n, 'calls': n}
+_llm_tokens = {}
+# name -> (help text, metric type, callable, summed over processes), values owned by other modules
+_collectors = {}
+_flusher = None
+
+
+def _reset_after_fork():
+    """A forked worker starts from zero, the values inherited from the master are in its file already"""
+    global _lock, _flusher
+    _lock = threading.Lock()
+    _stage_histograms.clear()
+    _llm_tokens.clear()
+    _flusher = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _snapshot_path(pid):
+    return METRICS_DIR / f'{pid}.json'
+
+
+def _collect(name, collect):
+    try:
+        value = collect()
+    except Exception as e:
+        logging.error(f"Collecting metric {name} failed: {str(e)}")
+        return None
+    return value if isinstance(value, dict) else {(): value}
+
+
+def _write_snapshot():
+    """Write the values of this process atomically, for the scrapes answered by the other workers"""
+    with _lock:
+        histograms = [[stage, file_type, list(value)] for (stage, file_type), value in _stage_histograms.items()]
+        tokens = [[model, function, dict(value)] for (model, function), value in _llm_tokens.items()]
+    collectors = {}
+    for name, (_, _, collect, summed) in list(_collectors.items()):
+        values = _collect(name, collect) if summed else None
+        if values is not None:
+            collectors[name] = [[[list(pair) for pair in pairs], number] for pairs, number in values.items()]
+    snapshot = {'pid': os.getpid(), 'stages': histograms, 'tokens': tokens, 'collectors': collectors}
+    METRICS_DIR.mkdir(exist_ok=True)
+    tmp_path = METRICS_DIR / f'.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, _snapshot_path(os.getpid()))
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            _write_snapshot()
+        except Exception as e:
+            logging.error(f"Writing metrics failed: {str(e)}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+                _flusher.start()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_snapshots():
+    snapshots = []
+    for path in METRICS_DIR.glob('*.json'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def clear_stale():
+    """
+    Remove the values of processes that are gone, e.g. of the previous server run.
+    Called once by the gunicorn master before it starts the workers; values of workers
+    replaced later are kept so the counters summed over all processes never go back.
+    """
+    if not METRICS_DIR.exists():
+        return
+    for path in METRICS_DIR.glob('*.json'):
+        try:
+            if not _process_alive(int(path.stem)):
+                os.remove(path)
+        except (ValueError, OSError):
+            continue
+
+
+def observe(stage, seconds, file_type=''):
+    """Record the duration of one pipeline stage"""
+    _ensure_flusher()
+    key = (stage, file_type)
+    with _lock:
+        histogram = _stage_histograms.get(key)
+        if histogram is None:
+            histogram = _stage_histograms[key] = [0] * len(LATENCY_BUCKETS) + [0, 0.0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+
+@contextmanager
+def timed(stage, file_type=''):
+    """Time the body of a with block as one stage, also when it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, file_type)
+
+
+def record_llm_usage(function, response, model=''):
+    """Count prompt / completion tokens reported by Ollama for one generation"""
+    if not isinstance(response, dict):
+        return
+    _ensure_flusher()
+    key = (model or response.get('model', ''), function)
+    with _lock:
+        usage = _llm_tokens.setdefault(key, {'prompt': 0, 'completion': 0, 'calls': 0})
+        usage['prompt'] += response.get('prompt_eval_count') or 0
+        usage['completion'] += response.get('eval_count') or 0
+        usage['calls'] += 1
+
+
+def register_collector(name, help_text, collect, kind='gauge', summed=False):
+    """
+    Expose a value owned by another module, read when /metrics is scraped.
+    collect: callable returning a number, or a dict of {((label, value), ...): number}
+    kind: "gauge" or "counter"
+    summed: report the sum over all server processes (gauges: those still running)
+        instead of the value of the process answering the scrape
+    """
+    _collectors[name] = (help_text, kind, collect, summed)
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format, summed over the server processes"""
+    _ensure_flusher()
+    try:
+        _write_snapshot()
+    except Exception as e:
+        logging.error(f"Writing metrics failed: {str(e)}")
+    histograms = {}
+    tokens = {}
+    summed = {}
+    for snapshot in _read_snapshots():
+        for stage, file_type, histogram in snapshot['stages']:
+            total = histograms.setdefault((stage, file_type), [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+        for model, function, usage in snapshot['tokens']:
+            total = tokens.setdefault((model, function), {'prompt': 0, 'completion': 0, 'calls': 0})
+            for kind, value in usage.items():
+                total[kind] += value
+        alive = None
+        for name, values in snapshot['collectors'].items():
+            if name not in _collectors:
+                continue
+            if _collectors[name][1] != 'counter':
+                # The gauges of a stopped worker, e.g. its queue depth, no longer exist
+                if alive is None:
+                    alive = _process_alive(snapshot['pid'])
+                if not alive:
+                    continue
+            total = summed.setdefault(name, {})
+            for pairs, number in values:
+                key = tuple(tuple(pair) for pair in pairs)
+                total[key] = total.get(key, 0) + number
+
+    lines = [
+        f'# HELP {METRIC_PREFIX}_stage_seconds Duration of pipeline stages',
+        f'# TYPE {METRIC_PREFIX}_stage_seconds histogram'
+    ]
+    for (stage, file_type), histogram in sorted(histograms.items()):
+        labels = [('stage', stage)] + ([('type', file_type)] if file_type else [])
+        for bound, count in zip(LATENCY_BUCKETS, histogram):
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{_labels(labels + [("le", bound)])} {count}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{_labels(labels + [("le", "+Inf")])} {histogram[-2]}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_count{_labels(labels)} {histogram[-2]}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{_labels(labels)} {histogram[-1]:.6f}')
+
+    for kind, name, help_text in (('prompt', 'llm_prompt_tokens_total', 'Prompt tokens sent to the model'),
+                                  ('completion', 'llm_completion_tokens_total', 'Tokens generated by the model'),
+                                  ('calls', 'llm_calls_total', 'Model generations')):
+        name = f'{METRIC_PREFIX}_{name}'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for (model, function), usage in sorted(tokens.items()):
+            lines.append(f'{name}{_labels([("model", model), ("function", function)])} {usage[kind]}')
+
+    for name, (help_text, kind, collect, is_summed) in sorted(_collectors.items()):
+        values = summed.get(name, {}) if is_summed else _collect(name, collect)
+        if values is None:
+            continue
+        lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+        for pairs, number in sorted(values.items()):
+            lines.append(f'{METRIC_PREFIX}_{name}{_labels(pairs)} {number}')
+    return '\n'.join(lines) + '\n'
+
+
+def log_payload(label, payload):
+    """
+    Log a (possibly large) payload at DEBUG level for a PAYLOAD_LOG_SAMPLE_RATE sample of
+    calls, cut to PAYLOAD_LOG_MAX_CHARS. Payloads are not even formatted otherwise.
+    """
+    if random.random() >= PAYLOAD_LOG_SAMPLE_RATE or not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    text = payload if isinstance(payload, str) else repr(payload)
+    if len(text) > PAYLOAD_LOG_MAX_CHARS:
+        text = f"{text[:PAYLOAD_LOG_MAX_CHARS]}... ({len(text)} chars)"
+    logging.debug(f"{label}: {text}")
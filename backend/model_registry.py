@@ -0,0 +1,169 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+MODEL_DIR = BASE_DIR / 'model'
+
+# Vosk models shipped under model/, selected by language code
+VOSK_MODELS = {
+    'en': MODEL_DIR / 'vosk-model-small-en-us-0.15',
+    'zh': MODEL_DIR / 'vosk-model-small-cn-0.22',
+}
+
+# Accept the language codes the front end and users actually send
+LANGUAGE_ALIASES = {
+    'en-us': 'en',
+    'english': 'en',
+    'cn': 'zh',
+    'zh-cn': 'zh',
+    'chinese': 'zh',
+}
+
+# Whisper size: "tiny", "base", "small", "medium", "large"
+WHISPER_MODEL_SIZE = os.getenv('WHISPER_MODEL_SIZE', 'base')
+# Per-language override, e.g. "en:base,zh:small"
+WHISPER_LANGUAGE_SIZES = dict(
+    item.split(':', 1) for item in os.getenv('WHISPER_MODEL_SIZES', '').split(',') if ':' in item
+)
+WHISPER_DEVICE = os.getenv('WHISPER_DEVICE') or None
+# Upper bound for all resident speech models, 0 means no limit
+MODEL_MEMORY_LIMIT_MB = int(os.getenv('SPEECH_MODEL_MEMORY_MB', '0'))
+# Models loaded by warm_up(), e.g. "whisper:base,vosk:en,vosk:zh"; Vosk serves real-time dictation
+SPEECH_MODEL_PRELOAD = os.getenv('SPEECH_MODEL_PRELOAD', f'whisper:{WHISPER_MODEL_SIZE},vosk:en')
+
+# key -> (model, size in bytes), ordered from least to most recently used
+_models = OrderedDict()
+_lock = threading.Lock()
+# One lock per key so a slow load does not block lookups of other models
+_load_locks = {}
+
+
+def normalize_language(language):
+    """Map a user supplied language code to the short code used by the registry"""
+    language = (language or 'en').strip().lower()
+    return LANGUAGE_ALIASES.get(language, language.split('-')[0])
+
+
+def _directory_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def _evict(keep_key):
+    """Drop least recently used models until the memory limit is respected"""
+    if MODEL_MEMORY_LIMIT_MB <= 0:
+        return
+    limit = MODEL_MEMORY_LIMIT_MB * 1024 * 1024
+    total = sum(size for _, size in _models.values())
+    for key in list(_models):
+        if total <= limit:
+            break
+        if key == keep_key:
+            continue
+        _, size = _models.pop(key)
+        total -= size
+        logging.info(f"Evicted speech model {key} ({size // (1024 * 1024)} MB)")
+
+
+def _get_or_load(key, loader):
+    with _lock:
+        if key in _models:
+            _models.move_to_end(key)
+            return _models[key][0]
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        # Another thread may have finished loading while we waited
+        with _lock:
+            if key in _models:
+                _models.move_to_end(key)
+                return _models[key][0]
+
+        model, size = loader()
+        logging.info(f"Loaded speech model {key} ({size // (1024 * 1024)} MB)")
+        with _lock:
+            _models[key] = (model, size)
+            _evict(keep_key=key)
+        return model
+
+
+def get_whisper_model(size=None, language=None):
+    """
+    Return a process-wide Whisper model, loading it on first use. The size configured for
+    the language is only used when a language is given, otherwise WHISPER_MODEL_SIZE.
+    """
+    if size is None:
+        size = WHISPER_LANGUAGE_SIZES.get(normalize_language(language), WHISPER_MODEL_SIZE) if language else WHISPER_MODEL_SIZE
+
+    def loader():
+        import whisper
+        model = whisper.load_model(size, device=WHISPER_DEVICE)
+        nbytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        return model, nbytes
+
+    return _get_or_load(('whisper', size), loader)
+
+
+def get_vosk_model(language='en'):
+    """Return a process-wide Vosk model for the given language"""
+    language = normalize_language(language)
+    if language not in VOSK_MODELS:
+        raise ValueError(f"No Vosk model available for language: {language}")
+    model_path = VOSK_MODELS[language]
+
+    def loader():
+        from vosk import Model
+        return Model(str(model_path)), _directory_size(model_path)
+
+    return _get_or_load(('vosk', language), loader)
+
+
+def loaded_models():
+    """Return (key, size in bytes) of resident models, least recently used first"""
+    with _lock:
+        return [(key, size) for key, (_, size) in _models.items()]
+
+
+def unload_all():
+    with _lock:
+        _models.clear()
+
+
+@contextmanager
+def _single_threaded_torch():
+    """
+    Keep torch from starting its OpenMP thread pool while models load: a pool started in
+    the gunicorn master does not survive fork, and the workers would hang on their first transcription
+    """
+    import torch
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(threads)
+
+
+def warm_up(spec=None):
+    """
+    Load the models listed in spec (default SPEECH_MODEL_PRELOAD) so the first
+    request does not pay the loading cost, e.g. "whisper:base,vosk:en,vosk:zh".
+    Safe to call in a process that forks workers afterwards (gunicorn preload_app).
+    """
+    spec = SPEECH_MODEL_PRELOAD if spec is None else spec
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        kind, _, name = item.partition(':')
+        try:
+            if kind == 'whisper':
+                with _single_threaded_torch():
+                    get_whisper_model(size=name or None)
+            elif kind == 'vosk':
+                get_vosk_model(name or 'en')
+            else:
+                logging.warning(f"Unknown speech model in preload list: {item}")
+        except Exception as e:
+            logging.error(f"Speech model warm-up failed for {item}: {str(e)}")
@@ -0,0 +1,242 @@
+import os
+import logging
+import importlib.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+OCR_LANGUAGE = os.getenv('OCR_LANGUAGE', 'eng')
+# Images are downscaled to this resolution (when the file carries DPI information) and never larger than OCR_MAX_SIDE
+OCR_TARGET_DPI = int(os.getenv('OCR_TARGET_DPI', '300'))
+OCR_MAX_SIDE = int(os.getenv('OCR_MAX_SIDE', '2000'))
+# Threads OCR-ing crops in parallel, each with its own tesseract handle
+OCR_THREADS = int(os.getenv('OCR_THREADS', '4'))
+# Fixed text regions as fractions of the frame "left,top,right,bottom;...", e.g. header and caption bands
+# of a known ultrasound layout: "0,0,1,0.12;0,0.88,1,1". Empty means detect them automatically.
+OCR_REGIONS = os.getenv('OCR_REGIONS', '')
+
+# Row ink density of text lines; denser rows are image content (the ultrasound sector), sparser ones noise
+MIN_ROW_INK = 0.005
+MAX_ROW_INK = 0.35
+BAND_PADDING = 4
+# Crops of small text are enlarged, tesseract is most accurate with glyphs at least ~20 px high
+MIN_CROP_HEIGHT = 40
+# White space between the regions of a frame stacked for a single pytesseract call
+STACK_GAP = 20
+
+_local = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _tesseract_api():
+    """
+    One persistent tesseract handle per thread, so the language data is loaded once
+    instead of starting a tesseract process for every image. None if tesserocr is not installed.
+    """
+    if not hasattr(_local, 'api'):
+        try:
+            from tesserocr import PyTessBaseAPI, PSM
+            _local.api = PyTessBaseAPI(lang=OCR_LANGUAGE, psm=PSM.SINGLE_BLOCK)
+        except ImportError:
+            logging.warning("tesserocr is not installed, falling back to the pytesseract subprocess")
+            _local.api = None
+    return _local.api
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=OCR_THREADS, thread_name_prefix='ocr')
+        return _pool
+
+
+def load_frames(source):
+    """
+    Return every frame of an image file as a PIL image: multi-page TIFFs give one image per page,
+    DICOM files one per frame (requires pydicom), other formats a single image
+    """
+    from PIL import Image, ImageSequence
+    if hasattr(source, 'read'):
+        header = source.read(132)
+        source.seek(0)
+    else:
+        with open(source, 'rb') as f:
+            header = f.read(132)
+    if header[128:132] == b'DICM':
+        import numpy as np
+        import pydicom
+        dataset = pydicom.dcmread(source)
+        pixels = dataset.pixel_array
+        frames = pixels if getattr(dataset, 'NumberOfFrames', 1) > 1 else [pixels]
+        images = []
+        for frame in frames:
+            frame = frame.astype(np.float32)
+            frame = (frame - frame.min()) / max(float(frame.max() - frame.min()), 1.0) * 255
+            images.append(Image.fromarray(frame.astype(np.uint8)))
+        return images
+
+    image = Image.open(source)
+    return [frame.copy() for frame in ImageSequence.Iterator(image)]
+
+
+def preprocess(image):
+    """Grayscale, downscale and binarize to dark text on a light background"""
+    from PIL import Image, ImageOps
+    dpi = image.info.get('dpi', (0, 0))[0]
+    image = ImageOps.exif_transpose(image).convert('L')
+
+    scale = 1.0
+    if dpi and dpi > OCR_TARGET_DPI:
+        scale = OCR_TARGET_DPI / dpi
+    scale = min(scale, OCR_MAX_SIDE / max(image.size))
+    if scale < 1.0:
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+    # Ultrasound screenshots are mostly dark with light text
+    histogram = image.histogram()
+    total = sum(histogram)
+    if sum(histogram[:128]) > total / 2:
+        image = ImageOps.invert(image)
+    image = ImageOps.autocontrast(image)
+
+    # Otsu threshold
+    histogram = image.histogram()
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background, weight_background, best_threshold, best_variance = 0, 0, 128, 0.0
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_variance, best_threshold = variance, level
+    return image.point(lambda value: 255 if value > best_threshold else 0, mode='L')
+
+
+def _configured_regions(image):
+    regions = []
+    for item in filter(None, (part.strip() for part in OCR_REGIONS.split(';'))):
+        left, top, right, bottom = (float(v) for v in item.split(','))
+        regions.append((int(left * image.width), int(top * image.height),
+                        int(right * image.width), int(bottom * image.height)))
+    return regions
+
+
+def detect_text_regions(image):
+    """
+    Find horizontal bands that look like text lines in a binarized image with a row ink
+    profile, and trim each band to the columns that contain ink. Dense image content such
+    as the ultrasound sector itself is skipped.
+    """
+    width, height = image.size
+    ink = image.point(lambda value: 1 if value == 0 else 0)
+    data = ink.tobytes()
+    row_ink = [data[y * width:(y + 1) * width].count(1) / width for y in range(height)]
+
+    bands = []
+    start = None
+    for y, density in enumerate(row_ink + [0.0]):
+        is_text = MIN_ROW_INK < density < MAX_ROW_INK
+        if is_text and start is None:
+            start = y
+        elif not is_text and start is not None:
+            # Lines are at least a few pixels and not taller than a tenth of the frame
+            if 4 <= y - start <= max(height // 10, 20):
+                bands.append((start, y))
+            start = None
+
+    # Merge lines that belong to the same text block
+    merged = []
+    for top, bottom in bands:
+        if merged and top - merged[-1][1] <= BAND_PADDING * 2:
+            merged[-1] = (merged[-1][0], bottom)
+        else:
+            merged.append((top, bottom))
+
+    regions = []
+    for top, bottom in merged:
+        top, bottom = max(0, top - BAND_PADDING), min(height, bottom + BAND_PADDING)
+        box = ink.crop((0, top, width, bottom)).getbbox()
+        if box:
+            regions.append((max(0, box[0] - BAND_PADDING), top, min(width, box[2] + BAND_PADDING), bottom))
+    return regions
+
+
+def _has_tesserocr():
+    return importlib.util.find_spec('tesserocr') is not None
+
+
+def _ocr_crop(image):
+    api = _tesseract_api()
+    if api is None:
+        import pytesseract
+        return pytesseract.image_to_string(image, lang=OCR_LANGUAGE, config='--psm 6')
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+
+def _stack_crops(crops):
+    """
+    The regions of a frame one below the other on a white page, so pytesseract reads them
+    with one tesseract process instead of one per region
+    """
+    from PIL import Image
+    if len(crops) == 1:
+        return crops[0]
+    width = max(crop.width for crop in crops)
+    height = sum(crop.height for crop in crops) + STACK_GAP * (len(crops) - 1)
+    page = Image.new('L', (width, height), 255)
+    top = 0
+    for crop in crops:
+        page.paste(crop, (0, top))
+        top += crop.height + STACK_GAP
+    return page
+
+
+def _frame_crops(image):
+    from PIL import Image
+    binary = preprocess(image)
+    regions = _configured_regions(binary) or detect_text_regions(binary)
+    if not regions:
+        # Nothing that looks like text lines, let tesseract look at the whole frame
+        regions = [(0, 0, binary.width, binary.height)]
+    crops = []
+    for box in regions:
+        crop = binary.crop(box)
+        if crop.height < MIN_CROP_HEIGHT:
+            crop = crop.resize((crop.width * 2, crop.height * 2), Image.NEAREST)
+        crops.append(crop)
+    return crops
+
+
+def ocr_frames(frames):
+    """
+    OCR the text regions of all frames as one parallel batch and return the text of
+    each frame, regions top to bottom
+    """
+    crops = []
+    for index, frame in enumerate(frames):
+        frame_crops = _frame_crops(frame)
+        if _has_tesserocr():
+            crops.extend((index, crop) for crop in frame_crops)
+        else:
+            # Starting tesseract costs more than reading a region, one process per frame
+            crops.append((index, _stack_crops(frame_crops)))
+    texts = _get_pool().map(_ocr_crop, [crop for _, crop in crops])
+    results = [[] for _ in frames]
+    for (index, _), text in zip(crops, texts):
+        if text.strip():
+            results[index].append(text.strip())
+    return ['\n'.join(lines) for lines in results]
+
+
+def ocr_image(source):
+    """OCR every frame of an image file (path or binary file object) and return the combined text"""
+    return '\n\n'.join(filter(None, ocr_frames(load_frames(source))))
@@ -0,0 +1,249 @@
+import os
+import atexit
+import queue
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import time
+from pathlib import Path
+
+# LibreOffice executable used for headless conversion
+SOFFICE_BINARY = os.getenv('SOFFICE_BINARY', 'soffice')
+# Number of long-lived LibreOffice listener processes per server process
+PDF_CONVERTER_POOL_SIZE = int(os.getenv('PDF_CONVERTER_POOL_SIZE', '2'))
+PDF_CONVERTER_BASE_PORT = int(os.getenv('PDF_CONVERTER_BASE_PORT', '2002'))
+PDF_CONVERSION_TIMEOUT = int(os.getenv('PDF_CONVERSION_TIMEOUT', '120'))
+
+
+class ConversionError(Exception):
+    """Raised when a DOCX file could not be converted to PDF"""
+
+
+class ConversionTimeout(ConversionError):
+    """Raised when a conversion took longer than PDF_CONVERSION_TIMEOUT"""
+
+
+def _free_port(start):
+    """First port from start on that nothing listens on (pools of several workers must not collide)"""
+    port = start
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if s.connect_ex(('127.0.0.1', port)) != 0:
+                return port
+        port += 1
+
+
+class OfficeInstance:
+    """One headless LibreOffice process in listener mode, driven over the UNO bridge"""
+
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+        self.desktop = None
+        self.profile_dir = tempfile.mkdtemp(prefix='soffice-profile-')
+
+    def start(self):
+        # Another worker process may have taken the port since the pool was created
+        self.port = _free_port(self.port)
+        self.process = subprocess.Popen(
+            [
+                SOFFICE_BINARY, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault',
+                f'-env:UserInstallation={Path(self.profile_dir).as_uri()}',
+                f'--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+            ],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.desktop = self._connect()
+        logging.info(f"Started LibreOffice converter on port {self.port}")
+
+    def _connect(self):
+        import uno
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_context
+        )
+        url = f'uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext'
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                context = resolver.resolve(url)
+                return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+            except Exception:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    raise ConversionError(f'LibreOffice did not start on port {self.port}')
+                time.sleep(0.2)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        self.desktop = None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def convert(self, docx_path, pdf_path):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def prop(name, value):
+            p = PropertyValue()
+            p.Name = name
+            p.Value = value
+            return p
+
+        if not self.alive():
+            self.start()
+        # UNO calls cannot be interrupted, a hung office process is killed so the call fails
+        process = self.process
+        timed_out = threading.Event()
+
+        def kill_hung():
+            timed_out.set()
+            process.kill()
+
+        watchdog = threading.Timer(PDF_CONVERSION_TIMEOUT, kill_hung)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(docx_path)), '_blank', 0, (prop('Hidden', True),)
+            )
+            try:
+                document.storeToURL(
+                    uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                    (prop('FilterName', 'writer_pdf_Export'),)
+                )
+            finally:
+                if not timed_out.is_set():
+                    document.close(True)
+        except Exception:
+            if timed_out.is_set():
+                raise ConversionTimeout(f'Conversion took longer than {PDF_CONVERSION_TIMEOUT} seconds')
+            raise
+        finally:
+            watchdog.cancel()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Create the converter pool on first use; instances start lazily"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = queue.Queue()
+            port = PDF_CONVERTER_BASE_PORT
+            for _ in range(PDF_CONVERTER_POOL_SIZE):
+                port = _free_port(port)
+                _pool.put(OfficeInstance(port))
+                port += 1
+        return _pool
+
+
+def _uno_available():
+    try:
+        import uno  # noqa: F401
+        return shutil.which(SOFFICE_BINARY) is not None
+    except ImportError:
+        return False
+
+
+def _convert_with_pool(docx_path, pdf_path):
+    pool = _get_pool()
+    try:
+        instance = pool.get(timeout=PDF_CONVERSION_TIMEOUT)
+    except queue.Empty:
+        raise ConversionError('No PDF converter available')
+    try:
+        try:
+            instance.convert(docx_path, pdf_path)
+        except ConversionTimeout:
+            # The killed process is restarted by the next conversion, this document is not tried again
+            instance.stop()
+            raise
+        except Exception as e:
+            # The office process may have crashed, restart it once and retry
+            logging.error(f"PDF conversion on port {instance.port} failed, restarting converter: {str(e)}")
+            instance.stop()
+            instance.convert(docx_path, pdf_path)
+    finally:
+        pool.put(instance)
+
+
+def check_converter():
+    """Log at startup which converter PDF reports will use, warning about the slow fallback"""
+    if _uno_available():
+        return
+    if shutil.which(SOFFICE_BINARY):
+        logging.warning(
+            "python3-uno is not installed: every PDF conversion starts its own LibreOffice process. "
+            "Install python3-uno to use the converter pool"
+        )
+    else:
+        logging.warning(f"LibreOffice ({SOFFICE_BINARY}) not found: PDF conversion needs docx2pdf with Microsoft Word")
+
+
+def _convert_with_cli(docx_path, pdf_path):
+    """One-shot soffice conversion, used when the UNO bridge is not installed"""
+    with tempfile.TemporaryDirectory() as out_dir, tempfile.TemporaryDirectory(prefix='soffice-profile-') as profile:
+        subprocess.run(
+            [
+                SOFFICE_BINARY, '--headless', f'-env:UserInstallation={Path(profile).as_uri()}',
+                '--convert-to', 'pdf', '--outdir', out_dir, os.path.abspath(docx_path)
+            ],
+            check=True, timeout=PDF_CONVERSION_TIMEOUT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        shutil.move(os.path.join(out_dir, Path(docx_path).with_suffix('.pdf').name), pdf_path)
+
+
+def convert_docx_to_pdf(docx_path, pdf_path):
+    """
+    Convert a rendered DOCX report to PDF. The PDF is written to a temporary file
+    first and moved into place, so readers never see a partial file.
+    """
+    tmp_path = f'{pdf_path}.{os.getpid()}.{threading.get_ident()}.tmp.pdf'
+    try:
+        if _uno_available():
+            _convert_with_pool(docx_path, tmp_path)
+        elif shutil.which(SOFFICE_BINARY):
+            _convert_with_cli(docx_path, tmp_path)
+        else:
+            # Windows / macOS with Microsoft Word installed
+            from docx2pdf import convert
+            convert(docx_path, tmp_path)
+        os.replace(tmp_path, pdf_path)
+        return pdf_path
+    except Exception as e:
+        raise ConversionError(f'Failed to convert {docx_path} to PDF: {str(e)}') from e
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def shutdown():
+    """Stop all LibreOffice processes of this server process"""
+    if _pool is None:
+        return
+    while True:
+        try:
+            instance = _pool.get_nowait()
+        except queue.Empty:
+            break
+        instance.stop()
+        shutil.rmtree(instance.profile_dir, ignore_errors=True)
+
+
+atexit.register(shutdown)
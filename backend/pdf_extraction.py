@@ -0,0 +1,229 @@
+import os
+import io
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import result_cache
+from ocr_engine import OCR_LANGUAGE
+from upload_spool import SPOOL_DIR
+
+# Worker processes extracting pages of the text layer in parallel
+PDF_PAGE_PROCESSES = int(os.getenv('PDF_PAGE_PROCESSES', str(min(4, os.cpu_count() or 1))))
+# Pages handed to one worker at a time
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '4'))
+# Stop once this many characters are extracted, the LLM prompt cannot use more (0 = no limit)
+PDF_CHAR_BUDGET = int(os.getenv('PDF_CHAR_BUDGET', '20000'))
+# Resolution scanned pages are rasterized at for OCR
+PDF_OCR_DPI = int(os.getenv('PDF_OCR_DPI', '300'))
+# Pages with fewer characters in their text layer are treated as scanned images
+MIN_TEXT_LAYER_CHARS = 20
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: worker processes must not be forked from a threaded server process
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_PAGE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+def _hash_object(digest, obj, seen):
+    """Feed a PDF object into digest, following references (each object once) and including stream data"""
+    from pdfminer.pdftypes import PDFObjRef, PDFStream
+    from pdfminer.psparser import PSLiteral, PSKeyword
+
+    if isinstance(obj, PDFObjRef):
+        # Repeated references by order of appearance, object numbers differ between files
+        if obj.objid in seen:
+            digest.update(f'ref {seen[obj.objid]};'.encode('utf-8'))
+            return
+        seen[obj.objid] = len(seen)
+        obj = obj.resolve()
+    if isinstance(obj, PDFStream):
+        digest.update(b'stream(')
+        _hash_object(digest, obj.attrs, seen)
+        digest.update(obj.get_rawdata() or b'')
+        digest.update(b')')
+    elif isinstance(obj, dict):
+        digest.update(b'{')
+        for key in sorted(obj):
+            digest.update(f'/{key} '.encode('utf-8'))
+            _hash_object(digest, obj[key], seen)
+        digest.update(b'}')
+    elif isinstance(obj, list):
+        digest.update(b'[')
+        for item in obj:
+            _hash_object(digest, item, seen)
+        digest.update(b']')
+    elif isinstance(obj, (PSLiteral, PSKeyword)):
+        name = obj.name.decode('latin-1') if isinstance(obj.name, bytes) else str(obj.name)
+        digest.update(f'/{name};'.encode('utf-8'))
+    else:
+        digest.update(f'{obj!r};'.encode('utf-8'))
+
+
+def _page_digests(path):
+    """
+    SHA-256 of every page's content streams and resources, so identical pages are recognized
+    across documents and re-uploads. The resources include the fonts with their encodings and
+    ToUnicode maps, which decide what text the same glyph codes stand for, and the embedded
+    images, in which scanned pages usually differ while sharing the same content stream.
+    """
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+
+    digests = []
+    with open(path, 'rb') as f:
+        document = PDFDocument(PDFParser(f))
+        for page in PDFPage.create_pages(document):
+            digest = hashlib.sha256()
+            contents = page.contents if isinstance(page.contents, list) else [page.contents]
+            seen = {}
+            for stream in contents:
+                _hash_object(digest, stream, seen)
+            digest.update(b'resources')
+            _hash_object(digest, page.resources or {}, seen)
+            digests.append(digest.hexdigest())
+    return digests
+
+
+def _extract_page_texts(path, page_numbers):
+    """
+    Text layer of the given (0-based) pages; runs in a worker process, which opens the
+    file and parses the document once for all of them
+    """
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+
+    wanted = set(page_numbers)
+    texts = {}
+    with open(path, 'rb') as f:
+        document = PDFDocument(PDFParser(f))
+        manager = PDFResourceManager()
+        for number, page in enumerate(PDFPage.create_pages(document)):
+            if number not in wanted:
+                continue
+            # Same conversion as pdfminer.high_level.extract_text
+            output = io.StringIO()
+            device = TextConverter(manager, output, laparams=LAParams())
+            PDFPageInterpreter(manager, device).process_page(page)
+            device.close()
+            texts[number] = output.getvalue()
+            if len(texts) == len(wanted):
+                break
+    return [texts.get(number, '') for number in page_numbers]
+
+
+def _ocr_pages(path, page_numbers):
+    """
+    Rasterize pages without text layer and OCR them as one batch, so the regions of all
+    pages are recognized concurrently in the OCR pool (requires pdf2image and poppler)
+    """
+    try:
+        from pdf2image import convert_from_path
+    except ImportError:
+        logging.warning("pdf2image is not installed, scanned PDF pages cannot be OCR'd")
+        return ['' for _ in page_numbers]
+    from ocr_engine import ocr_frames
+    pages = [
+        convert_from_path(path, dpi=PDF_OCR_DPI, first_page=number + 1, last_page=number + 1)
+        for number in page_numbers
+    ]
+    texts = iter(ocr_frames([image for images in pages for image in images]))
+    return ['\n'.join(next(texts) for _ in images) for images in pages]
+
+
+def extract_pdf_text(source, char_budget=None):
+    """
+    Extract the text of a PDF (path or binary file object) page by page: pages with a
+    text layer are parsed concurrently in worker processes, pages without one are OCR'd.
+    Page results are cached by page content hash, and extraction stops early once
+    char_budget characters (default PDF_CHAR_BUDGET, 0 = no limit) are collected.
+    """
+    char_budget = PDF_CHAR_BUDGET if char_budget is None else char_budget
+    if not hasattr(source, 'read'):
+        return _extract_pdf_path(os.path.abspath(source), char_budget)
+
+    # Worker processes open the document by path instead of receiving its bytes with every task
+    fd, path = tempfile.mkstemp(suffix='.pdf', dir=SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(source.open() if hasattr(source, 'open') else source, f)
+        return _extract_pdf_path(path, char_budget)
+    finally:
+        os.remove(path)
+
+
+def _extract_pdf_path(path, char_budget):
+    digests = _page_digests(path)
+    keys = [result_cache.make_key('pdf_page', digest, OCR_LANGUAGE) for digest in digests]
+    texts = [result_cache.get_json('text', key) for key in keys]
+    missing = [index for index, text in enumerate(texts) if text is None]
+    batches = [missing[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(missing), PDF_PAGES_PER_TASK)]
+
+    def collected():
+        # Characters of the leading pages that are already known
+        length = 0
+        for text in texts:
+            if text is None:
+                break
+            length += len(text)
+        return length
+
+    pool = _get_pool()
+    # Keep only a few batches in flight so pages past the budget are never parsed
+    window = PDF_PAGE_PROCESSES * 2
+    pending = []
+    scanned_pages = 0
+    while batches or pending:
+        if char_budget and collected() >= char_budget:
+            for _, future in pending:
+                future.cancel()
+            break
+        while batches and len(pending) < window:
+            page_numbers = batches.pop(0)
+            pending.append((page_numbers, pool.submit(_extract_page_texts, path, page_numbers)))
+        page_numbers, future = pending.pop(0)
+        batch = dict(zip(page_numbers, future.result()))
+        # No text layer, the pages are scanned images
+        scanned = [number for number, text in batch.items() if len(text.strip()) < MIN_TEXT_LAYER_CHARS]
+        scanned_pages += len(scanned)
+        for number, ocr_text in zip(scanned, _ocr_pages(path, scanned) if scanned else []):
+            if len(ocr_text.strip()) > len(batch[number].strip()):
+                batch[number] = ocr_text
+        for number, text in batch.items():
+            texts[number] = text
+            # Empty pages are retried next time, OCR may become available
+            if text.strip():
+                result_cache.put_json('text', keys[number], text)
+
+    pages = []
+    for text in texts:
+        if text is None:
+            logging.info(f"PDF extraction stopped after {len(pages)} of {len(texts)} pages (character budget)")
+            break
+        pages.append(text)
+    result = '\n'.join(pages)
+    if not result.strip():
+        if scanned_pages:
+            logging.warning(f"PDF has no text layer and OCR found no text on its {scanned_pages} scanned pages")
+        else:
+            logging.warning("PDF contains no extractable text")
+    return result[:char_budget] if char_budget else result
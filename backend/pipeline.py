@@ -0,0 +1,346 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from text_processing import process_image, process_audio, process_text, process_pdf, process_docx
+from ai_processing import generate_report_with_ai, enhance_text_with_ai, generate_structured_report, AI_PIPELINE_MODE, AI_MODEL, PROMPT_VERSION, REPORT_KEYS, FREE_TEXT_KEYS, validate_report_field
+from field_extraction import extract_fields
+from document_chunking import count_tokens, split_into_chunks, merge_partial_reports, LLM_CHUNK_TOKENS, LLM_CHUNK_WORKERS
+from report_generation import render_docx, ensure_pdf, report_paths, PDF_MODE
+from template_engine import get_template, template_version, DEFAULT_TEMPLATE
+from model_registry import WHISPER_MODEL_SIZE, WHISPER_LANGUAGE_SIZES, normalize_language
+from pdf_extraction import PDF_CHAR_BUDGET
+import result_cache
+import report_store
+import metrics
+from upload_spool import SpooledUpload
+
+# Select processor based on file extension
+processors = {
+    'jpg': process_image,
+    'jpeg': process_image,
+    'png': process_image,
+    'tif': process_image,
+    'tiff': process_image,
+    'dcm': process_image,
+    'wav': process_audio,
+    'mp3': process_audio,
+    'pdf': process_pdf,
+    'docx': process_docx,
+    'txt': process_text
+}
+
+# Per-report locks, corrections of one report are applied and rendered one at a time;
+# report ID -> [lock, number of corrections holding or waiting for it]
+_update_locks = {}
+_update_locks_guard = threading.Lock()
+
+
+def get_extension(filename):
+    return filename.split('.')[-1].lower()
+
+
+def function_version(fn):
+    """
+    Version of a processing function for cache keys: the hash of its source, which includes
+    the prompt strings, so editing a prompt invalidates its cached outputs. Identical in every
+    process, unlike the repr of code objects (it contains memory addresses).
+    """
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        # No source shipped, fall back to the bytecode
+        source = fn.__code__.co_code.hex()
+    return hashlib.sha256(f'{fn.__module__}.{fn.__qualname__}\n{source}'.encode('utf-8')).hexdigest()
+
+
+def source_digest(source):
+    """Content hash of an upload, the key of its cached text and of its reports in the report store"""
+    return source.sha256 if isinstance(source, SpooledUpload) else result_cache.hash_file(source)
+
+
+def _extract_text(source, ext, language, on_partial=None):
+    if isinstance(source, SpooledUpload):
+        source = source.open()
+    if processors[ext] is process_audio:
+        return process_audio(source, language, format=ext, on_partial=on_partial)
+    return processors[ext](source)
+
+
+def extract_text(source, ext, language=None, on_partial=None):
+    """
+    Run the OCR / speech recognition / text reading / PDF extraction stage.
+    source: path of a saved file or a SpooledUpload held in memory / a request spool file
+    language: language of audio, None to let Whisper detect it
+    on_partial: optional callback receiving partial transcripts of long recordings
+    """
+    processor = processors[ext]
+    if processor is process_audio:
+        language = normalize_language(language) if language else None
+        version = (language or 'auto', WHISPER_LANGUAGE_SIZES.get(language, WHISPER_MODEL_SIZE))
+    elif processor is process_pdf:
+        version = (PDF_CHAR_BUDGET,)
+    else:
+        version = ()
+    key = result_cache.make_key(source_digest(source), ext, processor.__name__, *version)
+    # Empty text means the processor failed, retry it next time
+    with metrics.timed('extract', ext):
+        text = result_cache.cached_json('text', key, lambda: _extract_text(source, ext, language, on_partial), should_cache=bool)
+    metrics.log_payload(f"Extracted text ({ext})", text)
+    return text
+
+
+def _llm_key(fn, text, *keys):
+    return result_cache.make_key(fn.__name__, AI_MODEL, PROMPT_VERSION, function_version(fn), text, *keys)
+
+
+def _has_known_fields(data):
+    # generate_report_with_ai falls back to all-"unknown" data when the model call fails
+    return any(value != 'unknown' for value in data.values())
+
+
+def _structure_with_model(text, keys, ai_mode=None, on_stage=None):
+    """
+    Ask the model for the given report keys, either with two generations (enhance,
+    then structure) or with a single streamed generation
+    """
+    if (ai_mode or AI_PIPELINE_MODE) == 'single_pass':
+        if on_stage:
+            on_stage('structure')
+        with metrics.timed('structure', 'single_pass'):
+            return result_cache.cached_json(
+                'llm', _llm_key(generate_structured_report, text, *keys),
+                lambda: generate_structured_report(text, keys=keys)[1], should_cache=_has_known_fields
+            )
+
+    if on_stage:
+        on_stage('enhance')
+    # enhance_text_with_ai returns its input unchanged when the model call fails
+    with metrics.timed('enhance'):
+        enhanced_text = result_cache.cached_json(
+            'llm', _llm_key(enhance_text_with_ai, text),
+            lambda: enhance_text_with_ai(text), should_cache=lambda value: value != text
+        )
+    if on_stage:
+        on_stage('structure')
+    with metrics.timed('structure', 'two_pass'):
+        return result_cache.cached_json(
+            'llm', _llm_key(generate_report_with_ai, enhanced_text, *keys),
+            lambda: generate_report_with_ai(enhanced_text, keys=keys), should_cache=_has_known_fields
+        )
+
+
+def structure_text(text, ai_mode=None, on_stage=None):
+    """
+    Turn extracted text into structured report data. Header fields printed as "Label: value" are
+    read with the field_extraction rules and the model is only asked for the rest. It is always
+    called, the free-text fields (findings, diagnosis, comment) are never settled by rules.
+    Texts over LLM_CHUNK_TOKENS are split into overlapping sections that are structured
+    concurrently and merged.
+    """
+    with metrics.timed('field_extraction'):
+        layout, fields, remaining = extract_fields(text)
+    missing = [key for key in REPORT_KEYS if key not in fields]
+    if fields:
+        logging.debug(f"{len(fields)} report fields read with the {layout} layout, asking the model for {missing}")
+        text = remaining
+
+    if count_tokens(text) <= LLM_CHUNK_TOKENS:
+        return _merge_fields(_structure_with_model(text, missing, ai_mode, on_stage), fields)
+
+    chunks = split_into_chunks(text)
+    logging.info(f"Structuring {len(chunks)} sections of a {count_tokens(text)} token text")
+    if on_stage:
+        on_stage('structure')
+    with ThreadPoolExecutor(max_workers=LLM_CHUNK_WORKERS) as pool:
+        partials = list(pool.map(lambda chunk: _structure_with_model(chunk, missing, ai_mode), chunks))
+    return _merge_fields(merge_partial_reports(partials, missing), fields)
+
+
+def _merge_fields(data, fields):
+    """Model output completed with the fields read by the rules, in template order"""
+    merged = {**data, **fields}
+    ordered = {key: merged[key] for key in REPORT_KEYS if key in merged}
+    ordered.update((key, value) for key, value in merged.items() if key not in ordered)
+    return ordered
+
+
+def _copy_into_place(source, path):
+    """
+    Replace path with a copy of source. Stored reports are hard links to their blob, writing
+    into the existing file would change the blob and every report sharing it.
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def render_reports(structured_data, report_id, original_filename, template_name=None):
+    """
+    Render the DOCX report once under TESTGEN/reports/ and derive the PDF from it,
+    now (PDF_MODE=eager) or on first download (PDF_MODE=lazy). Artifacts rendered
+    earlier from identical data with the same template are reused.
+    """
+    key = result_cache.make_key(
+        template_name or DEFAULT_TEMPLATE, template_version(template_name), function_version(render_docx),
+        json.dumps(structured_data, sort_keys=True, ensure_ascii=False)
+    )
+    docx_path, pdf_path = report_paths(report_id)
+
+    cached_docx = result_cache.get_file('render', key, 'docx')
+    if cached_docx:
+        _copy_into_place(cached_docx, docx_path)
+    else:
+        # render_docx formats the data in place, give it a copy
+        render_docx(dict(structured_data), report_id, template_name)
+        result_cache.put_file('render', key, 'docx', docx_path)
+    report_store.add_artifact(report_id, 'docx', docx_path)
+    # The PDF of an earlier version no longer matches the DOCX
+    report_store.discard_artifact(report_id, 'pdf')
+
+    if PDF_MODE != 'eager':
+        return
+    cached_pdf = result_cache.get_file('render', key, 'pdf')
+    if cached_pdf:
+        _copy_into_place(cached_pdf, pdf_path)
+        report_store.add_artifact(report_id, 'pdf', pdf_path)
+        return
+    try:
+        # Stored in the report store by ensure_pdf
+        ensure_pdf(report_id)
+        result_cache.put_file('render', key, 'pdf', pdf_path)
+    except Exception as e:
+        # The DOCX is still available, the PDF can be converted again on download
+        logging.error(f"Failed to convert DOCX to PDF: {str(e)}")
+
+
+def build_report(text, original_filename, report_id=None, on_stage=None, ai_mode=None, template_name=None,
+                 source_hash=None):
+    """
+    Run enhance -> structure -> render on already extracted text and return
+    the same payload /process responds with.
+    source_hash: content hash of the upload the text came from, recorded in the report store
+    """
+    # Call AI to generate structured report data
+    structured_data = structure_text(text, ai_mode, on_stage)
+    metrics.log_payload("Structured data from AI", structured_data)
+    if not structured_data:
+        raise RuntimeError('AI report generation failed')
+
+    # Generate report files and store in TESTGEN/reports/
+    if on_stage:
+        on_stage('render')
+    report_id = report_id or str(uuid.uuid4())
+    version = report_store.record_report(report_id, structured_data, source_hash, original_filename, template_name)
+    # Generate the DOCX, and the PDF from it
+    render_reports(structured_data, report_id, original_filename, template_name)
+    logging.info(f"Report {report_id} generated from {original_filename}")
+    return _report_payload(report_id, structured_data, version)
+
+
+def _report_payload(report_id, data, version):
+    return {
+        'reportId': report_id,
+        'downloadUrl_docx': f'/download/{report_id}?format=docx',
+        'downloadUrl_pdf': f'/download/{report_id}?format=pdf',
+        'data': data,
+        'version': version
+    }
+
+
+def update_report(report_id, fields, base_version=None, template_name=None):
+    """
+    Apply corrected fields to a stored report and render it again, without extracting
+    text or calling the model. The artifacts are only rendered again when a changed
+    field appears in the template, or when the template changes.
+    fields: {key: new value} of the fields to change, other fields keep their value
+    base_version: version the correction was made on; VersionConflictError if the
+                  report changed since (omit to apply it to the latest version)
+    template_name: render with another template from now on
+    return: the payload /process responds with, for the new version
+    """
+    unknown = [key for key in fields if key not in REPORT_KEYS]
+    if unknown:
+        raise ValueError(f"Unknown report fields: {', '.join(unknown)}")
+    invalid = [
+        key for key, value in fields.items()
+        if not (value is None or isinstance(value, str) or (key in FREE_TEXT_KEYS and isinstance(value, (list, dict))))
+    ]
+    if invalid:
+        raise ValueError(f"Values must be strings (lists or objects only for free-text fields): {', '.join(invalid)}")
+    # Cleaned like model output; an empty value clears the field
+    fields = {key: validate_report_field(key, value) or 'unknown' for key, value in fields.items()}
+
+    with _update_locks_guard:
+        entry = _update_locks.setdefault(report_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            return _apply_update(report_id, fields, base_version, template_name)
+    finally:
+        # Dropped with its last user, so the dict does not grow with every report ever corrected
+        with _update_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                _update_locks.pop(report_id, None)
+
+
+def _apply_update(report_id, fields, base_version, template_name):
+    report = report_store.get_report(report_id)
+    current = report_store.get_version(report_id)
+    if report is None or current is None:
+        raise report_store.ReportNotFoundError(f'Unknown report: {report_id}')
+    if base_version is not None and base_version != current['version']:
+        raise report_store.VersionConflictError(
+            f"Report {report_id} is at version {current['version']}, not {base_version}"
+        )
+
+    old_template = report['template'] or DEFAULT_TEMPLATE
+    template_name = template_name or old_template
+    template = get_template(template_name)
+    changed = [key for key, value in fields.items() if current['data'].get(key) != value]
+    if not changed and template_name == old_template:
+        return _report_payload(report_id, current['data'], current['version'])
+
+    data = _merge_fields(current['data'], {key: fields[key] for key in changed})
+    # Rendered before the version is recorded, so a failed render leaves the report at its last good version
+    rerender = template_name != old_template or any(key in template.placeholders for key in changed)
+    if rerender:
+        with metrics.timed('rerender'):
+            render_reports(data, report_id, report['source_filename'], template_name)
+    try:
+        version = report_store.record_report(
+            report_id, data, template_name=template_name, changed_fields=changed, base_version=current['version']
+        )
+    except Exception:
+        # Another process recorded a version first; put back the artifacts of the stored data
+        if rerender:
+            latest = report_store.get_version(report_id)
+            render_reports(latest['data'], report_id, report['source_filename'],
+                           report_store.get_report(report_id)['template'] or DEFAULT_TEMPLATE)
+        raise
+    logging.info(f"Report {report_id} updated to version {version}: {', '.join(changed) or 'template'}")
+    return _report_payload(report_id, data, version)
+
+
+def run_pipeline(source, original_filename, language=None, report_id=None, on_stage=None, ai_mode=None,
+                 template_name=None, on_partial=None):
+    """
+    Run extract -> enhance -> structure -> render for one uploaded file and return
+    the same payload /process responds with.
+    source: path of a saved file or a SpooledUpload
+    on_stage: optional callback receiving the name of each stage as it starts
+    ai_mode: "two_pass" or "single_pass", defaults to AI_PIPELINE_MODE
+    template_name: report template in backend/templates/, defaults to DEFAULT_TEMPLATE
+    on_partial: optional callback receiving partial transcripts of long recordings
+    """
+    if on_stage:
+        on_stage('extract')
+    text = extract_text(source, get_extension(original_filename), language, on_partial)
+    return build_report(text, original_filename, report_id, on_stage, ai_mode, template_name, source_digest(source))
@@ -1,17 +1,28 @@
 import os
 import uuid
 from pathlib import Path
-from docxtpl import DocxTemplate
 from datetime import datetime
 import logging
 from flask import send_file, jsonify, request
 import json
 import ast
 import re
+import threading
+from pdf_conversion import convert_docx_to_pdf, ConversionError
+from template_engine import get_template
+import metrics
+import report_store
 
 # Get absolute path of project root directory
 BASE_DIR = Path(__file__).parent.parent.absolute()
 
+# "eager": convert to PDF while processing the upload, "lazy": on first PDF download
+PDF_MODE = os.getenv('PDF_MODE', 'eager')
+
+# Per-report PDF conversion locks with their number of users: [lock, count]
+_pdf_locks = {}
+_pdf_locks_guard = threading.Lock()
+
 def format_findings(findings):
     """
     将 imaging_findings 格式化为整洁文本
@@ -75,82 +86,110 @@ def prepare_data_for_template(data):
             data[key] = value.strip()
     return data
 
-def generate_report(data, format='docx', report_id=None, original_filename=None):
+def normalize_report_data(data):
     """
-    Generate report file using template1.docx template.
+    Recover data from a raw model response if needed, fill in missing keys and format the fields for the template.
     """
-    try:
-        # 如果数据中存在 raw_response，尝试提取有效的 JSON 部分并覆盖 data
-        if 'raw_response' in data:
-            raw = data['raw_response']
-            # 查找换行后紧跟 "{" 的位置
-            pos = raw.find('\n{')
-            if pos != -1:
-                json_str = raw[pos+1:]
-            else:
-                pos = raw.find('{')
-                json_str = raw[pos:]
-            print("Extracted JSON string:", json_str)
+    # 如果数据中存在 raw_response，尝试提取有效的 JSON 部分并覆盖 data
+    if 'raw_response' in data:
+        raw = data['raw_response']
+        # 查找换行后紧跟 "{" 的位置
+        pos = raw.find('\n{')
+        if pos != -1:
+            json_str = raw[pos+1:]
+        else:
+            pos = raw.find('{')
+            json_str = raw[pos:]
+        metrics.log_payload("Extracted JSON string", json_str)
+        try:
+            parsed = json.loads(json_str)
+            data = parsed  # 直接覆盖原来的 data
+        except json.JSONDecodeError as parse_e:
+            logging.error(f"Failed to parse raw_response using json: {parse_e}")
             try:
-                parsed = json.loads(json_str)
+                parsed = ast.literal_eval(json_str)
                 data = parsed  # 直接覆盖原来的 data
-            except json.JSONDecodeError as parse_e:
-                logging.error(f"Failed to parse raw_response using json: {parse_e}")
-                try:
-                    parsed = ast.literal_eval(json_str)
-                    data = parsed  # 直接覆盖原来的 data
-                except Exception as ast_e:
-                    logging.error(f"Failed to parse raw_response using ast.literal_eval: {ast_e}")
-        
-        # Ensure data contains all required keys
-        required_keys = [
-            'patient_name', 'examination_date', 'sex', 'age', 'refby', 'uhidno',
-            'examination_type', 'examined_area', 'device_model', 'imaging_findings',
-            'diagnosis_summary', 'comment'
-        ]
-        for key in required_keys:
-            if key not in data or not data[key]:
-                data[key] = '123'
-        
-        # Debug: Print the data being used for report generation
-        print("Data being used for report generation:", data)
-        
-        # 对数据进行预处理
-        data = prepare_data_for_template(data)
-        
-        # Load template document using DocxTemplate
-        template_path = os.path.join(str(BASE_DIR / 'backend' / 'templates'), 'template1.docx')
-        doc = DocxTemplate(template_path)
-        
-        # Render template using docxtpl，data 作为上下文
-        doc.render(data)
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    if cell.text and '{' in cell.text and '}' in cell.text:
-                        try:
-                            cell.text = cell.text.format(**data)
-                        except KeyError:
-                            pass
-        
-        # 确保 reports 目录存在
-        reports_dir = BASE_DIR / 'reports'
-        reports_dir.mkdir(exist_ok=True)
+            except Exception as ast_e:
+                logging.error(f"Failed to parse raw_response using ast.literal_eval: {ast_e}")
+    
+    # Ensure data contains all required keys
+    required_keys = [
+        'patient_name', 'examination_date', 'sex', 'age', 'refby', 'uhidno',
+        'examination_type', 'examined_area', 'device_model', 'imaging_findings',
+        'diagnosis_summary', 'comment'
+    ]
+    for key in required_keys:
+        if key not in data or not data[key]:
+            data[key] = '123'
+    
+    metrics.log_payload("Data being used for report generation", data)
+    
+    # 对数据进行预处理
+    return prepare_data_for_template(data)
+
+def report_paths(report_id):
+    """
+    Return (docx path, pdf path) of a report in TESTGEN/reports/
+    """
+    reports_dir = BASE_DIR / 'reports'
+    reports_dir.mkdir(exist_ok=True)
+    return (os.path.join(str(reports_dir), f"{report_id}.docx"),
+            os.path.join(str(reports_dir), f"{report_id}.pdf"))
+
+def render_docx(data, report_id=None, template_name=None):
+    """
+    Render a report template (default template1.docx) once with the report data and save it as TESTGEN/reports/<report_id>.docx.
+    The template is parsed once per process by template_engine and reused for every render.
+    """
+    data = normalize_report_data(data)
+    
+    if not report_id:
+        report_id = str(uuid.uuid4())
+    docx_report_path, _ = report_paths(report_id)
+    
+    # 使用预编译模板渲染并保存 DOCX 文件
+    with metrics.timed('render_docx'):
+        get_template(template_name).render_to(data, docx_report_path)
+    return docx_report_path
+
+def ensure_pdf(report_id):
+    """
+    Convert the saved DOCX of a report to PDF unless the PDF already exists, and return the PDF path.
+    Conversions of the same report are serialized so concurrent downloads convert only once.
+    """
+    docx_report_path, pdf_report_path = report_paths(report_id)
+    with _pdf_locks_guard:
+        entry = _pdf_locks.setdefault(report_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if not os.path.exists(pdf_report_path):
+                logging.debug(f"Converting DOCX: {docx_report_path} to PDF: {pdf_report_path}")
+                with metrics.timed('pdf_convert'):
+                    convert_docx_to_pdf(docx_report_path, pdf_report_path)
+                report_store.add_artifact(report_id, 'pdf', pdf_report_path)
+    finally:
+        # Dropped with its last user; popping it earlier would let a waiting and a new caller convert at once
+        with _pdf_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                _pdf_locks.pop(report_id, None)
+    return pdf_report_path
+
+def generate_report(data, format='docx', report_id=None, original_filename=None, template_name=None):
+    """
+    Generate report file using template1.docx template (or the named template).
+    The DOCX is rendered once; the PDF is converted from it.
+    """
+    try:
         if not report_id:
             report_id = str(uuid.uuid4())
-        docx_report_path = os.path.join(str(reports_dir), f"{report_id}.docx")
-        pdf_report_path = os.path.join(str(reports_dir), f"{report_id}.pdf")
+        docx_report_path = render_docx(data, report_id, template_name)
         
-        # 保存 DOCX 文件
-        doc.save(docx_report_path)
-        
-        # 如果需要转换为 PDF，则调用 docx2pdf
+        # 如果需要转换为 PDF，则通过转换器池转换已生成的 DOCX
         if format == 'pdf':
             try:
-                from docx2pdf import convert
-                print(f"Converting DOCX: {docx_report_path} to PDF: {pdf_report_path}")
-                convert(docx_report_path, pdf_report_path)
-                return pdf_report_path
+                return ensure_pdf(report_id)
             except Exception as conv_e:
                 logging.error(f"Failed to convert DOCX to PDF: {conv_e}")
                 return docx_report_path
@@ -164,14 +203,34 @@ def generate_report(data, format='docx', report_id=None, original_filename=None)
 def download_report(report_id):
     """
     Find corresponding docx or pdf report file in TESTGEN/reports/ based on report_id and return to client for download.
+    Stored reports are sent with their content hash as strong ETag; conditional and range requests are answered
+    with 304 / 206 and the file is streamed from disk.
     """
     try:
         fmt = request.args.get('format', 'docx')
+        if fmt not in ('docx', 'pdf'):
+            return jsonify({'error': 'Unsupported format'}), 400
         reports_dir = str(BASE_DIR / 'reports')
-        file_path = os.path.join(reports_dir, f'{report_id}.{fmt}')
+        # PDFs are converted on first download when PDF_MODE=lazy
+        if fmt == 'pdf' and report_store.get_artifact(report_id, 'pdf') is None \
+                and not os.path.exists(os.path.join(reports_dir, f'{report_id}.pdf')) \
+                and os.path.exists(os.path.join(reports_dir, f'{report_id}.docx')):
+            try:
+                ensure_pdf(report_id)
+            except ConversionError as conv_e:
+                logging.error(f"Failed to convert DOCX to PDF: {conv_e}")
+                return jsonify({'error': 'PDF conversion failed'}), 500
+
+        stored = report_store.get_artifact(report_id, fmt)
+        if stored:
+            file_path, etag = stored
+        else:
+            # Reports from before the report store, ETag derived from mtime and size
+            file_path, etag = os.path.join(reports_dir, f'{report_id}.{fmt}'), True
         if not os.path.exists(file_path):
             return jsonify({'error': 'Report does not exist'}), 404
-        return send_file(file_path, as_attachment=True)
+        return send_file(file_path, as_attachment=True, download_name=f'{report_id}.{fmt}',
+                         conditional=True, etag=etag)
     except Exception as e:
         logging.error(f'Failed to download report: {str(e)}')
-        return jsonify({'error': f'Failed to download report: {str(e)}'}), 500
\ No newline at end of file
+        return jsonify({'error': f'Failed to download report: {str(e)}'}), 500
@@ -0,0 +1,364 @@
+import os
+import json
+import shutil
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+from result_cache import hash_file
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+REPORTS_DIR = BASE_DIR / 'reports'
+# One copy of every distinct artifact; reports/<report_id>.<format> are hard links to these
+BLOBS_DIR = REPORTS_DIR / 'blobs'
+REPORT_INDEX_PATH = Path(os.getenv('REPORT_INDEX_PATH', str(REPORTS_DIR / 'index.sqlite3')))
+# Disk quota of the stored artifacts; reports not downloaded for the longest time are evicted (0 = no limit)
+REPORT_STORE_MAX_MB = int(os.getenv('REPORT_STORE_MAX_MB', '0'))
+
+# Date formats the model writes examination dates in, normalized to ISO for range queries
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d', '%d %B %Y', '%d %b %Y', '%B %d, %Y')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    report_id TEXT PRIMARY KEY,
+    source_hash TEXT,
+    source_filename TEXT,
+    uhidno TEXT,
+    examination_date TEXT,
+    examination_date_raw TEXT,
+    template TEXT,
+    created_at TEXT NOT NULL,
+    last_access TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_uhidno ON reports (uhidno);
+CREATE INDEX IF NOT EXISTS reports_examination_date ON reports (examination_date);
+CREATE INDEX IF NOT EXISTS reports_source_hash ON reports (source_hash);
+CREATE INDEX IF NOT EXISTS reports_last_access ON reports (last_access);
+CREATE TABLE IF NOT EXISTS artifacts (
+    report_id TEXT NOT NULL,
+    format TEXT NOT NULL,
+    blob_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (report_id, format)
+);
+CREATE INDEX IF NOT EXISTS artifacts_blob_hash ON artifacts (blob_hash);
+CREATE TABLE IF NOT EXISTS report_versions (
+    report_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    changed_fields TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (report_id, version)
+);
+"""
+
+
+class ReportNotFoundError(Exception):
+    """Raised when a report is not in the report store"""
+
+
+class VersionConflictError(Exception):
+    """Raised when a report was changed since the version an update is based on"""
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _db():
+    """One connection per thread; WAL lets several worker processes read while one writes"""
+    global _schema_ready
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        REPORT_INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(str(REPORT_INDEX_PATH), timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with _schema_lock:
+            if not _schema_ready:
+                connection.executescript(SCHEMA)
+                _schema_ready = True
+        _local.connection = connection
+    return connection
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def normalize_date(value):
+    """ISO date (YYYY-MM-DD) of a date the model extracted, None if it cannot be parsed"""
+    value = str(value or '').strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def _field(data, key):
+    value = (data or {}).get(key)
+    if not isinstance(value, str) or value.strip().lower() in ('', 'unknown'):
+        return None
+    return value.strip()
+
+
+def record_report(report_id, data, source_hash=None, source_filename=None, template_name=None,
+                  changed_fields=None, base_version=None):
+    """
+    Index a report with the upload it came from and the patient / date of its structured data,
+    and keep the structured data as a new version of the report.
+    changed_fields: fields a correction changed, None for data generated from the upload
+    base_version: version the data was derived from; VersionConflictError if a newer one exists
+    return: the new version number
+    """
+    examination_date = _field(data, 'examination_date')
+    now = _now()
+    db = _db()
+    # Reserve the write lock up front so concurrent updates from other processes serialize here
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        current = db.execute(
+            'SELECT COALESCE(MAX(version), 0) AS version FROM report_versions WHERE report_id = ?', (report_id,)
+        ).fetchone()['version']
+        if base_version is not None and base_version != current:
+            raise VersionConflictError(f'Report {report_id} is at version {current}, not {base_version}')
+        db.execute(
+            """INSERT INTO reports (report_id, source_hash, source_filename, uhidno, examination_date,
+                                    examination_date_raw, template, created_at, last_access)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (report_id) DO UPDATE SET
+                   source_hash = COALESCE(excluded.source_hash, source_hash),
+                   source_filename = COALESCE(excluded.source_filename, source_filename),
+                   uhidno = excluded.uhidno, examination_date = excluded.examination_date,
+                   examination_date_raw = excluded.examination_date_raw,
+                   template = COALESCE(excluded.template, template), last_access = excluded.last_access""",
+            (report_id, source_hash, source_filename, _field(data, 'uhidno'), normalize_date(examination_date),
+             examination_date, template_name, now, now)
+        )
+        db.execute(
+            'INSERT INTO report_versions (report_id, version, data, changed_fields, created_at) VALUES (?, ?, ?, ?, ?)',
+            (report_id, current + 1, json.dumps(data, ensure_ascii=False),
+             None if changed_fields is None else json.dumps(list(changed_fields)), now)
+        )
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return current + 1
+
+
+def get_report(report_id):
+    """Index entry of a report as a dict (source_filename, template, ...), None if unknown"""
+    row = _db().execute('SELECT * FROM reports WHERE report_id = ?', (report_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _version_dict(row):
+    return {
+        'version': row['version'],
+        'changedFields': None if row['changed_fields'] is None else json.loads(row['changed_fields']),
+        'createdAt': row['created_at']
+    }
+
+
+def get_version(report_id, version=None):
+    """
+    Structured data of one version of a report (default: the latest) as
+    {'version', 'changedFields', 'createdAt', 'data'}, None if it does not exist
+    """
+    if version is None:
+        row = _db().execute(
+            'SELECT * FROM report_versions WHERE report_id = ? ORDER BY version DESC LIMIT 1', (report_id,)
+        ).fetchone()
+    else:
+        row = _db().execute(
+            'SELECT * FROM report_versions WHERE report_id = ? AND version = ?', (report_id, version)
+        ).fetchone()
+    if row is None:
+        return None
+    return {**_version_dict(row), 'data': json.loads(row['data'])}
+
+
+def list_versions(report_id):
+    """History of a report, oldest version first, without the data"""
+    rows = _db().execute(
+        'SELECT version, changed_fields, created_at FROM report_versions WHERE report_id = ? ORDER BY version',
+        (report_id,)
+    ).fetchall()
+    return [_version_dict(row) for row in rows]
+
+
+def _blob_path(blob_hash, fmt):
+    return BLOBS_DIR / blob_hash[:2] / f'{blob_hash}.{fmt}'
+
+
+def add_artifact(report_id, fmt, path):
+    """
+    Store a rendered artifact (reports/<report_id>.<fmt>) by content hash: the first copy of
+    a content becomes the blob, identical later artifacts are replaced by hard links to it.
+    """
+    blob_hash = hash_file(path)
+    blob_path = _blob_path(blob_hash, fmt)
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if not blob_path.exists():
+            os.link(path, blob_path)
+        elif not os.path.samefile(path, blob_path):
+            # Swap the duplicate for a link to the stored copy, atomically
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            os.link(blob_path, tmp_path)
+            os.replace(tmp_path, path)
+    except OSError as e:
+        # No hard links on this file system: keep a separate copy
+        logging.warning(f"Report store cannot link {path}: {str(e)}")
+        if not blob_path.exists():
+            shutil.copyfile(path, blob_path)
+
+    size = os.path.getsize(path)
+    db = _db()
+    previous = db.execute(
+        'SELECT blob_hash FROM artifacts WHERE report_id = ? AND format = ?', (report_id, fmt)
+    ).fetchone()
+    db.execute(
+        """INSERT INTO artifacts (report_id, format, blob_hash, size) VALUES (?, ?, ?, ?)
+           ON CONFLICT (report_id, format) DO UPDATE SET blob_hash = excluded.blob_hash, size = excluded.size""",
+        (report_id, fmt, blob_hash, size)
+    )
+    # A re-rendered report replaces its artifact
+    if previous is not None and previous['blob_hash'] != blob_hash:
+        _remove_unused_blob(previous['blob_hash'], fmt)
+    enforce_quota()
+    return blob_hash
+
+
+def _remove_unused_blob(blob_hash, fmt):
+    if _db().execute('SELECT 1 FROM artifacts WHERE blob_hash = ? LIMIT 1', (blob_hash,)).fetchone() is None:
+        try:
+            os.remove(_blob_path(blob_hash, fmt))
+        except FileNotFoundError:
+            pass
+
+
+def discard_artifact(report_id, fmt):
+    """Forget an artifact that no longer matches the report data, e.g. the PDF of a corrected report"""
+    db = _db()
+    row = db.execute('SELECT blob_hash FROM artifacts WHERE report_id = ? AND format = ?', (report_id, fmt)).fetchone()
+    if row is None:
+        return
+    db.execute('DELETE FROM artifacts WHERE report_id = ? AND format = ?', (report_id, fmt))
+    try:
+        os.remove(REPORTS_DIR / f'{report_id}.{fmt}')
+    except FileNotFoundError:
+        pass
+    _remove_unused_blob(row['blob_hash'], fmt)
+
+
+def get_artifact(report_id, fmt):
+    """(path, content hash) of a stored artifact, or None. Marks the report as recently used."""
+    db = _db()
+    row = db.execute(
+        'SELECT blob_hash FROM artifacts WHERE report_id = ? AND format = ?', (report_id, fmt)
+    ).fetchone()
+    if row is None:
+        return None
+    path = REPORTS_DIR / f'{report_id}.{fmt}'
+    if not path.exists():
+        path = _blob_path(row['blob_hash'], fmt)
+        if not path.exists():
+            return None
+    db.execute('UPDATE reports SET last_access = ? WHERE report_id = ?', (_now(), report_id))
+    return str(path), row['blob_hash']
+
+
+def _report_dict(row, artifacts):
+    return {
+        'reportId': row['report_id'],
+        'sourceHash': row['source_hash'],
+        'sourceFilename': row['source_filename'],
+        'uhidno': row['uhidno'],
+        'examinationDate': row['examination_date'] or row['examination_date_raw'],
+        'template': row['template'],
+        'createdAt': row['created_at'],
+        'artifacts': {
+            a['format']: {'size': a['size'], 'etag': a['blob_hash'], 'downloadUrl': f"/download/{row['report_id']}?format={a['format']}"}
+            for a in artifacts
+        }
+    }
+
+
+def query_reports(uhidno=None, date_from=None, date_to=None, source_hash=None, limit=100, offset=0):
+    """
+    Reports of a patient and/or examination date range (ISO dates, inclusive), newest examination first
+    """
+    clauses, params = [], []
+    if uhidno:
+        clauses.append('uhidno = ?')
+        params.append(uhidno)
+    if date_from:
+        clauses.append('examination_date >= ?')
+        params.append(normalize_date(date_from) or date_from)
+    if date_to:
+        clauses.append('examination_date <= ?')
+        params.append(normalize_date(date_to) or date_to)
+    if source_hash:
+        clauses.append('source_hash = ?')
+        params.append(source_hash)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    db = _db()
+    rows = db.execute(
+        f'SELECT * FROM reports {where} ORDER BY examination_date DESC, created_at DESC LIMIT ? OFFSET ?',
+        params + [limit, offset]
+    ).fetchall()
+    if not rows:
+        return []
+    ids = [row['report_id'] for row in rows]
+    artifacts = {}
+    for artifact in db.execute(
+        f"SELECT * FROM artifacts WHERE report_id IN ({','.join('?' * len(ids))})", ids
+    ).fetchall():
+        artifacts.setdefault(artifact['report_id'], []).append(artifact)
+    return [_report_dict(row, artifacts.get(row['report_id'], [])) for row in rows]
+
+
+def stored_bytes():
+    """Disk usage of the distinct stored artifacts"""
+    row = _db().execute('SELECT COALESCE(SUM(size), 0) AS total FROM (SELECT DISTINCT blob_hash, size FROM artifacts)').fetchone()
+    return row['total']
+
+
+def delete_report(report_id):
+    """Remove a report with its history, and every blob no other report shares"""
+    db = _db()
+    artifacts = db.execute('SELECT format, blob_hash FROM artifacts WHERE report_id = ?', (report_id,)).fetchall()
+    db.execute('DELETE FROM artifacts WHERE report_id = ?', (report_id,))
+    db.execute('DELETE FROM report_versions WHERE report_id = ?', (report_id,))
+    db.execute('DELETE FROM reports WHERE report_id = ?', (report_id,))
+    for artifact in artifacts:
+        try:
+            os.remove(REPORTS_DIR / f"{report_id}.{artifact['format']}")
+        except FileNotFoundError:
+            pass
+        _remove_unused_blob(artifact['blob_hash'], artifact['format'])
+
+
+def enforce_quota():
+    """Evict the least recently downloaded reports until the store fits REPORT_STORE_MAX_MB"""
+    if REPORT_STORE_MAX_MB <= 0:
+        return
+    limit = REPORT_STORE_MAX_MB * 1024 * 1024
+    total = stored_bytes()
+    if total <= limit:
+        return
+    db = _db()
+    for row in db.execute('SELECT report_id FROM reports ORDER BY last_access').fetchall():
+        delete_report(row['report_id'])
+        logging.info(f"Evicted report {row['report_id']} from the report store")
+        total = stored_bytes()
+        if total <= limit:
+            break
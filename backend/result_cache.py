@@ -0,0 +1,173 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+CACHE_DIR = Path(os.getenv('CACHE_DIR', str(BASE_DIR / 'cache')))
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', '1') != '0'
+# Total size of all tiers before least recently used entries are evicted
+CACHE_MAX_MB = int(os.getenv('CACHE_MAX_MB', '1024'))
+
+# text: extracted text per upload, llm: model output per prompt, render: report artifacts
+TIERS = ('text', 'llm', 'render')
+
+_stats = {tier: {'hits': 0, 'misses': 0} for tier in TIERS}
+_lock = threading.Lock()
+# Approximate size of the cache directory, computed on first write
+_total_size = None
+
+
+def make_key(*parts):
+    """Build a cache key from bytes / strings such as a content hash and a model or template version"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def hash_file(filepath):
+    """SHA-256 of a file's bytes, read in blocks"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _entry_path(tier, key, ext):
+    return CACHE_DIR / tier / key[:2] / f'{key}.{ext}'
+
+
+def _count(tier, hit):
+    with _lock:
+        _stats[tier]['hits' if hit else 'misses'] += 1
+
+
+def _touch(path):
+    """Mark an entry as recently used; eviction removes the oldest mtimes first"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _entries():
+    for path in CACHE_DIR.glob('*/*/*'):
+        if path.is_file() and not path.name.startswith('.'):
+            yield path
+
+
+def _evict():
+    """Remove least recently used entries until the cache fits in CACHE_MAX_MB"""
+    global _total_size
+    limit = CACHE_MAX_MB * 1024 * 1024
+    entries = []
+    for path in _entries():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total <= limit:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except FileNotFoundError:
+            pass
+    _total_size = total
+
+
+def _write(path, write):
+    """Write an entry atomically and keep the cache within its size limit"""
+    global _total_size
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{uuid.uuid4().hex}.tmp')
+    write(tmp_path)
+    size = tmp_path.stat().st_size
+    os.replace(tmp_path, path)
+    with _lock:
+        if _total_size is None:
+            _evict()
+        else:
+            _total_size += size
+            if _total_size > CACHE_MAX_MB * 1024 * 1024:
+                _evict()
+
+
+def get_json(tier, key):
+    """Return the cached value or None on a miss"""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(tier, key, 'json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            value = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        _count(tier, False)
+        return None
+    _touch(path)
+    _count(tier, True)
+    return value
+
+
+def put_json(tier, key, value):
+    if not CACHE_ENABLED:
+        return
+    try:
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+        _write(_entry_path(tier, key, 'json'), write)
+    except Exception as e:
+        logging.error(f"Failed to write {tier} cache entry: {str(e)}")
+
+
+def get_file(tier, key, ext):
+    """Return the path of a cached artifact or None on a miss"""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(tier, key, ext)
+    if not path.exists():
+        _count(tier, False)
+        return None
+    _touch(path)
+    _count(tier, True)
+    return str(path)
+
+
+def put_file(tier, key, ext, src_path):
+    if not CACHE_ENABLED:
+        return
+    try:
+        _write(_entry_path(tier, key, ext), lambda tmp_path: shutil.copyfile(src_path, tmp_path))
+    except Exception as e:
+        logging.error(f"Failed to write {tier} cache entry: {str(e)}")
+
+
+def cached_json(tier, key, compute, should_cache=None):
+    """Return the cached value for key, or compute and store it"""
+    value = get_json(tier, key)
+    if value is not None:
+        return value
+    value = compute()
+    if value is not None and (should_cache is None or should_cache(value)):
+        put_json(tier, key, value)
+    return value
+
+
+def cache_stats():
+    """Hit / miss counters per tier since the process started"""
+    with _lock:
+        return {tier: dict(counts) for tier, counts in _stats.items()}
@@ -0,0 +1,175 @@
+"""
+Startup cost of the server: import time, the heavy libraries imported at startup and
+the memory of gunicorn-style workers with and without preloading (gunicorn.conf.py).
+
+Every measurement runs in a fresh interpreter. Worker memory is read from
+/proc/<pid>/smaps_rollup (Linux): "private" is what each worker adds, "shared" what
+it shares with the master copy-on-write.
+
+Command line usage (from the backend/ directory):
+    python startup_report.py
+    python startup_report.py --workers 4 --models "whisper:base,vosk:en"
+"""
+import os
+import sys
+import json
+import signal
+import argparse
+import subprocess
+from pathlib import Path
+
+# Libraries worth keeping out of the import path of a worker that does not need them
+HEAVY_MODULES = ('torch', 'whisper', 'vosk', 'pydub', 'PIL', 'numpy', 'pdfminer', 'docxtpl', 'ollama')
+
+BACKEND_DIR = Path(__file__).parent.absolute()
+
+
+def _import_app():
+    """Import the app as gunicorn does and return the seconds it took"""
+    import time
+    started = time.perf_counter()
+    import app2  # noqa: F401
+    return time.perf_counter() - started
+
+
+def _rss_mb(pid='self'):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def _smaps_mb(pid):
+    """Private and shared resident memory of a process, in MB"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+        'shared': values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0)
+    }
+
+
+def probe_import():
+    """Runs in a child interpreter: time the app import and list the heavy modules it loaded"""
+    seconds = _import_app()
+    print(json.dumps({
+        'seconds': seconds,
+        'rss_mb': _rss_mb(),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules]
+    }))
+
+
+def probe_workers(workers, preload):
+    """
+    Runs in a child interpreter: fork workers the way gunicorn does, importing the app
+    in the master before forking (preload) or in every worker after it
+    """
+    import gc
+    if preload:
+        _import_app()
+        gc.freeze()
+
+    pids = []
+    ready_read, ready_write = os.pipe()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            if not preload:
+                _import_app()
+            # Let the collector run once, as it would while serving requests
+            gc.collect()
+            os.write(ready_write, b'.')
+            signal.pause()
+            os._exit(0)
+        pids.append(pid)
+    os.close(ready_write)
+    for _ in range(workers):
+        os.read(ready_read, 1)
+
+    try:
+        memory = [_smaps_mb(pid) for pid in pids]
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+    print(json.dumps({
+        'master_rss_mb': _rss_mb(),
+        'workers': memory,
+        'private_mb': sum(m['private'] for m in memory) / workers,
+        'shared_mb': sum(m['shared'] for m in memory) / workers,
+        'pss_total_mb': _smaps_mb(os.getpid())['pss'] + sum(m['pss'] for m in memory)
+    }))
+
+
+def _run_probe(args, models, importtime=False):
+    env = dict(os.environ, SPEECH_MODEL_PRELOAD=models, PYTHONDONTWRITEBYTECODE='1')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + [__file__] + args
+    result = subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Probe {' '.join(args)} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def _slowest_imports(importtime_log, count):
+    """Packages by cumulative import time (including what they import), from the -X importtime output"""
+    packages = {}
+    for line in importtime_log.splitlines():
+        fields = line[len('import time:'):].split('|') if line.startswith('import time:') else []
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        if package in ('app2', 'startup_report'):
+            continue
+        packages[package] = max(packages.get(package, 0.0), int(fields[1]) / 1e6)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report import time and worker memory of the server')
+    parser.add_argument('--workers', type=int, default=2, help='workers forked for the memory comparison')
+    parser.add_argument('--models', default='', help='SPEECH_MODEL_PRELOAD for the measurements (default: none)')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports listed')
+    parser.add_argument('--json', action='store_true', help='print the raw measurements as JSON')
+    parser.add_argument('--probe', choices=['import', 'preload', 'per-worker'], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.probe == 'import':
+        return probe_import()
+    if args.probe:
+        return probe_workers(args.workers, preload=args.probe == 'preload')
+
+    cold, importtime_log = _run_probe(['--probe', 'import'], args.models, importtime=True)
+    report = {'models': args.models, 'import': cold, 'slowest_imports': _slowest_imports(importtime_log, args.top)}
+    if os.path.exists('/proc/self/smaps_rollup'):
+        for mode in ('preload', 'per-worker'):
+            report[mode], _ = _run_probe(['--probe', mode, '--workers', str(args.workers)], args.models)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Cold start (import app2, SPEECH_MODEL_PRELOAD={args.models!r}): "
+          f"{cold['seconds']:.2f} s, RSS {cold['rss_mb']:.0f} MB")
+    print(f"Heavy libraries imported at startup: {', '.join(cold['heavy_modules']) or 'none'}")
+    print('Slowest imports (cumulative):')
+    for name, seconds in report['slowest_imports']:
+        print(f"  {name:<28}{seconds * 1000:8.1f} ms")
+    if 'preload' not in report:
+        print('Worker memory: /proc/<pid>/smaps_rollup is not available on this system')
+        return
+    print(f"{f'Worker memory, {args.workers} workers (MB)':<34}{'preload':>10}{'per-worker import':>20}")
+    for label, key in (('private per worker', 'private_mb'), ('shared per worker', 'shared_mb'),
+                       ('total PSS incl. master', 'pss_total_mb')):
+        print(f"  {label:<32}{report['preload'][key]:10.0f}{report['per-worker'][key]:20.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Static asset build: content-hashed copies of static/ with gzip (and brotli, with
+`pip install brotli`) variants and a manifest, served with immutable cache headers.
+
+Single files get the hash in their name (css/styles.css -> css/styles.3f2a9c1b04.css) and
+url(...) references between them are rewritten. Bundles such as the pdf.js viewer load
+their files by relative URLs, so they are copied as a whole into a directory named after
+the hash of all their files (pdfjs -> pdfjs-8d1e0c55aa/) and keep their file names.
+Pages reference assets with asset_url('css/styles.css'); without a build they are
+served from /static/ as before.
+
+Command line usage (from the backend/ directory), e.g. before starting the server:
+    python static_assets.py
+    python static_assets.py --prune
+"""
+import os
+import re
+import json
+import gzip
+import shutil
+import logging
+import argparse
+import hashlib
+import mimetypes
+import posixpath
+import threading
+from pathlib import Path
+
+from flask import request, send_from_directory, abort
+from dotenv import load_dotenv
+
+from result_cache import hash_file
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+STATIC_DIR = BASE_DIR / 'static'
+
+# Load .env so the settings below see it when run from the command line
+load_dotenv(BASE_DIR / ".env")
+
+STATIC_BUILD_DIR = Path(os.getenv('STATIC_BUILD_DIR', str(BASE_DIR / 'static_build')))
+MANIFEST_PATH = STATIC_BUILD_DIR / 'manifest.json'
+# Directories of static/ fingerprinted as a whole because their files reference each other relatively
+STATIC_BUNDLES = [name.strip() for name in os.getenv('STATIC_BUNDLES', 'pdfjs').split(',') if name.strip()]
+# Lifetime of fingerprinted assets in browser and proxy caches, their content never changes under a name
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', str(365 * 24 * 3600)))
+
+ASSETS_URL = '/assets'
+HASH_LENGTH = 10
+# Compressed variants are only kept for text-like formats, when they save at least MIN_SAVING
+COMPRESSIBLE_EXTENSIONS = {
+    '.js', '.mjs', '.css', '.html', '.svg', '.json', '.map', '.txt', '.xml', '.ftl',
+    '.wasm', '.bcmap', '.pfb', '.ttf', '.otf', '.icc'
+}
+MIN_COMPRESS_BYTES = 1024
+MIN_SAVING = 0.1
+# Preferred first when the browser accepts both
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Module scripts are only executed when served with a JavaScript type
+mimetypes.add_type('text/javascript', '.mjs')
+mimetypes.add_type('application/wasm', '.wasm')
+mimetypes.add_type('text/plain', '.ftl')
+
+CSS_URL_PATTERN = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+_manifest = None
+_manifest_mtime = None
+_lock = threading.Lock()
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def _fingerprinted(logical, digest):
+    stem, ext = posixpath.splitext(logical)
+    return f'{stem}.{digest[:HASH_LENGTH]}{ext}'
+
+
+def _copy_atomic(source, target):
+    # A copy, not a link: static/ may be edited in place, the output must keep the content it is named after
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def _write_atomic(target, data):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, target)
+
+
+def _compress_variants(target):
+    """Write the .br / .gz variants of a built file, return the encodings kept"""
+    if target.suffix.lower() not in COMPRESSIBLE_EXTENSIONS or target.stat().st_size < MIN_COMPRESS_BYTES:
+        return []
+    data = None
+    encodings = []
+    brotli = _brotli()
+    for encoding, suffix in ENCODINGS:
+        variant = target.with_name(target.name + suffix)
+        # Outputs are named after their content, a variant built earlier is still valid
+        if not variant.exists():
+            if encoding == 'br' and brotli is None:
+                continue
+            data = target.read_bytes() if data is None else data
+            compressed = brotli.compress(data, quality=11) if encoding == 'br' else gzip.compress(data, 9, mtime=0)
+            if len(compressed) > len(data) * (1 - MIN_SAVING):
+                continue
+            _write_atomic(variant, compressed)
+        encodings.append(encoding)
+    return encodings
+
+
+def _rewrite_css(logical, source, files):
+    """CSS with relative url(...) references to other assets pointed at their fingerprinted names"""
+    css = source.read_text(encoding='utf-8')
+    directory = posixpath.dirname(logical)
+
+    def replace(match):
+        quote, reference = match.groups()
+        if re.match(r'^(?:[a-z]+:|/|#)', reference, re.IGNORECASE):
+            return match.group(0)
+        path, _, suffix = reference.partition('?')
+        target = posixpath.normpath(posixpath.join(directory, path))
+        if target not in files:
+            return match.group(0)
+        relative = posixpath.relpath(files[target], directory)
+        return f"url({quote}{relative}{'?' + suffix if suffix else ''}{quote})"
+
+    return CSS_URL_PATTERN.sub(replace, css).encode('utf-8')
+
+
+def _bundle_digest(root):
+    digest = hashlib.sha256()
+    for path in sorted(p for p in root.rglob('*') if p.is_file()):
+        digest.update(f'{path.relative_to(root).as_posix()}\0{hash_file(path)}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_assets(prune=False):
+    """
+    Build static/ into STATIC_BUILD_DIR and write the manifest. Outputs already built
+    for the same content are reused, so a rebuild without changes only hashes files.
+    prune: remove outputs of earlier builds that the new manifest does not reference
+    return: the manifest {'files': {logical path: built path}, 'encodings': {built path: [encodings]}}
+    """
+    files, encodings = {}, {}
+
+    for bundle in STATIC_BUNDLES:
+        root = STATIC_DIR / bundle
+        if not root.is_dir():
+            logging.warning(f"Static bundle {bundle} does not exist")
+            continue
+        built_root = f'{bundle}-{_bundle_digest(root)[:HASH_LENGTH]}'
+        for path in sorted(p for p in root.rglob('*') if p.is_file()):
+            relative = path.relative_to(root).as_posix()
+            built = f'{built_root}/{relative}'
+            target = STATIC_BUILD_DIR / built
+            if not target.exists():
+                _copy_atomic(path, target)
+            files[f'{bundle}/{relative}'] = built
+            encodings[built] = _compress_variants(target)
+
+    singles = [
+        p for p in sorted(STATIC_DIR.rglob('*'))
+        if p.is_file() and p.relative_to(STATIC_DIR).parts[0] not in STATIC_BUNDLES
+    ]
+    # Stylesheets last, they are rewritten to the fingerprinted names of the files they reference
+    for path in sorted(singles, key=lambda p: p.suffix.lower() == '.css'):
+        logical = path.relative_to(STATIC_DIR).as_posix()
+        if path.suffix.lower() == '.css':
+            data = _rewrite_css(logical, path, files)
+            built = _fingerprinted(logical, hashlib.sha256(data).hexdigest())
+            target = STATIC_BUILD_DIR / built
+            if not target.exists():
+                _write_atomic(target, data)
+        else:
+            built = _fingerprinted(logical, hash_file(path))
+            target = STATIC_BUILD_DIR / built
+            if not target.exists():
+                _copy_atomic(path, target)
+        files[logical] = built
+        encodings[built] = _compress_variants(target)
+
+    manifest = {'files': files, 'encodings': encodings}
+    _write_atomic(MANIFEST_PATH, json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    logging.info(f"Built {len(files)} static assets into {STATIC_BUILD_DIR}")
+
+    if prune:
+        keep = {MANIFEST_PATH}
+        for built, kept in encodings.items():
+            keep.add(STATIC_BUILD_DIR / built)
+            keep.update(STATIC_BUILD_DIR / (built + suffix) for encoding, suffix in ENCODINGS if encoding in kept)
+        for path in sorted(STATIC_BUILD_DIR.rglob('*'), reverse=True):
+            if path.is_file() and path not in keep:
+                path.unlink()
+            elif path.is_dir() and not any(path.iterdir()):
+                path.rmdir()
+    return manifest
+
+
+def get_manifest():
+    """The manifest of the last build, reloaded when a new build is written; None without a build"""
+    global _manifest, _manifest_mtime
+    try:
+        mtime = MANIFEST_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _lock:
+        if mtime != _manifest_mtime:
+            try:
+                _manifest = json.loads(MANIFEST_PATH.read_text(encoding='utf-8'))
+                _manifest_mtime = mtime
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to load static asset manifest: {str(e)}")
+                return _manifest
+        return _manifest
+
+
+def asset_url(path):
+    """URL of a file in static/, fingerprinted when it is part of the build"""
+    manifest = get_manifest()
+    built = manifest['files'].get(path) if manifest else None
+    if built is None:
+        return f'/static/{path}'
+    return f'{ASSETS_URL}/{built}'
+
+
+def _accepted_encodings():
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def send_asset(built):
+    """
+    Response for a fingerprinted asset: the smallest variant the browser accepts,
+    cacheable forever since its name changes with its content
+    """
+    manifest = get_manifest()
+    if not manifest or built not in manifest['encodings']:
+        abort(404)
+
+    available = manifest['encodings'][built]
+    accepted = _accepted_encodings()
+    encoding = next((name for name, _ in ENCODINGS if name in available and (name in accepted or '*' in accepted)), None)
+    if encoding:
+        mimetype = mimetypes.guess_type(built)[0] or 'application/octet-stream'
+        response = send_from_directory(
+            STATIC_BUILD_DIR, built + dict(ENCODINGS)[encoding], mimetype=mimetype, max_age=STATIC_MAX_AGE
+        )
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(STATIC_BUILD_DIR, built, max_age=STATIC_MAX_AGE)
+    if available:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed static assets')
+    parser.add_argument('--prune', action='store_true', help='remove outputs of earlier builds')
+    args = parser.parse_args(argv)
+    if _brotli() is None:
+        logging.warning("brotli is not installed, only gzip variants are built")
+    manifest = build_assets(prune=args.prune)
+    compressed = sum(1 for kept in manifest['encodings'].values() if kept)
+    print(f"{len(manifest['files'])} assets, {compressed} with compressed variants, manifest: {MANIFEST_PATH}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main()
@@ -0,0 +1,207 @@
+import os
+import re
+import io
+import copy
+import uuid
+import zipfile
+import logging
+import posixpath
+import threading
+from pathlib import Path
+
+from lxml import etree
+from jinja2 import Environment, meta
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn, nsmap
+from docxtpl import DocxTemplate
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.parent.absolute()
+TEMPLATES_DIR = BASE_DIR / 'backend' / 'templates'
+DEFAULT_TEMPLATE = os.getenv('DEFAULT_TEMPLATE', 'template1')
+
+DOCUMENT_PART = 'word/document.xml'
+DOCUMENT_RELS_PART = 'word/_rels/document.xml.rels'
+# Parts of the DOCX zip that may hold placeholders
+TEMPLATE_PARTS_PATTERN = re.compile(r'word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml')
+# Legacy single-brace placeholders such as {patient_name}, formerly filled by str.format on table cells
+SINGLE_BRACE_PATTERN = re.compile(r'(?<!\{)\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}(?!\})')
+
+# Values are escaped, so "<5 mm" or "A & E" cannot corrupt the document XML
+_jinja_env = Environment(autoescape=True)
+
+
+class TemplateNotFoundError(Exception):
+    """Raised when a requested report template does not exist"""
+
+
+def _convert_single_braces(raw):
+    """Return the DOCX bytes with legacy {name} placeholders rewritten as {{ name }}"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(raw)) as source, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            data = source.read(info)
+            if TEMPLATE_PARTS_PATTERN.fullmatch(info.filename):
+                data = SINGLE_BRACE_PATTERN.sub(r'{{ \1 }}', data.decode('utf-8')).encode('utf-8')
+            target.writestr(info, data)
+    return output.getvalue()
+
+
+class CompiledTemplate:
+    """
+    A DOCX report template parsed once. The body, headers and footers are cleaned up with
+    docxtpl's own preprocessing and compiled to jinja2 templates when the file is loaded,
+    and the parts nothing is rendered into are zipped once. A render only fills the
+    compiled templates, applies the same post-processing as DocxTemplate.render and adds
+    the rendered parts to a copy of that zip, without unzipping or parsing the template
+    again. docxtpl is pinned in requirements.txt; tests/test_template_engine.py checks
+    that the output matches DocxTemplate.render for every shipped template.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = str(path)
+        stat = os.stat(self.path)
+        self.version = f"{stat.st_mtime_ns}-{stat.st_size}"
+
+        with open(self.path, 'rb') as f:
+            raw = _convert_single_braces(f.read())
+        with zipfile.ZipFile(io.BytesIO(raw)) as archive:
+            members = [(info, archive.read(info)) for info in archive.infolist()]
+        contents = {info.filename: data for info, data in members}
+
+        # Only used for its XML clean-up and post-processing, which do not touch the document
+        self._docx = DocxTemplate(io.BytesIO(raw))
+
+        # zip member name -> compiled template; placeholder name -> member names it appears in
+        self.parts = {}
+        self.placeholders = {}
+
+        # The document element without its body, the rendered body is inserted at the same position
+        self._document = parse_xml(contents[DOCUMENT_PART])
+        body = self._document.find(qn('w:body'))
+        self._body_index = self._document.index(body)
+        self._document.remove(body)
+        self._compile(DOCUMENT_PART, self._docx.xml_to_string(body))
+
+        # Headers and footers, found through the relationships of the main document like docxtpl does
+        relationships = parse_xml(contents[DOCUMENT_RELS_PART])
+        for relationship in relationships:
+            target = relationship.get('TargetMode') != 'External' and relationship.get('Target')
+            if relationship.get('Type') in (DocxTemplate.HEADER_URI, DocxTemplate.FOOTER_URI) and target:
+                member = posixpath.normpath(posixpath.join('word', target)).lstrip('/')
+                if contents.get(member):
+                    self._compile(member, self._docx.xml_to_string(parse_xml(contents[member])))
+
+        # Everything else is compressed once; renders append their parts to a copy
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for info, data in members:
+                if info.filename not in self.parts:
+                    archive.writestr(info, data)
+        self._base_zip = output.getvalue()
+        self._infos = {info.filename: info for info, _ in members if info.filename in self.parts}
+
+    def _compile(self, member, xml):
+        xml = self._docx.patch_xml(xml)
+        # Same line splitting docxtpl does before rendering, so jinja2 error line numbers stay meaningful
+        xml = re.sub(r'<w:p([ >])', r'\n<w:p\1', xml)
+        for variable in meta.find_undeclared_variables(_jinja_env.parse(xml)):
+            self.placeholders.setdefault(variable, []).append(member)
+        self.parts[member] = _jinja_env.from_string(xml)
+
+    def _render_part(self, member, context):
+        xml = self.parts[member].render(context)
+        xml = re.sub(r'\n<w:p([ >])', r'<w:p\1', xml)
+        xml = (xml
+               .replace('{_{', '{{')
+               .replace('}_}', '}}')
+               .replace('{_%', '{%')
+               .replace('%_}', '%}'))
+        # Turn \n, \t etc. in values into Word line breaks and tabs
+        xml = self._docx.resolve_listing(xml)
+        if member != DOCUMENT_PART:
+            return etree.tostring(parse_xml(xml.encode('utf-8')), encoding='UTF-8', standalone=True)
+
+        body = self._docx.fix_tables(xml)
+        # Drawings repeated by loops would share their ids, number them again as docxtpl does
+        for index, element in enumerate(body.xpath('//wp:docPr', namespaces=nsmap), start=1001):
+            element.set('id', str(index))
+        document = copy.deepcopy(self._document)
+        document.insert(self._body_index, body)
+        return etree.tostring(document, encoding='UTF-8', standalone=True)
+
+    def render(self, context):
+        """Render the template with context and return the DOCX file as bytes"""
+        rendered = {member: self._render_part(member, context) for member in self.parts}
+        output = io.BytesIO(self._base_zip)
+        output.seek(0, io.SEEK_END)
+        with zipfile.ZipFile(output, 'a', zipfile.ZIP_DEFLATED) as archive:
+            for member, data in rendered.items():
+                archive.writestr(self._infos[member], data)
+        return output.getvalue()
+
+    def render_to(self, context, path):
+        """Render to path atomically, so a concurrent download never reads a partial file"""
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self.render(context))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+_templates = {}
+_lock = threading.Lock()
+
+
+def template_path(name):
+    return TEMPLATES_DIR / f'{name}.docx'
+
+
+def available_templates():
+    """Names of the DOCX templates in backend/templates/ (Word lock files are skipped)"""
+    return sorted(p.stem for p in TEMPLATES_DIR.glob('*.docx') if not p.name.startswith('~$'))
+
+
+def get_template(name=None):
+    """
+    Return the compiled template, parsing it on first use and again whenever
+    the file on disk has changed
+    """
+    name = name or DEFAULT_TEMPLATE
+    if not re.fullmatch(r'[A-Za-z0-9_\-]+', name):
+        raise TemplateNotFoundError(f'Unknown report template: {name}')
+    try:
+        stat = os.stat(template_path(name))
+    except FileNotFoundError:
+        raise TemplateNotFoundError(f'Unknown report template: {name}')
+    version = f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    template = _templates.get(name)
+    if template is not None and template.version == version:
+        return template
+    with _lock:
+        template = _templates.get(name)
+        if template is None or template.version != version:
+            template = CompiledTemplate(name, template_path(name))
+            _templates[name] = template
+            logging.info(f"Compiled report template {name} ({len(template.placeholders)} placeholders)")
+        return template
+
+
+def template_version(name=None):
+    """Identify the current template file so cached renders are invalidated when it changes"""
+    return get_template(name).version
+
+
+def load_templates():
+    """Parse all templates up front, e.g. when a worker starts"""
+    for name in available_templates():
+        try:
+            get_template(name)
+        except Exception as e:
+            logging.error(f"Failed to compile report template {name}: {str(e)}")
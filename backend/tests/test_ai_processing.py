@@ -0,0 +1,60 @@
+"""
+The streamed JSON reader must hand out every member of the report object, however the
+model splits its output into chunks and whatever prose it writes before the object.
+
+Run from the backend/ directory:
+    python -m unittest discover tests
+"""
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ai_processing import StreamingJSONExtractor
+
+
+def feed_all(chunks):
+    extractor = StreamingJSONExtractor()
+    members = []
+    for chunk in chunks:
+        members.extend(extractor.feed(chunk))
+    return extractor, members
+
+
+class StreamingJSONExtractorTest(unittest.TestCase):
+
+    def test_brackets_before_the_object(self):
+        extractor, members = feed_all(['Sure [note]: {"a": 1}'])
+        self.assertEqual(members, [('a', 1)])
+        self.assertTrue(extractor.done)
+
+    def test_unbalanced_brackets_before_the_object(self):
+        extractor, members = feed_all(['Here it is] [see below: {"a": "x"}'])
+        self.assertEqual(members, [('a', 'x')])
+        self.assertTrue(extractor.done)
+
+    def test_members_split_across_chunks(self):
+        text = 'Report:\n{"name": "Jane, \\"JD\\" Doe", "findings": ["a}", {"b": [1, 2]}], "age": 42}\ntrailing'
+        expected = [('name', 'Jane, "JD" Doe'), ('findings', ['a}', {'b': [1, 2]}]), ('age', 42)]
+        for size in (1, 2, 3, 7):
+            with self.subTest(size=size):
+                extractor, members = feed_all([text[i:i + size] for i in range(0, len(text), size)])
+                self.assertEqual(members, expected)
+                self.assertTrue(extractor.done)
+
+    def test_members_arrive_as_they_complete(self):
+        extractor = StreamingJSONExtractor()
+        self.assertEqual(extractor.feed('{"a": 1, "b": "te'), [('a', 1)])
+        self.assertEqual(extractor.feed('xt", '), [('b', 'text')])
+        self.assertEqual(extractor.feed('"c": null}'), [('c', None)])
+        self.assertTrue(extractor.done)
+
+    def test_incomplete_object(self):
+        extractor, members = feed_all(['{"a": 1, "b": [1, 2'])
+        self.assertEqual(members, [('a', 1)])
+        self.assertFalse(extractor.done)
+
+
+if __name__ == '__main__':
+    unittest.main()
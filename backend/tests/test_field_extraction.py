@@ -0,0 +1,91 @@
+"""
+The field reader must only take real header labels, never words of the findings prose.
+
+Run from the backend/ directory:
+    python -m unittest discover tests
+"""
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from field_extraction import CompiledLayout, DEFAULT_LAYOUT, FREE_TEXT_KEYS
+
+HEADER = """Patient Name: Jane Doe
+Age: 42 Y    Sex: F
+UHID No: AB-1234 | Referred By: Dr. Smith
+Examination Date: 12/03/2024
+Examination Type: Ultrasound abdomen
+Examined Area: Abdomen
+"""
+
+PROSE = """Findings:
+The patient was examined in supine position. The study was limited by bowel gas.
+Name of the lesion: not determined; region: right lobe, area: 2 cm.
+Examination: no free fluid in the pelvis. The liver area shows normal echotexture.
+Impression: Normal study.
+Comments: Correlate clinically, patient name: see request form.
+"""
+
+
+class FieldExtractionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.layout = CompiledLayout(DEFAULT_LAYOUT)
+
+    def test_header_fields(self):
+        found, remaining = self.layout.extract(HEADER + PROSE)
+        self.assertEqual(found, {
+            'patient_name': 'Jane Doe',
+            'age': '42 Y',
+            'sex': 'F',
+            'uhidno': 'AB-1234',
+            'refby': 'Dr. Smith',
+            'examination_date': '12/03/2024',
+            'examination_type': 'Ultrasound abdomen',
+            'examined_area': 'Abdomen'
+        })
+        self.assertNotIn('Jane Doe', remaining)
+        self.assertIn('The patient was examined in supine position.', remaining)
+
+    def test_prose_is_not_read_as_fields(self):
+        found, remaining = self.layout.extract(PROSE)
+        self.assertEqual(found, {})
+        self.assertEqual(remaining, '\n'.join(line.strip() for line in PROSE.splitlines() if line.strip()))
+
+    def test_generic_words_at_line_start(self):
+        text = 'Name: Liver\nPatient: cooperative\nStudy: limited\nRegion: epigastric\nArea: 3 cm\nExamination: normal'
+        found, _ = self.layout.extract(text)
+        self.assertEqual(found, {})
+
+    def test_labels_inside_sentences(self):
+        found, _ = self.layout.extract('Lesion seen, patient name: unknown, age: 30 years, examined area: liver')
+        self.assertEqual(found, {})
+
+    def test_free_text_fields_are_left_to_the_model(self):
+        found, remaining = self.layout.extract(HEADER + PROSE)
+        for key in FREE_TEXT_KEYS:
+            self.assertNotIn(key, found)
+        self.assertIn('Impression: Normal study.', remaining)
+        self.assertIn('Comments: Correlate clinically', remaining)
+
+    def test_free_text_label_ends_header_field(self):
+        found, _ = self.layout.extract('Examined Area: Pelvis  Impression: simple cyst')
+        self.assertEqual(found, {'examined_area': 'Pelvis'})
+
+    def test_custom_multiline_field_is_free_text(self):
+        layout = CompiledLayout({'fields': {
+            'patient_name': {'labels': ['pt name']},
+            'observations': {'labels': ['observations'], 'multiline': True}
+        }})
+        found, _ = layout.extract('Pt Name: John\nObservations: normal kidneys')
+        self.assertEqual(found, {'patient_name': 'John'})
+
+    def test_values_must_match(self):
+        found, _ = self.layout.extract('Age: appropriate for gestation\nSex: not assessed\nDate: to be fixed')
+        self.assertEqual(found, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Rendered reports must match what DocxTemplate.render produces for every shipped template.
+
+Run from the backend/ directory:
+    python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import tempfile
+import zipfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from lxml import etree
+from docxtpl import DocxTemplate
+
+from template_engine import available_templates, get_template, template_path, CompiledTemplate, _jinja_env
+
+CONTEXT = {
+    'patient_name': 'Jane <Doe> & Co',
+    'age': '42',
+    'sex': 'F',
+    'uhidno': 'U-1001',
+    'refby': 'Dr. Smith',
+    'examination_date': '2024-03-01',
+    'examination_type': 'Ultrasound abdomen',
+    'examined_area': 'Abdomen',
+    'device_model': 'Voluson E8',
+    'imaging_findings': 'Liver normal in size.\nNo focal lesion, gallbladder <5 mm wall.',
+    'diagnosis_summary': 'Normal study',
+    'comment': 'Follow up in 6 months'
+}
+
+
+def _parts(docx_bytes):
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def _canonical(name, data):
+    """
+    XML parts in canonical form, python-docx rewrites them with other quoting and declarations
+    and lists the content types in another order
+    """
+    if not name.endswith(('.xml', '.rels')):
+        return data
+    root = etree.fromstring(data)
+    if name == '[Content_Types].xml':
+        return sorted(etree.tostring(child, method='c14n') for child in root)
+    return etree.tostring(root, method='c14n')
+
+
+class TemplateRenderTest(unittest.TestCase):
+
+    def assertDocxEqual(self, docx_bytes, template_file):
+        """docx_bytes has the same parts as DocxTemplate.render of template_file produces"""
+        expected = DocxTemplate(template_file)
+        expected.render(CONTEXT, _jinja_env, autoescape=True)
+        output = io.BytesIO()
+        expected.save(output)
+
+        rendered = _parts(docx_bytes)
+        expected = _parts(output.getvalue())
+        self.assertEqual(sorted(rendered), sorted(expected))
+        for member, data in expected.items():
+            self.assertTrue(_canonical(member, rendered[member]) == _canonical(member, data), member)
+
+    def test_templates_are_shipped(self):
+        self.assertTrue(available_templates())
+
+    def test_render_matches_docxtpl(self):
+        for name in available_templates():
+            with self.subTest(template=name):
+                self.assertDocxEqual(get_template(name).render(CONTEXT), str(template_path(name)))
+
+    def test_headers_footers_and_tables(self):
+        from docx import Document
+        document = Document()
+        document.sections[0].header.paragraphs[0].text = 'UHID {{ uhidno }}'
+        document.sections[0].footer.paragraphs[0].text = 'Referred by {{ refby }}'
+        document.add_paragraph('Patient: {{ patient_name }}')
+        table = document.add_table(rows=1, cols=2)
+        table.cell(0, 0).text = 'Findings'
+        table.cell(0, 1).text = '{{ imaging_findings }}'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'report.docx')
+            document.save(path)
+            template = CompiledTemplate('report', path)
+            self.assertEqual(set(template.placeholders), {'uhidno', 'refby', 'patient_name', 'imaging_findings'})
+            self.assertDocxEqual(template.render(CONTEXT), path)
+
+    def test_values_are_escaped(self):
+        for name in available_templates():
+            with self.subTest(template=name):
+                document = _parts(get_template(name).render(CONTEXT))['word/document.xml'].decode('utf-8')
+                self.assertIn('Jane &lt;Doe&gt; &amp; Co', document)
+
+    def test_placeholders(self):
+        template = get_template()
+        self.assertIn('patient_name', template.placeholders)
+        self.assertIn('imaging_findings', template.placeholders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,74 +1,102 @@
 import os
 from pathlib import Path
-from PIL import Image
-import pytesseract
-from pydub import AudioSegment
-import wave
 import json
 import logging
-import whisper  # 导入 Whisper
+from model_registry import get_whisper_model, normalize_language
+from audio_chunking import transcribe_long_audio, LONG_AUDIO_SECONDS
+from ocr_engine import ocr_image
+from pdf_extraction import extract_pdf_text
+
+def load_audio(source, format=None):
+    """
+    Decode an audio file path or binary file object into mono 16kHz 16-bit PCM in memory.
+    WAV data is parsed directly; other formats are piped through ffmpeg without a temporary copy.
+    """
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(source, format=format)
+    return audio.set_channels(1).set_frame_rate(16000).set_sample_width(2)
+
+def audio_to_array(audio):
+    """Convert 16-bit PCM AudioSegment to the float32 waveform Whisper accepts"""
+    import numpy as np
+    return np.frombuffer(audio.raw_data, dtype=np.int16).astype(np.float32) / 32768.0
 
 def convert_audio(filepath):
     """Convert audio file to Whisper supported format: mono 16kHz 16-bit PCM"""
     try:
-        audio = AudioSegment.from_file(filepath)
-        audio = audio.set_channels(1).set_frame_rate(16000).set_sample_width(2)
+        audio = load_audio(filepath)
         converted_path = Path(filepath).with_suffix('.wav')
         audio.export(converted_path, format="wav")
-        print(f"Audio converted and saved to: {converted_path}")  # 打印转换后的文件路径
+        logging.debug(f"Audio converted and saved to: {converted_path}")
         return str(converted_path)
     except Exception as e:
         logging.error(f"Audio conversion failed: {str(e)}")
         raise
 
-def process_image(filepath):
-    """Process image using Tesseract OCR and return recognized text"""
+def process_image(source):
+    """
+    Process image (path or binary file object) using Tesseract OCR and return recognized text.
+    Only the detected text regions are OCR'd, in parallel, with a persistent tesseract handle per thread;
+    every page of multi-page TIFF and DICOM files is included.
+    """
     try:
-        img = Image.open(filepath)
-        text = pytesseract.image_to_string(img, lang='eng')
+        text = ocr_image(source)
         return text.strip() or "No text recognized"
     except Exception as e:
         logging.error(f"Image processing failed: {str(e)}")
         return ""
 
-def process_audio(filepath, language='en'):
-    """Process audio using Whisper and return transcribed text"""
+def process_audio(source, language=None, format=None, on_partial=None):
+    """
+    Process audio (path or binary file object) using Whisper and return transcribed text.
+    Without a language Whisper detects it, as it did before languages could be chosen.
+    Recordings longer than LONG_AUDIO_SECONDS are split at silences and transcribed in parallel;
+    on_partial then receives the transcript finished so far.
+    """
     try:
-        # 加载 Whisper 模型
-        model = whisper.load_model("base")  # 可以选择 "tiny", "base", "small", "medium", "large"
+        # 在内存中解码为 16kHz 单声道 PCM，不再写临时文件
+        audio = load_audio(source, format)
+        
+        # 长录音：按静音切分并行转写
+        if audio.duration_seconds > LONG_AUDIO_SECONDS:
+            result = transcribe_long_audio(audio, language, on_partial=on_partial)
+            return result["text"].strip() or "No speech recognized"
         
-        # 转写音频
-        result = model.transcribe(filepath)
-        print("Transcribed text:", result["text"])  # 打印转写结果
+        # 从进程级模型注册表获取 Whisper 模型（只在首次使用时加载）
+        model = get_whisper_model(language=language)
+        
+        # 转写音频，指定语言以跳过语言检测
+        result = model.transcribe(audio_to_array(audio), language=normalize_language(language) if language else None)
         return result["text"].strip() or "No speech recognized"
     except Exception as e:
         logging.error(f"Audio processing failed: {str(e)}")
         return ""
 
-def process_text(filepath):
-    """Process plain text file, read and return content"""
+def process_text(source):
+    """Process plain text file (path or binary file object), read and return content"""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
+        if hasattr(source, 'read'):
+            return source.read().decode('utf-8')
+        with open(source, 'r', encoding='utf-8') as f:
             return f.read()
     except Exception as e:
         logging.error(f"Text processing failed: {str(e)}")
         return ""
 
-def process_pdf(filepath):
-    """Process PDF file using pdfminer and return extracted text"""
+def process_pdf(source):
+    """Process PDF file (path or binary file object) page by page, OCR-ing scanned pages, and return extracted text"""
     try:
-        from pdfminer.high_level import extract_text
-        return extract_text(filepath)
+        return extract_pdf_text(source)
     except Exception as e:
         logging.error(f"PDF processing failed: {str(e)}")
         return ""
 
-def process_docx(filepath):
-    """Process Word document using python-docx and return all paragraph text"""
+def process_docx(source):
+    """Process Word document (path or binary file object) using python-docx and return all paragraph text"""
     try:
         from docx import Document as DocxDocument
-        doc = DocxDocument(filepath)
+        doc = DocxDocument(source)
         return '\n'.join([para.text for para in doc.paragraphs])
     except Exception as e:
         logging.error(f"Word processing failed: {str(e)}")
-        return "" 
\ No newline at end of file
+        return ""
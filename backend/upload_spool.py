@@ -0,0 +1,97 @@
+import os
+import uuid
+import hashlib
+import tempfile
+
+from flask import Request
+
+# Uploads up to this size stay in memory, larger ones go to an anonymous temporary file
+SPOOL_MAX_MEMORY_MB = int(os.getenv('SPOOL_MAX_MEMORY_MB', '8'))
+# Directory for spooled temporary files (default: the system temp directory)
+SPOOL_DIR = os.getenv('SPOOL_DIR') or None
+
+
+class SpoolingRequest(Request):
+    """
+    Flask request that spools uploaded files into a SpooledTemporaryFile with a
+    configurable memory limit. Temporary files are unique per request and are
+    removed by the operating system when the request closes them.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_MEMORY_MB * 1024 * 1024, mode='rb+', dir=SPOOL_DIR
+        )
+
+
+class SpooledUpload:
+    """
+    An uploaded file handed to the processors as a binary file object instead of a
+    path, so it is read from memory (or its per-request spool file) without being
+    saved to uploads/ first.
+    """
+
+    def __init__(self, stream, filename):
+        self.stream = stream
+        self.filename = filename
+        self.ext = filename.split('.')[-1].lower()
+
+        # Hash while reading through once; the result cache is keyed on it
+        digest = hashlib.sha256()
+        size = 0
+        self.stream.seek(0)
+        for block in iter(lambda: self.stream.read(1024 * 1024), b''):
+            digest.update(block)
+            size += len(block)
+        self.sha256 = digest.hexdigest()
+        self.size = size
+        self.stream.seek(0)
+        self._paths = []
+
+    @classmethod
+    def from_file_storage(cls, file, filename):
+        return cls(file.stream, filename)
+
+    @classmethod
+    def from_bytes(cls, data, filename):
+        stream = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_MB * 1024 * 1024, mode='rb+', dir=SPOOL_DIR)
+        stream.write(data)
+        return cls(stream, filename)
+
+    def open(self):
+        """Return the upload as a binary file object positioned at the start"""
+        self.stream.seek(0)
+        return self.stream
+
+    def read(self):
+        return self.open().read()
+
+    def save(self, path):
+        """Copy the upload to path, for consumers that outlive the request"""
+        stream = self.open()
+        with open(path, 'wb') as f:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                f.write(block)
+        return path
+
+    def path(self):
+        """Write the upload to a unique temporary file for tools that only accept paths"""
+        fd, path = tempfile.mkstemp(suffix=f'.{self.ext}', prefix=f'upload-{uuid.uuid4().hex}-', dir=SPOOL_DIR)
+        os.close(fd)
+        self._paths.append(path)
+        return self.save(path)
+
+    def close(self):
+        for path in self._paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._paths = []
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
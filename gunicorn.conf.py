@@ -0,0 +1,60 @@
+"""
+Gunicorn settings, see startup.txt:
+    gunicorn --config gunicorn.conf.py --chdir backend app2:app
+
+With GUNICORN_PRELOAD=1 (the default) the app is imported once in the master, which
+loads the speech models (SPEECH_MODEL_PRELOAD) and report templates, and the workers
+are forked from it. They share the model memory copy-on-write instead of each one
+importing the heavy libraries and loading its own copy, and start in milliseconds.
+The number of workers is WEB_CONCURRENCY (gunicorn's own setting), each serving
+GUNICORN_THREADS requests at a time.
+"""
+import gc
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# Get absolute path of project root directory
+BASE_DIR = Path(__file__).parent.absolute()
+
+# Read before the app is imported, so .env can switch preloading off
+load_dotenv(BASE_DIR / ".env")
+
+# CUDA cannot be initialized in a process that forks, GPU workers load their own models
+GUNICORN_PRELOAD = os.getenv(
+    'GUNICORN_PRELOAD', '0' if os.getenv('WHISPER_DEVICE', '').startswith('cuda') else '1'
+) != '0'
+
+# Threaded workers: a /ws/dictation session holds its thread while the sonographer speaks, and
+# the worker keeps reporting to the arbiter meanwhile instead of being killed after `timeout`
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '16'))
+# Seconds a worker may go silent (stuck) before the arbiter restarts it; not a limit on request length
+GUNICORN_TIMEOUT = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Seconds a worker gets on restart / reload to finish what it serves, e.g. a /bulk NDJSON stream
+GUNICORN_GRACEFUL_TIMEOUT = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '600'))
+
+preload_app = GUNICORN_PRELOAD
+worker_class = 'gthread'
+threads = GUNICORN_THREADS
+timeout = GUNICORN_TIMEOUT
+graceful_timeout = GUNICORN_GRACEFUL_TIMEOUT
+
+
+def when_ready(server):
+    # Metrics of the previous run; the workers of this one start counting from zero
+    import metrics
+    metrics.clear_stale()
+
+    # Everything the master created so far lives as long as the workers. Moving it out of
+    # the garbage collector's reach keeps collections in the workers from writing to, and
+    # so copying, the pages they share with the master.
+    if GUNICORN_PRELOAD:
+        gc.freeze()
+        server.log.info(f"Preloaded app, {gc.get_freeze_count()} objects shared with the workers")
+
+
+def post_worker_init(worker):
+    # Jobs are queued in the memory of a worker; take over those of workers that are gone
+    from job_queue import recover_jobs
+    recover_jobs()
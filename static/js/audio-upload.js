@@ -210,4 +210,115 @@ document.addEventListener('DOMContentLoaded', () => {
         // 其他类型就统一用一个图标
         return '📁';
     }
-});
\ No newline at end of file
+});
+// ==========================
+// 7. 实时听写（WebSocket + Vosk）
+// ==========================
+document.addEventListener('DOMContentLoaded', () => {
+    const dictationBtn = document.getElementById('dictationBtn');
+    const languageSelect = document.getElementById('dictationLanguage');
+    const transcriptDisplay = document.getElementById('dictationTranscript');
+    const resultDisplay = document.getElementById('result');
+
+    if (!dictationBtn || !transcriptDisplay || !resultDisplay) {
+        return;
+    }
+
+    const TARGET_RATE = 16000;
+    let socket = null;
+    let audioContext = null;
+    let mediaStream = null;
+    let processor = null;
+    let finalText = '';
+
+    // 将麦克风采样率的 Float32 数据降采样为 16kHz 16-bit PCM
+    function toPcm16(input, inputRate) {
+        const ratio = inputRate / TARGET_RATE;
+        const length = Math.floor(input.length / ratio);
+        const output = new Int16Array(length);
+        for (let i = 0; i < length; i++) {
+            const sample = Math.max(-1, Math.min(1, input[Math.floor(i * ratio)]));
+            output[i] = sample < 0 ? sample * 0x8000 : sample * 0x7FFF;
+        }
+        return output.buffer;
+    }
+
+    function showTranscript(partial) {
+        transcriptDisplay.textContent = finalText + (partial ? partial : '');
+    }
+
+    async function startDictation() {
+        mediaStream = await navigator.mediaDevices.getUserMedia({ audio: true });
+        audioContext = new AudioContext();
+        const sourceNode = audioContext.createMediaStreamSource(mediaStream);
+        processor = audioContext.createScriptProcessor(4096, 1, 1);
+
+        const protocol = location.protocol === 'https:' ? 'wss' : 'ws';
+        const language = languageSelect ? languageSelect.value : 'en';
+        socket = new WebSocket(`${protocol}://${location.host}/ws/dictation?language=${language}&rate=${TARGET_RATE}`);
+        socket.binaryType = 'arraybuffer';
+        finalText = '';
+
+        socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.type === 'partial') {
+                showTranscript(message.text);
+            } else if (message.type === 'final') {
+                finalText += message.text + '\n';
+                showTranscript('');
+            } else if (message.type === 'report') {
+                resultDisplay.innerHTML = `
+                    <p>Report generated successfully!</p>
+                    <a href="${message.downloadUrl_docx}" download>Download DOCX</a>
+                    <a href="${message.downloadUrl_pdf}" download>Download PDF</a>
+                `;
+                socket.close();
+            } else if (message.type === 'error') {
+                resultDisplay.innerHTML = `<p>Dictation failed: ${message.error}</p>`;
+                socket.close();
+            }
+        };
+
+        processor.onaudioprocess = (event) => {
+            if (socket && socket.readyState === WebSocket.OPEN) {
+                socket.send(toPcm16(event.inputBuffer.getChannelData(0), audioContext.sampleRate));
+            }
+        };
+        sourceNode.connect(processor);
+        processor.connect(audioContext.destination);
+
+        dictationBtn.innerHTML = '<i class="fas fa-stop"></i> Stop and Generate Report';
+        resultDisplay.innerHTML = '';
+    }
+
+    function stopDictation() {
+        if (processor) {
+            processor.disconnect();
+            processor = null;
+        }
+        if (mediaStream) {
+            mediaStream.getTracks().forEach(track => track.stop());
+            mediaStream = null;
+        }
+        if (audioContext) {
+            audioContext.close();
+            audioContext = null;
+        }
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify({ type: 'end' }));
+            resultDisplay.innerHTML = '<p>Generating report...</p>';
+        }
+        dictationBtn.innerHTML = '<i class="fas fa-microphone"></i> Start Dictation';
+    }
+
+    dictationBtn.addEventListener('click', () => {
+        if (processor) {
+            stopDictation();
+        } else {
+            startDictation().catch(error => {
+                console.error('Dictation failed:', error);
+                resultDisplay.innerHTML = `<p>Dictation failed: ${error.message}</p>`;
+            });
+        }
+    });
+});